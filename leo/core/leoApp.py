@@ -17,7 +17,7 @@ import os
 import optparse
 import string
 import sys
-# import time
+import time
 import traceback
 import zipfile
 import platform
@@ -37,11 +37,39 @@ class IdleTimeManager(object):
 
     Any code can call g.app.idleTimeManager.add_callback(callback) to cause
     the callback to be called at idle time forever.
+
+    The manager measures the time taken by each callback. At each tick, it
+    calls callbacks in rotating order until they have taken more than
+    @int idle-time-budget msec. The remaining callbacks are called first at
+    the next tick.
+
+    Callbacks may return False to indicate that they had nothing to do. The
+    manager then calls them less and less often, at most every max_backoff
+    ticks. itm.wake(callback) cancels the backoff. The manager also calls
+    callbacks that take longer than the budget less often, so that a slow
+    callback does not make typing sluggish.
+
+    Each 'idle' hook handler is a separate callback, so a slow plugin is
+    timed and backed off by itself. Likewise, the manager skips the
+    handlers of slow IdleTime timers for a number of firings.
+
+    The show-idle-time-stats command prints the statistics.
     '''
 
+    max_backoff = 8
+        # The maximum number of ticks for which a callback is skipped.
+
     def __init__(self):
         '''Ctor for IdleTimeManager class.'''
+        self.budget = None
+            # The budget for each tick, in msec.
+            # None: use @int idle-time-budget.
         self.callback_list = []
+        self.next_index = 0
+            # The index of the callback to call first at the next tick.
+        self.stats = {}
+            # Keys are callbacks or the names of IdleTime timers.
+            # Values are IdleTimeStats instances.
         self.timer = None
 
     #@+others
@@ -49,24 +77,122 @@ class IdleTimeManager(object):
     def add_callback(self, callback):
         '''Add a callback to be called at every idle time.'''
         self.callback_list.append(callback)
-    #@+node:ekr.20161026124810.1: *3* itm.on_idle
+    #@+node:ekr.20170822171539.1: *3* itm.get_budget & get_stats
+    def get_budget(self):
+        '''Return the budget for each tick, in seconds.'''
+        if self.budget is None:
+            n = g.app.config and g.app.config.getInt('idle-time-budget')
+            self.budget = n if n and n > 0 else 50
+        return self.budget / 1000.0
+
+    def get_stats(self, key, name=None):
+        '''Return the IdleTimeStats instance for key, creating it if necessary.'''
+        stats = self.stats.get(key)
+        if not stats:
+            stats = self.stats[key] = IdleTimeStats(name or self.callback_name(key))
+        return stats
+
+    def callback_name(self, callback):
+        '''Return a readable name for callback.'''
+        obj = getattr(callback, '__self__', None)
+        name = getattr(callback, '__name__', repr(callback))
+        return '%s.%s' % (obj.__class__.__name__, name) if obj else name
+    #@+node:ekr.20161026124810.1: *3* itm.on_idle & helper
     on_idle_count = 0
 
     def on_idle(self, timer):
-        '''IdleTimeManager: Run all idle-time callbacks.'''
+        '''IdleTimeManager: Run idle-time callbacks within the budget.'''
         if not g.app: return
         if g.app.killed: return
         self.on_idle_count += 1
-        # Handle the registered callbacks.
-        for callback in self.callback_list:
-            try:
-                callback()
-            except Exception:
-                g.es_exception()
+        tick = self.on_idle_count
+        budget = self.get_budget()
+        # Handle the registered callbacks, then the idle-time hooks.
+        callbacks = self.callback_list[:]
+        callbacks.extend(g.app.pluginsController.get_idle_callbacks())
+        n = len(callbacks)
+        start = self.next_index % n
+        t1 = time.time()
+        for i in range(n):
+            callback = callbacks[(start + i) % n]
+            if time.time() - t1 > budget:
+                # Start with this callback at the next tick.
+                self.next_index = (start + i) % n
+                break
+            stats = self.get_stats(callback)
+            if tick < stats.next_tick:
+                stats.skipped += 1
+                continue
+            self.call(callback, stats, tick, budget)
+        else:
+            self.next_index = start
+
+    def call(self, callback, stats, tick, budget):
+        '''Call the callback and record the time it takes.'''
+        t1 = time.time()
+        try:
+            result = callback()
+        except Exception:
+            g.es_exception()
+            if callback in self.callback_list:
                 g.es_print('removing callback: %s' % callback)
                 self.callback_list.remove(callback)
-        # Handle idle-time hooks.
-        g.app.pluginsController.on_idle()
+            return
+        stats.record(time.time() - t1, result)
+        stats.backoff = 0 if result is not False else min(
+            self.max_backoff, max(1, 2 * stats.backoff))
+        if stats.last > budget:
+            # Call slow callbacks less often.
+            stats.backoff = max(stats.backoff,
+                min(self.max_backoff, int(stats.last / budget)))
+        stats.next_tick = tick + 1 + stats.backoff
+    #@+node:ekr.20170822171539.2: *3* itm.print_stats
+    def print_stats(self):
+        '''Print the statistics of all callbacks and timers.'''
+        g.es_print('idle-time budget: %s msec, ticks: %s' % (
+            int(self.get_budget() * 1000), self.on_idle_count))
+        g.es_print('%8s %8s %8s %10s %8s %8s  %s' % (
+            'calls', 'idle', 'skipped', 'total ms', 'avg ms', 'max ms', 'name'))
+        for stats in sorted(self.stats.values(), key=lambda z: -z.total):
+            g.es_print('%8s %8s %8s %10.1f %8.2f %8.2f  %s' % (
+                stats.calls, stats.idle_calls, stats.skipped,
+                1000 * stats.total,
+                1000 * stats.total / max(1, stats.calls),
+                1000 * stats.max,
+                stats.name))
+    #@+node:ekr.20170822171539.3: *3* itm.record_timer, skip_timer & wake
+    def record_timer(self, timer, elapsed):
+        '''
+        Record the time taken by the handler of an IdleTime timer.
+        Skip the handler of a slow timer for a number of firings.
+        '''
+        stats = self.get_timer_stats(timer)
+        stats.record(elapsed, None)
+        budget = self.get_budget()
+        stats.backoff = min(self.max_backoff, int(elapsed / budget)) if elapsed > budget else 0
+        # For timers, ticks count the firings of the timer.
+        stats.next_tick = stats.calls + stats.skipped + 1 + stats.backoff
+
+    def skip_timer(self, timer):
+        '''Return True if the handler of the IdleTime timer should be skipped.'''
+        if timer is self.timer:
+            return False # The manager budgets its own callbacks.
+        stats = self.get_timer_stats(timer)
+        if stats.calls + stats.skipped + 1 < stats.next_tick:
+            stats.skipped += 1
+            return True
+        return False
+
+    def get_timer_stats(self, timer):
+        '''Return the IdleTimeStats instance for an IdleTime timer.'''
+        name = 'IdleTime: %s' % (timer.tag or self.callback_name(timer.handler))
+        return self.get_stats(name, name=name)
+
+    def wake(self, callback):
+        '''Call the callback at the next tick, even if it has been backed off.'''
+        stats = self.stats.get(callback)
+        if stats:
+            stats.backoff = stats.next_tick = 0
     #@+node:ekr.20161028034808.1: *3* itm.start
     def start (self):
         '''Start the idle-time timer.'''
@@ -77,6 +203,35 @@ class IdleTimeManager(object):
         if self.timer:
             self.timer.start()
     #@-others
+#@+node:ekr.20170822171539.4: ** class IdleTimeStats
+class IdleTimeStats(object):
+    '''Statistics about one idle-time callback or IdleTime timer.'''
+
+    def __init__(self, name):
+        '''Ctor for IdleTimeStats class.'''
+        self.name = name
+        self.backoff = 0
+            # The number of ticks to skip after the last call.
+        self.calls = 0
+        self.idle_calls = 0
+            # The number of calls that returned False.
+        self.last = 0.0
+            # The time taken by the last call, in seconds.
+        self.max = 0.0
+        self.next_tick = 0
+            # The first tick at which to call the callback again.
+        self.skipped = 0
+            # The number of ticks at which the callback was skipped.
+        self.total = 0.0
+
+    def record(self, elapsed, result):
+        '''Record one call that took elapsed seconds and returned result.'''
+        self.calls += 1
+        self.last = elapsed
+        self.max = max(self.max, elapsed)
+        self.total += elapsed
+        if result is False:
+            self.idle_calls += 1
 #@+node:ekr.20120209051836.10241: ** class LeoApp
 class LeoApp(object):
     """A class representing the Leo application itself.
@@ -3589,6 +3744,13 @@ def enable_idle_time_events(event):
 def toggle_idle_time_events(event):
     '''Toggle default idle-time event handling.'''
     g.app.idle_time_hooks_enabled = not g.app.idle_time_hooks_enabled
+#@+node:ekr.20170822171539.5: *3* show-idle-time-stats
+@g.command('show-idle-time-stats')
+def show_idle_time_stats(event):
+    '''Print statistics about all idle-time callbacks and IdleTime timers.'''
+    itm = g.app.idleTimeManager
+    if itm:
+        itm.print_stats()
 #@+node:ekr.20150514125218.4: *3* join-leo-irc
 @g.command('join-leo-irc')
 def join_leo_irc(event=None):
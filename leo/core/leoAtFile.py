@@ -130,6 +130,24 @@ class AtFile(object):
             'run-pyflakes-on-write', default=False)
         self.underindentEscapeString = c.config.getString(
             'underindent-escape-string') or '\\-'
+        n = c.config.getInt('read-external-files-threads')
+        self.readThreads = 4 if n is None else n
+            # The number of threads at.readAll uses to prefetch files.
+        self.prefetchDict = {}
+            # Keys are normalized paths, values are AsyncResults.
+        self.prefetchPool = None
+        n = c.config.getInt('write-external-files-threads')
+        self.writeThreads = 4 if n is None else n
+            # The number of threads at.writeAll uses to write files.
+        self.writePool = None
+        self.writeJobs = []
+        self.writeJobsDict = {}
+        self.pyflakesPaths = None
+            # A list of (path, pyflakes_errors_only) tuples
+            # while at.writeAll defers pyflakes checks.
+        self.fileDigests = {}
+            # Keys are at.pathKey(path), values are (mtime, size, digest)
+            # for the contents Leo last read from or wrote to path.
         self.dispatch_dict = self.defineDispatchDict()
             # Define the dispatch dictionary used by scanText4.
     #@+node:ekr.20041005105605.9: *5* at.defineDispatchDict
@@ -697,7 +715,7 @@ class AtFile(object):
         except sqlite3.OperationalError:
             hx2 = False
         return hx2 and hx2[0] == hx
-    #@+node:ekr.20041005105605.26: *5* at.readAll
+    #@+node:ekr.20041005105605.26: *5* at.readAll & helper
     def readAll(self, root, force=False):
         """Scan positions, looking for @<file> nodes to read."""
         at, c = self, self.c
@@ -708,64 +726,142 @@ class AtFile(object):
             # we aren't doing the initial read.
             c.endEditing()
         t1 = time.time()
+        c.init_error_dialogs()
+        at.startPrefetch(root if force else None)
+        try:
+            nRead = at.readAllHelper(root, force)
+        finally:
+            at.endPrefetch()
+        c.cacher.flushOutlineCache()
+        if not g.unitTesting:
+            if nRead:
+                t2 = time.time()
+                g.es('read %s files in %2.2f seconds' % (nRead, t2 - t1))
+            elif force:
+                g.es("no @<file> nodes in the selected tree")
+        if use_tracer: tt.stop()
+        c.raise_error_dialogs()
+
+    def readAllHelper(self, root, force):
+        '''Read all @<file> nodes. Return the number of files read.'''
+        at, c = self, self.c
         nRead = 0
-        p = root.copy()
         scanned_tnodes = set()
-        c.init_error_dialogs()
-        after = p.nodeAfterTree() if force else None
-        while p and p != after:
-            gnx = p.gnx
+        # Traverse vnodes, creating positions only for @<file> nodes.
+        w = c.walk_nodes(root=root if force else None)
+        for v, level, childIndex in w:
+            gnx = v.gnx
             #skip clones
             if gnx in scanned_tnodes:
-                p.moveToNodeAfterTree()
+                w.skipTree()
                 continue
             scanned_tnodes.add(gnx)
-            if not p.h.startswith('@'):
-                p.moveToThreadNext()
-            elif p.isAtIgnoreNode():
-                if p.isAnyAtFileNode():
-                    c.ignored_at_file_nodes.append(p.h)
-                p.moveToNodeAfterTree()
-            elif p.isAtThinFileNode():
+            if not v.h.startswith('@'):
+                pass
+            elif v.isAtIgnoreNode():
+                if v.isAnyAtFileNode():
+                    c.ignored_at_file_nodes.append(v.h)
+                w.skipTree()
+            elif v.isAtThinFileNode():
                 nRead += 1
-                at.read(p, force=force)
-                p.moveToNodeAfterTree()
-            elif p.isAtAutoNode():
+                at.read(w.position(), force=force)
+                w.skipTree()
+            elif v.isAtAutoNode():
                 nRead += 1
-                fileName = p.atAutoNodeName()
-                at.readOneAtAutoNode(fileName, p)
-                p.moveToNodeAfterTree()
-            elif p.isAtEditNode():
+                fileName = v.atAutoNodeName()
+                at.readOneAtAutoNode(fileName, w.position())
+                w.skipTree()
+            elif v.isAtEditNode():
                 nRead += 1
-                fileName = p.atEditNodeName()
-                at.readOneAtEditNode(fileName, p)
-                p.moveToNodeAfterTree()
-            elif p.isAtShadowFileNode():
+                fileName = v.atEditNodeName()
+                at.readOneAtEditNode(fileName, w.position())
+                w.skipTree()
+            elif v.isAtShadowFileNode():
                 nRead += 1
-                fileName = p.atShadowFileNodeName()
-                at.readOneAtShadowNode(fileName, p)
-                p.moveToNodeAfterTree()
-            elif p.isAtFileNode():
+                fileName = v.atShadowFileNodeName()
+                at.readOneAtShadowNode(fileName, w.position())
+                w.skipTree()
+            elif v.isAtFileNode():
                 nRead += 1
-                at.read(p, force=force)
-                p.moveToNodeAfterTree()
-            elif p.isAtAsisFileNode() or p.isAtNoSentFileNode():
+                at.read(w.position(), force=force)
+                w.skipTree()
+            elif v.isAtAsisFileNode() or v.isAtNoSentFileNode():
+                p = w.position()
                 at.rememberReadPath(g.fullPath(c, p), p)
-                p.moveToNodeAfterTree()
-            elif p.isAtCleanNode():
+                w.skipTree()
+            elif v.isAtCleanNode():
                 nRead += 1
-                at.readOneAtCleanNode(p)
-                p.moveToNodeAfterTree()
-            else:
-                p.moveToThreadNext()
-        if not g.unitTesting:
-            if nRead:
-                t2 = time.time()
-                g.es('read %s files in %2.2f seconds' % (nRead, t2 - t1))
-            elif force:
-                g.es("no @<file> nodes in the selected tree")
-        if use_tracer: tt.stop()
-        c.raise_error_dialogs()
+                at.readOneAtCleanNode(w.position())
+                w.skipTree()
+        return nRead
+    #@+node:ekr.20170820094128.1: *5* at.startPrefetch & helpers
+    def startPrefetch(self, root=None):
+        '''
+        Start reading the contents of the external files of all @file, @thin,
+        @clean and @auto nodes in root's tree (or the entire outline) in
+        at.readThreads worker threads.
+
+        The threads only read bytes. at.openFileHelper and cacher.readFile
+        call at.getPrefetchedFile, so all decoding, scanning and outline
+        changes happen in the main thread, in the same order as before.
+        '''
+        at, c = self, self.c
+        if at.readThreads < 2 or at.prefetchPool:
+            return
+        paths, seen = [], set()
+        w = c.walk_nodes(root=root)
+        for v, level, childIndex in w:
+            if v in seen:
+                w.skipTree()
+                continue
+            seen.add(v)
+            if not v.h.startswith('@'):
+                continue
+            if v.isAtIgnoreNode() or v.isAtShadowFileNode():
+                # @shadow reads may update the public file.
+                w.skipTree()
+            elif (v.isAtThinFileNode() or v.isAtFileNode() or
+                v.isAtCleanNode() or v.isAtAutoNode()
+            ):
+                paths.append(g.fullPath(c, w.position()))
+                w.skipTree()
+            elif v.isAnyAtFileNode():
+                w.skipTree()
+        if len(paths) < 2:
+            return
+        try:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(at.readThreads, len(paths)))
+        except Exception:
+            # Some platforms do not support multiprocessing.
+            return
+        at.prefetchPool = pool
+        for path in paths:
+            key = at.pathKey(path)
+            if key not in at.prefetchDict:
+                at.prefetchDict[key] = pool.apply_async(
+                    g.readFileIntoEncodedString, (path,), {'silent': True})
+
+    def endPrefetch(self):
+        '''Discard all prefetched files.'''
+        at = self
+        if at.prefetchPool:
+            at.prefetchPool.terminate()
+            at.prefetchPool = None
+        at.prefetchDict = {}
+
+    def getPrefetchedFile(self, fn):
+        '''
+        Return the bytes of file fn if at.startPrefetch has read it.
+        Return None otherwise, or if the read failed.
+        '''
+        at = self
+        result = at.prefetchDict.get(at.pathKey(fn)) if fn else None
+        return result.get() if result else None
+
+    def pathKey(self, fn):
+        '''Return the key for fn in at.prefetchDict and at.fileDigests.'''
+        return os.path.normcase(os.path.abspath(fn))
     #@+node:ekr.20080801071227.7: *5* at.readAtShadowNodes
     def readAtShadowNodes(self, p):
         '''Read all @shadow nodes in the p's tree.'''
@@ -1193,11 +1289,15 @@ class AtFile(object):
     def openFileHelper(self, fn):
         '''Open a file, reporting all exceptions.'''
         at = self
-        s = None
+        s = at.getPrefetchedFile(fn)
+        if s is not None:
+            at.recordFileDigest(fn, s)
+            return s
         try:
             f = open(fn, 'rb')
             s = f.read()
             f.close()
+            at.recordFileDigest(fn, s)
         except IOError:
             at.error('can not open %s' % (fn))
         except Exception:
@@ -1286,6 +1386,7 @@ class AtFile(object):
         if trace: g.trace('%28s %s' % (v.h, repr(s)))
         if at.importing:
             v._bodyString = s # Allowed use of _bodyString.
+            v.textChanged()
         elif middle:
             pass # Middle sentinels never alter text.
         else:
@@ -2624,6 +2725,8 @@ class AtFile(object):
         self.error(message)
         # Delete all of root's tree.
         self.root.v.children = []
+        self.root.v.dataChanged()
+        self.c.frame.tree.generation += 1
         self.root.setDirty()
             # 2010/10/22: the dirty bit gets cleared later, though.
         self.root.setOrphan()
@@ -2922,12 +3025,11 @@ class AtFile(object):
                 else:
                     # Fix bug 889175: Remember the full fileName.
                     at.rememberReadPath(eventualFileName, root)
-                    at.replaceTargetFileIfDifferent(root)
+                    if trace: g.trace(g.shortFileName(eventualFileName))
+                    at.replaceTargetFileIfDifferent(root,
+                        cacheFileName=eventualFileName)
                         # Sets/clears dirty and orphan bits.
-                    # Leo 5.6: update the cache *here*, not just when reading.
-                    fileKey = c.cacher.fileKey(eventualFileName, at.outputContents)
-                    if trace: g.trace(g.shortFileName(eventualFileName), fileKey)
-                    c.cacher.writeFile(at.root, fileKey)
+                        # Leo 5.6: update the cache *here*, not just when reading.
         except Exception:
             if hasattr(self.root.v, 'tnodeList'):
                 delattr(self.root.v, 'tnodeList')
@@ -2979,38 +3081,19 @@ class AtFile(object):
             # Write all nodes in the selected tree.
             root = c.p
             p = c.p
-            after = p.nodeAfterTree()
         else:
             # Write dirty nodes in the entire outline.
             root = c.rootPosition()
             p = c.rootPosition()
-            after = None
         at.clearAllOrphanBits(p)
-        # Leo 5.6: write files only once.
-        seen = set()
-        while p and p != after:
-            if p.isAtIgnoreNode() and not p.isAtAsisFileNode():
-                if p.isAnyAtFileNode():
-                    c.ignored_at_file_nodes.append(p.h)
-                # Note: @ignore not honored in @asis nodes.
-                p.moveToNodeAfterTree() # 2011/10/08: Honor @ignore!
-            elif p.isAnyAtFileNode():
-                if p.v not in seen:
-                    seen.add(p.v)
-                    try:
-                        self.writeAllHelper(p, root, force, toString, writeAtFileNodesFlag, writtenFiles)
-                    except Exception:
-                        # Fix bug 1260415: https://bugs.launchpad.net/leo-editor/+bug/1260415
-                        # Give a more urgent, more specific, more helpful message.
-                        g.es_exception()
-                        g.es('Internal error writing: %s' % (p.h), color='red')
-                        g.es('Please report this error to:', color='blue')
-                        g.es('https://groups.google.com/forum/#!forum/leo-editor', color='blue')
-                        g.es('Warning: changes to this file will be lost', color='red')
-                        g.es('unless you can save the file successfully.', color='red')
-                p.moveToNodeAfterTree()
-            else:
-                p.moveToThreadNext()
+        if not toString:
+            at.startWriteBatch()
+        try:
+            at.writeAllFiles(p, root, force, toString, writeAtFileNodesFlag, writtenFiles)
+        finally:
+            if not toString:
+                at.endWriteBatch()
+                c.cacher.flushOutlineCache()
         # Make *sure* these flags are cleared for other commands.
         at.canCancelFlag = False
         at.cancelFlag = False
@@ -3034,6 +3117,36 @@ class AtFile(object):
             self.saveOutlineIfPossible()
         if trace: g.trace('%s calls to c.scanAtPathDirectives()' % (
             c.scanAtPathDirectivesCount - scanAtPathDirectivesCount))
+
+    def writeAllFiles(self, p, root, force, toString, writeAtFileNodesFlag, writtenFiles):
+        '''Call at.writeAllHelper for all @<file> nodes in p's tree.'''
+        at, c = self, self.c
+        # Leo 5.6: write files only once.
+        seen = set()
+        # Traverse vnodes, creating positions only for @<file> nodes.
+        w = c.walk_nodes(root=p if writeAtFileNodesFlag else None)
+        for v, level, childIndex in w:
+            if v.isAtIgnoreNode() and not v.isAtAsisFileNode():
+                if v.isAnyAtFileNode():
+                    c.ignored_at_file_nodes.append(v.h)
+                # Note: @ignore not honored in @asis nodes.
+                w.skipTree() # 2011/10/08: Honor @ignore!
+            elif v.isAnyAtFileNode():
+                if v not in seen:
+                    seen.add(v)
+                    p = w.position()
+                    try:
+                        self.writeAllHelper(p, root, force, toString, writeAtFileNodesFlag, writtenFiles)
+                    except Exception:
+                        # Fix bug 1260415: https://bugs.launchpad.net/leo-editor/+bug/1260415
+                        # Give a more urgent, more specific, more helpful message.
+                        g.es_exception()
+                        g.es('Internal error writing: %s' % (p.h), color='red')
+                        g.es('Please report this error to:', color='blue')
+                        g.es('https://groups.google.com/forum/#!forum/leo-editor', color='blue')
+                        g.es('Warning: changes to this file will be lost', color='red')
+                        g.es('unless you can save the file successfully.', color='red')
+                w.skipTree()
     #@+node:ekr.20041005105605.148: *6* at.clearAllOrphanBits
     def clearAllOrphanBits(self, p):
         '''Clear orphan bits for all nodes *except* orphan @file nodes.'''
@@ -4209,7 +4322,13 @@ class AtFile(object):
             # Syntax checking catches most indentation problems.
                 # if ok: at.tabNannyNode(root,s)
             if ok and at.runPyFlakesOnWrite and not g.unitTesting:
-                ok2 = self.runPyflakes(root, pyflakes_errors_only=pyflakes_errors_only)
+                if at.pyflakesPaths is not None:
+                    # Defer the check until at.endWriteBatch.
+                    # at.endPyflakesJob reports errors.
+                    at.pyflakesPaths.append((targetFn, pyflakes_errors_only))
+                    ok2 = True
+                else:
+                    ok2 = self.runPyflakes(root, pyflakes_errors_only=pyflakes_errors_only)
             else:
                 ok2 = True
             if not ok or not ok2:
@@ -4262,6 +4381,64 @@ class AtFile(object):
                 return ok
         except Exception:
             g.es_exception()
+    #@+node:ekr.20170820102251.5: *6* at.runPyflakesInBackground & endPyflakesJob
+    def runPyflakesInBackground(self, paths):
+        '''
+        Run pyflakes on the files in paths, a list of (path,
+        pyflakes_errors_only) tuples, using the BackgroundProcessManager.
+
+        One process checks all files whose pyflakes_errors_only flag is
+        False. The BPM writes its output to the log. Another, quiet, process
+        checks the other files, whose output appears only if pyflakes finds
+        problems. When each process finishes, at.endPyflakesJob reports the
+        files containing problems.
+        '''
+        at, c = self, self.c
+        bpm = g.app.backgroundProcessManager
+        try:
+            import leo.commands.checkerCommands as checkerCommands
+            if not checkerCommands.pyflakes:
+                return
+            full = set(fn for fn, errors_only in paths if not errors_only)
+            quiet = set(fn for fn, errors_only in paths if errors_only) - full
+            for fns, errors_only in ((full, False), (quiet, True)):
+                fns = sorted(fns)
+                if not fns:
+                    continue
+                if bpm:
+                    command = [sys.executable, '-m', 'pyflakes'] + fns
+                    bpm.start_process(c, command,
+                        kind='pyflakes',
+                        fn=c.shortFileName(),
+                        callback=lambda data, fns=fns: at.endPyflakesJob(data, fns),
+                        quiet=errors_only)
+                else:
+                    x = checkerCommands.PyflakesCommand(c)
+                    at.reportPyflakesErrors(
+                        [fn for fn in fns if x.check_all(False, [fn], errors_only)])
+        except Exception:
+            g.es_exception()
+
+    def endPyflakesJob(self, data, paths):
+        '''
+        The BPM callback for at.runPyflakesInBackground. pyflakes checked
+        paths and reports each problem as path:line:col: message.
+        '''
+        at = self
+        if not data.returncode:
+            return
+        lines = data.output + data.errors
+        if data.quiet:
+            for s in lines:
+                g.es_print(s.rstrip())
+        bad = [fn for fn in paths if any(s.startswith(fn + ':') for s in lines)]
+        at.reportPyflakesErrors(bad or paths)
+
+    def reportPyflakesErrors(self, paths):
+        '''Add paths to g.app.syntax_error_files and report them.'''
+        if paths:
+            g.app.syntax_error_files.extend([g.shortFileName(z) for z in paths])
+            self.c.syntaxErrorDialog()
     #@+node:ekr.20090514111518.5665: *6* at.tabNannyNode
     def tabNannyNode(self, p, body, suppress=False):
         import parser
@@ -4355,25 +4532,8 @@ class AtFile(object):
         if s2 is None:
             g.internalError('empty compare file: %s' % path2)
             return False
-        # 2013/10/28: fix bug #1243855: @auto-rst doesn't save text
-        # Make sure both strings are unicode.
-        # This is requred to handle binary files in Python 3.x.
-        if not g.isUnicode(s1):
-            s1 = g.toUnicode(s1, encoding=e1)
-        if not g.isUnicode(s2):
-            s2 = g.toUnicode(s2, encoding=e2)
-        equal = s1 == s2
-        if ignoreBlankLines and not equal:
-            s1 = g.removeBlankLines(s1)
-            s2 = g.removeBlankLines(s2)
-            equal = s1 == s2
-        if ignoreLineEndings and not equal:
-            # Wrong: equivalent to ignoreBlankLines!
-                # s1 = s1.replace('\n','').replace('\r','')
-                # s2 = s2.replace('\n','').replace('\r','')
-            s1 = s1.replace('\r', '')
-            s2 = s2.replace('\r', '')
-            equal = s1 == s2
+        equal = at.compareContents(s1, e1, s2, e2,
+            ignoreLineEndings, ignoreBlankLines=ignoreBlankLines)
         if trace: g.trace('equal', equal)
         return equal
     #@+node:ekr.20041005105605.198: *5* at.directiveKind4 (write logic, changed)
@@ -4711,8 +4871,10 @@ class AtFile(object):
             at.error('unexpected exception writing file: %s' % (fn))
             g.es_exception()
             return False
-    #@+node:ekr.20041005105605.212: *5* at.replaceTargetFileIfDifferent
-    def replaceTargetFileIfDifferent(self, root, ignoreBlankLines=False):
+    #@+node:ekr.20041005105605.212: *5* at.replaceTargetFileIfDifferent & helpers
+    def replaceTargetFileIfDifferent(self, root,
+        ignoreBlankLines=False, cacheFileName=None
+    ):
         '''Create target file as follows:
         1. If target file does not exist, rename output file to target file.
         2. If target file is identical to output file, remove the output file.
@@ -4720,9 +4882,16 @@ class AtFile(object):
            remove target file, then rename output file to be target file.
 
         Return True if the original file was changed.
+
+        If cacheFileName is given, at.finishWriteJob caches root's outline
+        for that file, but only if the target file now contains the output.
+
+        Within at.startWriteBatch and at.endWriteBatch, queue the comparison
+        and write for a worker thread and return False.
+        at.endWriteBatch reports the results.
         '''
         trace = False and not g.unitTesting
-        at = self; c = at.c
+        at = self
         if at.toString:
             # Do *not* change the actual file or set any dirty flag.
             at.fileChangedFlag = False
@@ -4740,74 +4909,249 @@ class AtFile(object):
             'ignoreBlankLines', ignoreBlankLines,
             'target exists', g.os_path_exists(at.targetFileName),
             at.outputFileName, at.targetFileName)
+        job = g.Bunch(
+            root=root and root.copy(),
+            cacheFileName=cacheFileName,
+            contents=at.outputContents,
+            encoding=at.encoding,
+            explicitLineEnding=at.explicitLineEnding,
+            ignoreBlankLines=ignoreBlankLines,
+            output_newline=at.output_newline,
+            shortFileName=at.shortFileName,
+            targetFileName=at.targetFileName,
+        )
+        if at.writePool:
+            at.queueWriteJob(job)
+            at.fileChangedFlag = False
+            return False
+        at.compareAndWrite(job)
+        return at.finishWriteJob(job)
+    #@+node:ekr.20170820102251.1: *6* at.compareAndWrite
+    def compareAndWrite(self, job):
+        '''
+        Compare job.contents with job.targetFileName, writing the file if they
+        differ. Set job.exists, job.equal, job.endingsOnly, job.ok, job.error
+        and job.readError.
+
+        The file is not read if at.fileDigests shows that its contents are
+        the bytes to be written.
+
+        This method may run in a worker thread: it uses only the job and the
+        file system, and it must not write to the log.
+        '''
+        at = self
+        fn, s = job.targetFileName, job.contents
+        job.exists = g.os_path_exists(fn)
+        job.equal = job.endingsOnly = False
+        job.error = job.readError = None
+        try:
+            b = at.toOutputBytes(s, job.encoding, job.output_newline)
+            if job.exists and at.fileDigestMatches(fn, b):
+                # Leo has just read or written exactly these bytes.
+                job.equal = job.ok = True
+                return job
+            if job.exists:
+                s2 = g.readFileIntoEncodedString(fn, silent=True)
+                if s2 is None:
+                    job.readError = 'empty compare file: %s' % fn
+                else:
+                    job.equal = at.compareContents(s, job.encoding, s2, None,
+                        ignoreLineEndings=not job.explicitLineEnding,
+                        ignoreBlankLines=job.ignoreBlankLines)
+                    if job.equal:
+                        at.recordFileDigest(fn, s2)
+                        job.ok = True
+                        return job
+                    # Report if the files differ only in line endings.
+                    job.endingsOnly = job.explicitLineEnding and at.compareContents(
+                        s, job.encoding, s2, None, ignoreLineEndings=True)
+            with open(fn, 'wb') as f: # Must be 'wb' to preserve line endings.
+                f.write(b)
+            at.recordFileDigest(fn, b)
+            job.ok = True
+        except Exception:
+            typ, val, tb = sys.exc_info()
+            job.error = '%s: %s' % (typ.__name__, val)
+            job.ok = False
+        return job
+    #@+node:ekr.20170820102251.2: *6* at.finishWriteJob
+    def finishWriteJob(self, job):
+        '''
+        Report the results of at.compareAndWrite, set dirty and orphan bits
+        and check Python code. Return True if the original file was changed.
+        '''
+        at, c = self, self.c
+        root, fn, sfn = job.root, job.targetFileName, job.shortFileName
         # #531: Optionally report timestamp...
         if c.config.getBool('log_show_save_time', default=False):
             format = c.config.getString('log_timestamp_format') or "%H:%M:%S"
             timestamp = time.strftime(format) + ' '
         else:
             timestamp = ''
-        if g.os_path_exists(at.targetFileName):
-            if at.compareFiles(
-                at.outputFileName,
-                at.targetFileName,
-                ignoreLineEndings=not at.explicitLineEnding,
-                ignoreBlankLines=ignoreBlankLines
-            ):
-                # Files are identical.
-                if trace: g.trace('files are identical')
-                report = c.config.getBool('report_unchanged_files', default=True)
-                at.sameFiles += 1
-                if report and not g.unitTesting:
-                    g.es('%sunchanged: %s' % (timestamp, at.shortFileName))
-                at.fileChangedFlag = False
-                # Leo 5.6: Check unchanged files.
-                at.checkPythonCode(root, pyflakes_errors_only=True)
-                return False
-            else:
-                # A mismatch. Report if the files differ only in line endings.
-                if (
-                    at.explicitLineEnding and
-                    at.compareFiles(
-                        at.outputFileName,
-                        at.targetFileName,
-                        ignoreLineEndings=True)
-                ):
-                    g.warning("correcting line endings in:", at.targetFileName)
-                s = at.outputContents
-                ok = at.create(at.targetFileName, s)
-                if ok:
-                    c.setFileTimeStamp(at.targetFileName)
-                    if not g.unitTesting:
-                        g.es('%swrote: %s' % (timestamp, at.shortFileName))
+        if job.ok and job.cacheFileName and job.root:
+            # The file contains exactly what Leo wrote.
+            c.cacher.writeFile(job.root, job.cacheFileName)
+        if job.exists and job.equal:
+            # Files are identical.
+            report = c.config.getBool('report_unchanged_files', default=True)
+            at.sameFiles += 1
+            if report and not g.unitTesting:
+                g.es('%sunchanged: %s' % (timestamp, sfn))
+            at.fileChangedFlag = False
+            # Leo 5.6: Check unchanged files.
+            at.checkPythonCode(root, s=job.contents, targetFn=fn,
+                pyflakes_errors_only=True)
+            return False
+        if job.readError:
+            g.internalError(job.readError)
+        if job.endingsOnly:
+            g.warning("correcting line endings in:", fn)
+        if job.ok:
+            c.setFileTimeStamp(fn)
+            if not g.unitTesting:
+                if job.exists:
+                    g.es('%swrote: %s' % (timestamp, sfn))
                 else:
-                    g.error('error writing', at.shortFileName)
-                    g.es('not written:', at.shortFileName)
-                    if root:
-                        root.setDirty() # New in 4.4.8.
-                        root.setOrphan() # 2010/10/22.
-                at.checkPythonCode(root)
-                    # Bug fix: check *after* writing the file.
-                at.fileChangedFlag = ok
-                return ok
+                    g.es('%screated: %s' % (timestamp, fn))
+            if root and not job.exists:
+                # Fix bug 889175: Remember the full fileName.
+                at.rememberReadPath(fn, root)
         else:
-            s = at.outputContents
-            ok = self.create(at.targetFileName, s)
-            if ok:
-                c.setFileTimeStamp(at.targetFileName)
-                if not g.unitTesting:
-                    g.es('%screated: %s' % (timestamp, at.targetFileName))
-                if root:
-                    # Fix bug 889175: Remember the full fileName.
-                    at.rememberReadPath(at.targetFileName, root)
-            else:
-                # at.rename gives the error.
-                if root:
-                    root.setDirty() # New in 4.4.8.
-                    root.setOrphan() # 2010/10/22.
-            # No original file to change. Return value tested by a unit test.
-            at.fileChangedFlag = False
-            at.checkPythonCode(root)
+            g.es_print(job.error)
+            g.error('error writing', fn)
+            g.es('not written:', sfn)
+            if root:
+                root.setDirty() # New in 4.4.8.
+                root.setOrphan() # 2010/10/22.
+        at.checkPythonCode(root, s=job.contents, targetFn=fn)
+            # Bug fix: check *after* writing the file.
+        # Return value tested by a unit test.
+        changed = job.exists and job.ok
+        at.fileChangedFlag = changed
+        return changed
+    #@+node:ekr.20170820102251.3: *6* at.start/endWriteBatch & helper
+    def startWriteBatch(self):
+        '''
+        Start a batch of writes. Until at.endWriteBatch,
+        at.replaceTargetFileIfDifferent compares and writes external files
+        in at.writeThreads worker threads, and at.checkPythonCode defers
+        pyflakes checks.
+        '''
+        at = self
+        if at.writeThreads > 1 and not at.writePool:
+            try:
+                from multiprocessing.pool import ThreadPool
+                at.writePool = ThreadPool(at.writeThreads)
+            except Exception:
+                # Some platforms do not support multiprocessing.
+                at.writePool = None
+        at.writeJobs = []
+        at.writeJobsDict = {}
+        at.pyflakesPaths = []
+
+    def endWriteBatch(self):
+        '''
+        Wait for all queued writes, then report the results in the order in
+        which the files were written. Finally, run pyflakes on all checked
+        files in the background.
+        '''
+        at = self
+        jobs, pool, paths = at.writeJobs, at.writePool, at.pyflakesPaths
+        at.writeJobs, at.writePool, at.pyflakesPaths = [], None, None
+        at.writeJobsDict = {}
+        try:
+            for job in jobs:
+                job.result.wait()
+                at.finishWriteJob(job)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        if paths:
+            at.runPyflakesInBackground(paths)
+
+    def queueWriteJob(self, job):
+        '''Start comparing and writing job.targetFileName in a worker thread.'''
+        at = self
+        key = g.os_path_normcase(job.targetFileName)
+        job2 = at.writeJobsDict.get(key)
+        if job2:
+            # Later writes to the same file must win.
+            job2.result.wait()
+        job.result = at.writePool.apply_async(at.compareAndWrite, (job,))
+        at.writeJobs.append(job)
+        at.writeJobsDict[key] = job
+    #@+node:ekr.20170821071845.1: *6* at.recordFileDigest & fileDigestMatches
+    def recordFileDigest(self, fn, s):
+        '''
+        Remember the digest of s, the bytes just read from or written to fn,
+        along with fn's modification time and size.
+        '''
+        at = self
+        try:
+            st = os.stat(fn)
+        except (OSError, TypeError):
+            return
+        if st.st_size == len(s):
+            at.fileDigests[at.pathKey(fn)] = (
+                st.st_mtime, st.st_size, hashlib.md5(s).hexdigest())
+
+    def fileDigestMatches(self, fn, s):
+        '''
+        Return True if file fn is unchanged since Leo last read or wrote it,
+        and if fn then contained exactly the bytes s.
+        '''
+        at = self
+        data = at.fileDigests.get(at.pathKey(fn))
+        if not data or data[1] != len(s):
             return False
+        try:
+            st = os.stat(fn)
+        except OSError:
+            return False
+        return (
+            (st.st_mtime, st.st_size) == data[:2] and
+            hashlib.md5(s).hexdigest() == data[2])
+    #@+node:ekr.20170820102251.4: *6* at.compareContents & toOutputBytes
+    def compareContents(self, s1, e1, s2, e2,
+        ignoreLineEndings, ignoreBlankLines=False
+    ):
+        '''
+        Return True if strings s1 and s2 are equal.
+        e1 and e2 are the encodings of s1 and s2 if they are not unicode.
+        '''
+        # 2013/10/28: fix bug #1243855: @auto-rst doesn't save text
+        # Make sure both strings are unicode.
+        # This is requred to handle binary files in Python 3.x.
+        if not g.isUnicode(s1):
+            s1 = g.toUnicode(s1, encoding=e1)
+        if not g.isUnicode(s2):
+            s2 = g.toUnicode(s2, encoding=e2)
+        equal = s1 == s2
+        if ignoreBlankLines and not equal:
+            s1 = g.removeBlankLines(s1)
+            s2 = g.removeBlankLines(s2)
+            equal = s1 == s2
+        if ignoreLineEndings and not equal:
+            # Wrong: equivalent to ignoreBlankLines!
+                # s1 = s1.replace('\n','').replace('\r','')
+                # s2 = s2.replace('\n','').replace('\r','')
+            s1 = s1.replace('\r', '')
+            s2 = s2.replace('\r', '')
+            equal = s1 == s2
+        return equal
+
+    def toOutputBytes(self, s, encoding, output_newline):
+        '''Return s, with output_newline line endings, as an encoded string.'''
+        # 2015/07/15: do this before converting to encoded string.
+        if output_newline != '\n':
+            s = s.replace('\r', '').replace('\n', output_newline)
+        # This is part of the new_write logic.
+        # This is the only call to g.toEncodedString in the new_write logic.
+        # 2013/10/28: fix bug 1243847: unicode error when saving @shadow nodes
+        if g.isUnicode(s):
+            s = g.toEncodedString(s, encoding=encoding)
+        return s
     #@+node:ekr.20041005105605.216: *5* at.warnAboutOrpanAndIgnoredNodes
     # Called from writeOpenFile.
 
@@ -4884,14 +5228,7 @@ class AtFile(object):
     def create(self, fn, s):
         '''Create a file whose contents are s.'''
         at = self
-        # 2015/07/15: do this before converting to encoded string.
-        if at.output_newline != '\n':
-            s = s.replace('\r', '').replace('\n', at.output_newline)
-        # This is part of the new_write logic.
-        # This is the only call to g.toEncodedString in the new_write logic.
-        # 2013/10/28: fix bug 1243847: unicode error when saving @shadow nodes
-        if g.isUnicode(s):
-            s = g.toEncodedString(s, encoding=at.encoding)
+        s = at.toOutputBytes(s, at.encoding, at.output_newline)
         try:
             f = open(fn, 'wb') # Must be 'wb' to preserve line endings.
             f.write(s)
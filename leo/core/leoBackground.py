@@ -6,6 +6,7 @@
 
 import leo.core.leoGlobals as g
 import subprocess
+import threading
 
 #@+others
 #@+node:ekr.20161026193609.1: ** class BackgroundProcessManager
@@ -17,32 +18,48 @@ class BackgroundProcessManager(object):
     #@@wrap
 
     The BackgroundProcessManager (BPM) class runs background processes,
-    *without blocking Leo*. The BPM manages a queue of processes, and runs them
-    *one at a time* so that their output remains separate.
+    *without blocking Leo*. The BPM manages a queue of processes, and runs up
+    to bpm.max_processes of them at once. Reader threads capture the output of
+    each process separately, so the output of all processes remains separate.
 
     g.app.backgroundProcessManager is the singleton BPM.
 
-    The BPM registers a handler with the IdleTimeManager that checks whether
-    the presently running background process has completed. If so, the handler
-    writes the process's output to the log and starts another background
-    process in the queue.
+    The BPM registers a handler with the IdleTimeManager that starts queued
+    processes, checks whether running processes have completed, and writes
+    their output to the log *in the order in which the processes were
+    queued*. The output of the oldest process appears as it is produced; the
+    output of later processes appears when all earlier processes have
+    completed. The stderr of each process follows its stdout when the
+    process has completed.
 
-    BPM.start_process(c, command, kind, fn=None, shell=False) adds a process to
-    the queue that will run the given command.
+    BPM.start_process(c, command, kind, fn=None, shell=False, callback=None,
+    quiet=False) adds a process to the queue that will run the given command.
+    It returns a ProcessData instance. When the process has completed and its
+    output has been written, the BPM calls callback(data), if given.
+    data.returncode is the process's return code, data.output its stdout and
+    data.errors its stderr, as lists of lines. If quiet is True, the BPM
+    writes nothing to the log for the process: the callback reports its
+    results.
 
-    BM.kill(kind=None) kills all process with the given kind. If kind is None
-    or 'all', all processes are killed.
+    BPM.set_limit(kind, n) limits the number of running processes of the
+    given kind. @int max-background-processes limits the total number of
+    running processes. The default is 4.
+
+    BPM.kill(kind=None) kills all process with the given kind. If kind is None
+    or 'all', all processes are killed. BPM.cancel(data) kills or dequeues a
+    single process.
 
     You can add processes to the queue at any time. For example, you can rerun
     the 'pylint' command while a background process is running.
 
-    The BackgroundProcessManager is completely safe: all of its code runs in
-    the main process.
+    The BackgroundProcessManager is completely safe: apart from the reader
+    threads, which only append lines to lists, all of its code runs in the
+    main process.
 
-    **Running multiple processes simultaneously**
+    **Running other processes**
 
-    Only one process at a time should be producing output. All processes that
-    *do* produce output should be managed by the singleton BPM instance.
+    All processes that produce output should be managed by the singleton BPM
+    instance.
 
     To run processes that *don't* produce output, just call subprocess.Popen.
     You can run as many of these process as you like, without involving the BPM
@@ -52,27 +69,50 @@ class BackgroundProcessManager(object):
 
     # Use self.put_log, not g.es or g.es_print!
 
+    default_max_processes = 4
+
     def __init__(self):
         '''Ctor for the base BackgroundProcessManager class.'''
         self.data = None
-            # a ProcessData instance.
+            # The ProcessData instance whose output is being written.
+        self.kind_limits = {}
+            # Keys are kinds, values are the maximum number of running
+            # processes of that kind.
+        self.max_processes = None
+            # The maximum number of running processes.
+            # None: use @int max-background-processes.
         self.process_queue = []
-            # List of g.Bunches.
-        self.pid = None
-            # The process id of the running process.
-        g.app.idleTimeManager.add_callback(self.on_idle)
+            # ProcessData instances, in the order in which they were queued,
+            # whose output has not been completely written.
+        if g.app.idleTimeManager:
+            g.app.idleTimeManager.add_callback(self.on_idle)
 
     #@+others
     #@+node:ekr.20161028090624.1: *3* class ProcessData
     class ProcessData(object):
         '''A class to hold data about running or queued processes.'''
 
-        def __init__(self, c, kind, fn, shell):
+        def __init__(self, c, kind, fn, shell, command=None, callback=None, quiet=False):
             '''Ctor for the ProcessData class.'''
             self.c = c
-            self.callback = None
+            self.callback = callback
+                # Called with self when the process has completed.
+            self.command = command
+            self.errors = []
+                # Lines written to stderr.
             self.fn = fn
             self.kind = kind
+            self.n_written = 0
+                # The number of lines of self.output written to the log.
+            self.output = []
+                # Lines written to stdout.
+            self.pid = None
+                # The subprocess.Popen instance, once the process has started.
+            self.quiet = quiet
+                # True: write nothing to the log.
+            self.readers = []
+                # Threads reading the process's stdout and stderr.
+            self.returncode = None
             self.shell = shell
 
         def __repr__(self):
@@ -85,70 +125,177 @@ class BackgroundProcessManager(object):
             )
 
         __str__ = __repr__
+
+        def is_done(self):
+            '''Return True if the process has exited and all its output has been read.'''
+            if not self.pid or self.pid.poll() is None:
+                return False
+            if any(z.is_alive() for z in self.readers):
+                return False
+            self.returncode = self.pid.returncode
+            return True
     #@+node:ekr.20161026193609.2: *3* bpm.check_process & helpers
     def check_process(self):
-        '''Check the running process, and switch if necessary.'''
+        '''Start queued processes and write the output of running processes.'''
         trace = False and not g.unitTesting
-        trace_inactive = True
-        trace_running = False
-        if self.pid:
-            if self.pid.poll() is None:
-                if trace and trace_running:
-                    self.put_log('running: %s' % id(self.pid))
-            else:
-                if trace:
-                    self.put_log('ending: %s' % id(self.pid))
-                self.end() # End this process.
-                self.start_next() # Start the next process.
-        elif self.process_queue:
-            self.start_next() # Start the next process.
-        elif trace and trace_inactive:
-            self.put_log('%s inactive' % (self.data and self.data.kind or 'all'))
+        self.start_next()
+        # Write output in the order in which the processes were queued.
+        while self.process_queue:
+            data = self.process_queue[0]
+            if not data.pid:
+                break
+            if self.data is not data:
+                self.data = data
+                if not data.quiet:
+                    self.put_log('%s: %s\n' % (data.kind, g.shortFileName(data.fn)))
+            done = data.is_done()
+            if not data.quiet:
+                self.write_output(data)
+            if not done:
+                break
+            if trace: self.put_log('ending: %s' % id(data.pid))
+            self.end(data)
     #@+node:ekr.20161028063557.1: *4* bpm.end
-    def end(self):
-        '''End the present process.'''
-        # Send the output to the log.
-        for s in self.pid.stdout:
-            self.put_log(s)
+    def end(self, data):
+        '''
+        End the process described by data, whose output has been written.
+        Write the process's stderr after its stdout.
+        '''
+        self.process_queue.remove(data)
         # Terminate the process properly.
         try:
-            self.pid.kill()
+            data.pid.kill()
         except OSError:
             pass
-        self.pid = None
+        if not data.quiet:
+            for s in data.errors:
+                self.put_log(s)
+        if data.callback:
+            try:
+                data.callback(data)
+            except Exception:
+                g.es_exception()
+        if not data.quiet and not any(
+            z.kind == data.kind and not z.quiet for z in self.process_queue
+        ):
+            self.put_log('%s finished' % data.kind)
+        self.data = None
     #@+node:ekr.20161028063800.1: *4* bpm.start_next
     def start_next(self):
-        '''The previous process has finished. Start the next one.'''
-        if self.process_queue:
-            self.data = self.process_queue.pop(0)
-            self.data.callback()
-        else:
-            self.put_log('%s finished' % self.data.kind)
-            self.data = None
-            self.pid = None
-    #@+node:ekr.20161026193609.3: *3* bpm.kill
+        '''Start as many queued processes as the limits allow.'''
+        running = [z for z in self.process_queue if z.pid and not z.is_done()]
+        n = len(running)
+        max_processes = self.get_max_processes()
+        for data in self.process_queue[:]:
+            if n >= max_processes:
+                break
+            if data.pid:
+                continue
+            limit = self.kind_limits.get(data.kind)
+            if limit and len([z for z in running if z.kind == data.kind]) >= limit:
+                continue
+            try:
+                self.start(data)
+            except (OSError, ValueError):
+                self.process_queue.remove(data)
+                g.es_print('can not start %s process: %s' % (data.kind, data.command))
+                continue
+            running.append(data)
+            n += 1
+    #@+node:ekr.20170822161407.1: *4* bpm.start & read_pipe
+    def start(self, data):
+        '''Start the process described by data, and its reader threads.'''
+        trace = False and not g.unitTesting
+        data.pid = subprocess.Popen(
+            data.command,
+            shell=data.shell,
+            stderr=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        for pipe, lines in ((data.pid.stdout, data.output), (data.pid.stderr, data.errors)):
+            thread = threading.Thread(target=self.read_pipe, args=(pipe, lines))
+            thread.daemon = True
+            thread.start()
+            data.readers.append(thread)
+        if trace: self.put_log('===== Starting: %s for %s' % (
+            id(data.pid), g.shortFileName(data.fn)))
+
+    def read_pipe(self, pipe, lines):
+        '''
+        Append all lines read from pipe to lines.
+        Runs in a reader thread: list.append is atomic.
+        '''
+        try:
+            for s in iter(pipe.readline, ''):
+                lines.append(s)
+        except (IOError, OSError, ValueError):
+            # The process has been killed.
+            pass
+        finally:
+            pipe.close()
+    #@+node:ekr.20170822161407.2: *4* bpm.write_output
+    def write_output(self, data):
+        '''Write the lines of data.output that have not yet been written.'''
+        self.data = data
+        n = len(data.output)
+        for s in data.output[data.n_written: n]:
+            self.put_log(s)
+        data.n_written = n
+    #@+node:ekr.20170822161407.3: *3* bpm.cancel
+    def cancel(self, data):
+        '''Kill or dequeue the process described by data, discarding its output.'''
+        if data in self.process_queue:
+            self.process_queue.remove(data)
+            self.kill_process(data)
+    #@+node:ekr.20161026193609.3: *3* bpm.kill & kill_process
     def kill(self, kind=None):
-        '''Kill the presently running process, if any.'''
+        '''Kill all running or queued processes of the given kind.'''
         if kind is None:
             kind = 'all'
-        if kind == 'all':
-            self.process_queue = []
-        else:
-            self.process_queue = [z for z in self.process_queue if z.kind != kind]
-        if self.pid and kind in ('all', self.data.kind):
+        killed = [z for z in self.process_queue if kind in ('all', z.kind)]
+        self.process_queue = [z for z in self.process_queue if z not in killed]
+        if any(z.pid for z in killed):
             self.put_log('killing %s process' % kind)
+        for data in killed:
+            self.kill_process(data)
+        self.put_log('%s finished' % kind)
+
+    def kill_process(self, data):
+        '''Kill the process described by data, if it has started.'''
+        if data.pid:
             try:
-                self.pid.kill()
+                data.pid.kill()
             except OSError:
                 pass
-            self.pid = None
-        self.put_log('%s finished' % kind)
+    #@+node:ekr.20170822161407.4: *3* bpm.get_max_processes & set_limit
+    def get_max_processes(self):
+        '''Return the maximum number of processes to run at once.'''
+        if self.max_processes is None:
+            n = g.app.config and g.app.config.getInt('max-background-processes')
+            self.max_processes = max(1, n or self.default_max_processes)
+        return self.max_processes
+
+    def set_limit(self, kind, n):
+        '''
+        Run at most n processes of the given kind at once.
+        n = None removes the limit.
+        '''
+        if n is None:
+            self.kind_limits.pop(kind, None)
+        else:
+            self.kind_limits[kind] = max(1, n)
     #@+node:ekr.20161026193609.4: *3* bpm.on_idle
     def on_idle(self):
-        '''The idle-time callback for leo.commands.checkerCommands.'''
-        # g.trace('(BPM)', 'pid:', self.pid, 'queue:', len(self.process_queue))
-        if self.process_queue or self.pid:
-            self.check_process()
+        '''
+        The idle-time callback for leo.commands.checkerCommands.
+        Return False if there is nothing to do.
+        '''
+        # g.trace('(BPM)', 'queue:', len(self.process_queue))
+        if not self.process_queue:
+            return False
+        self.check_process()
+        return True
     #@+node:ekr.20161028095553.1: *3* bpm.put_log
     def put_log(self, s):
         '''
@@ -165,41 +312,22 @@ class BackgroundProcessManager(object):
             else:
                 g.es_print(s)
     #@+node:ekr.20161026193609.5: *3* bpm.start_process
-    def start_process(self, c, command, kind, fn=None, shell=False):
-        '''Start or queue a process described by command and fn.'''
+    def start_process(self, c, command, kind, fn=None, shell=False, callback=None, quiet=False):
+        '''
+        Queue a process described by command and fn. The process starts at
+        the next idle time if the limits allow.
+
+        Return a ProcessData instance, for use with bpm.cancel.
+        '''
         trace = False and not g.unitTesting
-        self.data = data = self.ProcessData(c, kind, fn, shell)
-        if self.pid:
-            # A process is already active.  Add a new callback.
-            if trace: self.put_log('===== Adding callback for %s' % g.shortFileName(fn))
-
-            def callback(data=data):
-                fn = data.fn
-                self.put_log('%s: %s\n' % (kind, g.shortFileName(fn)))
-                self.pid = subprocess.Popen(
-                    command,
-                    shell=shell,
-                    stderr=subprocess.PIPE,
-                    stdout=subprocess.PIPE,
-                    universal_newlines=True,
-                )
-                if trace: self.put_log('===== Starting: %s for %s' % (
-                    id(self.pid), g.shortFileName(fn)))
-
-            data.callback = callback
-            self.process_queue.append(data)
-        else:
-            # Start the process immediately.
-            self.put_log('%s: %s\n' % (kind, g.shortFileName(fn)))
-            self.pid = subprocess.Popen(
-                command,
-                shell=shell,
-                stderr=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                universal_newlines=True,
-            )
-            if trace: self.put_log('===== Starting: %s for %s' % (
-                id(self.pid), g.shortFileName(fn)))
+        data = self.ProcessData(c, kind, fn, shell,
+            command=command, callback=callback, quiet=quiet)
+        if trace: self.put_log('===== Queuing %s' % g.shortFileName(fn))
+        self.process_queue.append(data)
+        self.start_next()
+        if g.app.idleTimeManager:
+            g.app.idleTimeManager.wake(self.on_idle)
+        return data
     #@-others
 #@-others
 #@@language python
@@ -11,11 +11,15 @@ if isPython3:
     import pickle
 else:
     import cPickle as pickle
+import array
+import collections
 import glob
 import fnmatch
 import hashlib
+import mmap
 import os
 import stat
+import struct
 # import time
 import zlib
 import sqlite3
@@ -52,6 +56,11 @@ class Cacher(object):
         self.globals_tag = 'leo.globals'
             # 'leo3k.globals' if g.isPython3 else 'leo2k.globals'
         self.inited = False
+        self.outlineCache = OutlineCache()
+            # The cache of the outlines of external files.
+        self.pendingOutlines = {}
+            # Keys are paths, values are lists created by makeCacheList.
+            # Outlines to be cached when their files are known to be unchanged.
     #@+node:ekr.20100208082353.5918: *4* cacher.initFileDB
     def initFileDB(self, fn):
         trace = False and not g.unitTesting
@@ -68,6 +77,8 @@ class Cacher(object):
             self.dbdirname = dbdirname = join(g.app.homeLeoDir, 'db',
                 '%s_%s' % (bname, hashlib.md5(fn).hexdigest()))
             self.db = SqlitePickleShare(dbdirname) if SQLITE else PickleShareDB(dbdirname)
+            self.outlineCache = OutlineCache(
+                None if g.unitTesting else join(dbdirname, 'outlines'))
             # Fixes bug 670108.
             self.c.db = self.db
             self.inited = True
@@ -79,7 +90,10 @@ class Cacher(object):
         # We always create the global db, even if caching is disabled.
         try:
             dbdirname = g.app.homeLeoDir + "/db/global"
-            db = SqlitePickleShare(dbdirname) if SQLITE else PickleShareDB(dbdirname)
+            # All running Leo processes share the global db, so do not
+            # hold its write lock until cacher.commit or cache its values.
+            db = (SqlitePickleShare(dbdirname, batch=False, cache=False) if SQLITE
+                else PickleShareDB(dbdirname))
             self.db = db
             if trace: g.trace(db, dbdirname)
             self.inited = True
@@ -95,6 +109,8 @@ class Cacher(object):
     #@+node:ekr.20100209160132.5759: *3* cacher.clearCache & clearAllCaches
     def clearCache(self):
         '''Clear the cache for the open window.'''
+        self.pendingOutlines = {}
+        self.outlineCache.clear()
         if self.db:
             # Be careful about calling db.clear.
             try:
@@ -131,7 +147,9 @@ class Cacher(object):
                 g.internalError('content arg must be str/bytes')
             content = g.toEncodedString(content)
         # New in Leo 5.6: Use the git branch name in the key.
-        branch = g.gitBranchName()
+        # Use the repository containing fileName, not leo-editor's.
+        directory = g.os_path_dirname(g.toUnicode(fileName))
+        branch = g.gitBranchName(directory or None)
         # g.trace(type(branch), repr(branch))
         branch = g.toEncodedString(branch)
             # Fix #475.
@@ -163,6 +181,7 @@ class Cacher(object):
             # Does this destroy the ability to handle the rare case?
             v._headString = g.toUnicode(h)
             v._bodyString = g.toUnicode(b)
+            v.textChanged()
         for child_tuple in children:
             h, b, gnx, grandChildren = child_tuple
             if trace:
@@ -362,7 +381,12 @@ class Cacher(object):
             if trace: g.trace('g.enableDB is False', fileName)
             return '', False, None
         if trace: g.trace('=====', root.v.gnx, 'children', root.numberOfChildren(), fileName)
-        s = g.readFileIntoEncodedString(fileName, silent=True)
+        at = self.c and getattr(self.c, 'atFileCommands', None)
+        s = at and at.getPrefetchedFile(fileName)
+        if s is None:
+            s = g.readFileIntoEncodedString(fileName, silent=True)
+        if s is not None and at:
+            at.recordFileDigest(fileName, s)
         if s is None:
             if trace: g.trace('empty file contents', fileName)
             return s, False, None
@@ -370,22 +394,21 @@ class Cacher(object):
         if trace and showLines:
             for i, line in enumerate(g.splitLines(s)):
                 print('%3d %s' % (i, repr(line)))
-        # There will be a bug if s is not already an encoded string.
-        key = self.fileKey(fileName, s, requireEncodedString=True)
-            # Fix bug #385: use the full fileName, not root.h.
-        ok = self.db and key in self.db
+        # Leo 5.6: The path, mtime and size of the file validate the cache.
+        key = fileName
+        aList = self.outlineCache.get(fileName)
+        ok = aList is not None
         if ok:
-            if trace and showHits: g.trace('cache hit', key[-6:], sfn)
+            if trace and showHits: g.trace('cache hit', sfn)
             # Delete the previous tree, regardless of the @<file> type.
             while root.hasChildren():
                 root.firstChild().doDelete()
             # Recreate the file from the cache.
-            aList = self.db.get(key)
             if trace and showList:
                 g.printList(list(g.flatten_list(aList)))
             self.createOutlineFromCacheList(root.v, aList, fileName=fileName)
         elif trace:
-            g.trace('cache miss', key[-6:], sfn)
+            g.trace('cache miss', sfn)
         return s, ok, key
     #@+node:ekr.20100208082353.5927: *3* cacher.Writing
     #@+node:ekr.20100208071151.5901: *4* cacher.makeCacheList
@@ -424,9 +447,15 @@ class Cacher(object):
         key = self.fileKey(c.mFileName, self.globals_tag)
         self.db['current_position_%s' % key] = str_pos
         if trace: g.trace(c.shortFileName(), str_pos)
-    #@+node:ekr.20100208071151.5903: *4* cacher.writeFile
+    #@+node:ekr.20100208071151.5903: *4* cacher.writeFile & flushOutlineCache
     def writeFile(self, p, fileKey):
-        '''Update the cache after reading the file.'''
+        '''
+        Update the cache after reading or writing the file.
+        fileKey is the file's full path.
+
+        The outline is cached when cacher.flushOutlineCache knows that the
+        file on disk is the file that Leo read or wrote.
+        '''
         trace = (False or g.app.debug) and not g.unitTesting
         # Check g.enableDB before giving internal error.
         if not g.enableDB:
@@ -434,11 +463,33 @@ class Cacher(object):
         elif not fileKey:
             g.trace(g.callers(5))
             g.internalError('empty fileKey')
-        elif self.db.get(fileKey):
-            if trace: g.trace('already cached', fileKey)
         else:
             if trace: g.trace('caching ', p.h, fileKey)
-            self.db[fileKey] = self.makeCacheList(p)
+            self.pendingOutlines[fileKey] = self.makeCacheList(p)
+
+    def flushOutlineCache(self):
+        '''
+        Write all pending outlines to the outline cache. Outlines are cached
+        only if the mtime and size of their file match the values recorded
+        by at.recordFileDigest, that is, only if the file has not changed
+        since Leo read or wrote it.
+        '''
+        c = self.c
+        pending, self.pendingOutlines = self.pendingOutlines, {}
+        at = c and getattr(c, 'atFileCommands', None)
+        if not at or not g.enableDB:
+            return
+        for fn, aList in pending.items():
+            data = at.fileDigests.get(at.pathKey(fn))
+            if not data:
+                continue
+            try:
+                st = os.stat(fn)
+            except OSError:
+                continue
+            mtime, size = data[:2]
+            if (st.st_mtime, st.st_size) == (mtime, size):
+                self.outlineCache.put(fn, aList, mtime, size)
     #@+node:ekr.20100208065621.5890: *3* cacher.test
     def test(self):
         
@@ -468,13 +519,223 @@ class Cacher(object):
         g.es_print('Warning: %s' % s.lstrip(), color='red')
     #@-others
     def commit(self, close=True):
+        self.flushOutlineCache()
         # in some cases while unit testing self.db is python dict
         if SQLITE and hasattr(self.db, 'conn'):
             # pylint: disable=no-member
-            self.db.conn.commit()
+            self.db.commit()
             if close:
-                self.db.conn.close()
+                self.db.close()
                 self.inited = False
+#@+node:ekr.20170821083012.1: ** class OutlineCache
+class OutlineCache(object):
+    '''
+    A cache of the outlines of external files, one cache file per external
+    file, in a compact, versioned binary format.
+
+    Entries are valid only if the external file's path, modification time
+    and size match the values in the entry's header, so checking for a hit
+    requires neither reading nor hashing the external file. Cache files are
+    read with mmap.
+
+    All numbers are little-endian. A cache file contains:
+
+    - The header: magic (8 bytes), version (uint32), mtime (double),
+      size (uint64), number of nodes (uint32), number of strings (uint32).
+    - The nodes in outline order, 4 uint32's per node: the string indices
+      of the gnx, headline and body, and the number of children. The first
+      node is the @<file> node itself.
+    - The string table: (number of strings + 1) uint32 offsets, followed by
+      all strings, encoded as utf-8. String 0 is the external file's path.
+    '''
+    magic = b'LEOOUTLN'
+    version = 1
+    header = struct.Struct('<8sIdQII')
+    typecode = 'I' if array.array('I').itemsize == 4 else 'L'
+
+    #@+others
+    #@+node:ekr.20170821083012.2: *3* oc.ctor
+    def __init__(self, dirname=None):
+        '''
+        Ctor for the OutlineCache class.
+        dirname: The directory containing the cache files.
+                 None: keep all entries in memory.
+        '''
+        self.dirname = dirname
+        self.memory = {}
+            # Keys are normalized paths, values are cache file contents.
+        # Statistics.
+        self.hits = 0
+        self.misses = 0
+    #@+node:ekr.20170821083012.3: *3* oc.get & put
+    def get(self, fn):
+        '''
+        Return the cached outline of file fn, as a list in the format
+        returned by cacher.makeCacheList, or None if there is no valid entry.
+        '''
+        key = self.pathKey(fn)
+        try:
+            st = os.stat(fn)
+        except OSError:
+            return None
+        aList = None
+        if self.dirname is None:
+            buf = self.memory.get(key)
+            if buf:
+                aList = self.decode(buf, key, st)
+        else:
+            cacheFile = self.cacheFileName(key)
+            try:
+                with open(cacheFile, 'rb') as f:
+                    buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    try:
+                        aList = self.decode(buf, key, st)
+                    finally:
+                        buf.close()
+            except (IOError, OSError, ValueError):
+                # No cache file, or an empty cache file.
+                pass
+        if aList is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return aList
+
+    def put(self, fn, aList, mtime, size):
+        '''
+        Cache aList, the outline of file fn, as returned by
+        cacher.makeCacheList. mtime and size describe the contents of fn
+        from which aList was computed.
+        '''
+        key = self.pathKey(fn)
+        buf = self.encode(key, aList, mtime, size)
+        if self.dirname is None:
+            self.memory[key] = buf
+            return
+        cacheFile = self.cacheFileName(key)
+        tempFile = cacheFile + '.tmp'
+        try:
+            if not isdir(self.dirname):
+                os.makedirs(self.dirname)
+            with open(tempFile, 'wb') as f:
+                f.write(buf)
+            if isfile(cacheFile):
+                os.remove(cacheFile)
+            os.rename(tempFile, cacheFile)
+        except (IOError, OSError):
+            g.es_exception()
+    #@+node:ekr.20170821083012.4: *3* oc.clear
+    def clear(self):
+        '''Delete all entries.'''
+        self.memory = {}
+        if self.dirname and isdir(self.dirname):
+            for fn in glob.glob(join(self.dirname, '*.outline')):
+                try:
+                    os.remove(fn)
+                except OSError:
+                    pass
+    #@+node:ekr.20170821083012.5: *3* oc.encode & decode
+    def encode(self, key, aList, mtime, size):
+        '''Return the cache file contents for aList.'''
+        strings, index = [], {}
+
+        def intern(s):
+            n = index.get(s)
+            if n is None:
+                n = index[s] = len(strings)
+                strings.append(s)
+            return n
+
+        intern(key)
+        nodes = array.array(self.typecode)
+        stack = [aList]
+        while stack:
+            h, b, gnx, children = stack.pop()
+            nodes.extend([intern(gnx), intern(h), intern(b), len(children)])
+            stack.extend(reversed(children))
+        blobs = [g.toEncodedString(s, 'utf-8') for s in strings]
+        offsets = array.array(self.typecode, [0])
+        n = 0
+        for blob in blobs:
+            n += len(blob)
+            offsets.append(n)
+        header = self.header.pack(self.magic, self.version,
+            mtime, size, len(nodes) // 4, len(strings))
+        return b''.join([header, self.toBytes(nodes), self.toBytes(offsets)] + blobs)
+
+    def decode(self, buf, key, st):
+        '''
+        Return the outline in buf, a list in the format returned by
+        cacher.makeCacheList, or None if buf is not a valid entry for the
+        file whose normalized path is key and whose os.stat result is st.
+        '''
+        hsize = self.header.size
+        if len(buf) < hsize:
+            return None
+        magic, version, mtime, size, nNodes, nStrings = self.header.unpack_from(buf, 0)
+        if (magic != self.magic or version != self.version or
+            mtime != st.st_mtime or size != st.st_size
+        ):
+            return None
+        i = hsize
+        j = i + 16 * nNodes
+        nodes = self.fromBytes(buf[i: j])
+        i, j = j, j + 4 * (nStrings + 1)
+        offsets = self.fromBytes(buf[i: j])
+        base = j
+        if len(offsets) != nStrings + 1 or len(buf) != base + offsets[-1]:
+            return None
+        strings = [
+            g.toUnicode(buf[base + offsets[n]: base + offsets[n + 1]], 'utf-8')
+                for n in range(nStrings)]
+        if strings[0] != key:
+            return None
+        # Rebuild the nested lists from the nodes in outline order.
+        root = None
+        stack = [] # Entries are [aList, number of children still to add].
+        for n in range(0, len(nodes), 4):
+            gnx, h, b, nChildren = nodes[n: n + 4]
+            aList = [strings[h], strings[b], strings[gnx], []]
+            if stack:
+                parent = stack[-1]
+                parent[0][3].append(aList)
+                parent[1] -= 1
+                if parent[1] == 0:
+                    stack.pop()
+            else:
+                root = aList
+            if nChildren:
+                stack.append([aList, nChildren])
+            while stack and stack[-1][1] == 0:
+                stack.pop()
+        return root
+    #@+node:ekr.20170821083012.6: *3* oc.utils
+    def cacheFileName(self, key):
+        '''Return the name of the cache file for the normalized path key.'''
+        digest = hashlib.md5(g.toEncodedString(key, 'utf-8')).hexdigest()
+        return join(self.dirname, '%s.outline' % digest)
+
+    def pathKey(self, fn):
+        return normcase(abspath(fn))
+
+    def fromBytes(self, s):
+        '''Return an array of uint32's from little-endian bytes s.'''
+        a = array.array(self.typecode)
+        if isPython3:
+            a.frombytes(s)
+        else:
+            a.fromstring(s)
+        if sys.byteorder == 'big':
+            a.byteswap()
+        return a
+
+    def toBytes(self, a):
+        '''Return array a of uint32's as little-endian bytes.'''
+        if sys.byteorder == 'big':
+            a = array.array(self.typecode, a)
+            a.byteswap()
+        return a.tobytes() if isPython3 else a.tostring()
+    #@-others
 #@+node:ekr.20100208223942.5967: ** class PickleShareDB
 _sentinel = object()
 
@@ -774,17 +1035,31 @@ class PickleShareDB(object):
 _sentinel = object()
 
 class SqlitePickleShare(object):
-    """ The main 'connection' object for SqlitePickleShare database """
+    """
+    The main 'connection' object for SqlitePickleShare database.
+
+    When batch is True, writes accumulate in a single transaction until
+    db.commit (called by cacher.commit) or until maxPending writes are
+    pending. Otherwise every write commits at once.
+
+    When cache is True, self.cache holds the maxCacheSize most recently
+    read or written values. Immutable values are cached as objects. Other values are cached as
+    uncompressed pickles, so each read still returns a private copy.
+    Databases shared by several processes must not cache values: the
+    cache would hide writes made by other processes.
+    """
     #@+others
     #@+node:vitalije.20170716201700.2: *3*  Birth & special methods
     def init_dbtables(self, conn):
         sql = 'create table if not exists cachevalues(key text primary key, data blob);'
         conn.execute(sql)
     #@+node:vitalije.20170716201700.3: *4*  __init__ (SqlitePickleShare)
-    def __init__(self, root):
+    def __init__(self, root, batch=True, cache=True, maxCacheSize=1000, maxPending=500):
         """
         Init the SqlitePickleShare class.
         root: The directory that contains the data. Created if it doesn't exist.
+        batch: True: commit writes only in db.commit.
+        cache: True: cache values in self.cache.
         """
         trace = False and not g.unitTesting
         self.root = abspath(expanduser(root))
@@ -793,33 +1068,55 @@ class SqlitePickleShare(object):
             self._makedirs(self.root)
         dbfile = ':memory:' if g.unitTesting else join(root, 'cache.sqlite')
         self.conn = sqlite3.connect(dbfile, isolation_level=None)
+            # Transactions are explicit: see db.begin and db.commit.
+        if dbfile != ':memory:':
+            try:
+                # Readers never block writers and commits need fewer fsyncs.
+                self.conn.execute('pragma journal_mode=wal;')
+                self.conn.execute('pragma synchronous=normal;')
+            except sqlite3.Error:
+                pass
         self.init_dbtables(self.conn)
-        self.cache = {}
-            # Keys are normalized file names.
-            # Values are tuples (obj, orig_mod_time)
+        self.batch = batch
+        self.cache = collections.OrderedDict()
+            # Keys are db keys, in least recently used order.
+            # Values are tuples (kind, value): see db.cacheValue.
+        self.useCache = cache
+        self.maxCacheSize = maxCacheSize
+        self.maxPending = maxPending
+        self.pending = None
+            # The number of uncommitted writes, or None if no transaction is open.
 
         def loadz(data):
             if data:
-                try:
-                    val = pickle.loads(zlib.decompress(data))
-                except ValueError:
-                    g.es("Unpickling error - Python 3 data accessed from Python 2?")
-                    return None
-                return val
+                return loads(zlib.decompress(data))
             else:
                 return None
 
-        def dumpz(val):
+        def loads(data):
+            try:
+                val = pickle.loads(data)
+            except ValueError:
+                g.es("Unpickling error - Python 3 data accessed from Python 2?")
+                return None
+            return val
+
+        def dumps(val):
             try:
                 # use Python 2's highest protocol, 2, if possible
                 data = pickle.dumps(val, 2)
             except Exception:
                 # but use best available if that doesn't work (unlikely)
                 data = pickle.dumps(val, pickle.HIGHEST_PROTOCOL)
-            return sqlite3.Binary(zlib.compress(data))
+            return data
+
+        def dumpz(val):
+            return sqlite3.Binary(zlib.compress(dumps(val)))
 
         self.loader = loadz
         self.dumper = dumpz
+        self.loads = loads
+        self.dumps = dumps
     #@+node:vitalije.20170716201700.4: *4* __contains__(SqlitePickleShare)
     def __contains__(self, key):
         trace = False and g.unitTesting
@@ -828,26 +1125,44 @@ class SqlitePickleShare(object):
     #@+node:vitalije.20170716201700.5: *4* __delitem__
     def __delitem__(self, key):
         """ del db["key"] """
+        self.cache.pop(key, None)
         try:
+            self.begin()
             self.conn.execute('''delete from cachevalues
                 where key=?''', (key,))
+            self.endWrite()
         except sqlite3.OperationalError:
             pass
 
     #@+node:vitalije.20170716201700.6: *4* __getitem__
     def __getitem__(self, key):
         """ db['key'] reading """
-        try:
-            obj = None
-            for row in self.conn.execute('''select data from cachevalues
-                where key=?''', (key,)):
-                obj = self.loader(row[0])
-                break
-            else:
+        entry = self.cache.get(key)
+        if entry is not None:
+            # Make key the most recently used key.
+            self.cache[key] = self.cache.pop(key)
+        else:
+            try:
+                for row in self.conn.execute('''select data from cachevalues
+                    where key=?''', (key,)):
+                    data = row[0]
+                    if data:
+                        data = zlib.decompress(data)
+                        obj = self.loads(data)
+                        entry = self.cacheValue(key, obj, data)
+                    else:
+                        entry = self.cacheValue(key, None)
+                    break
+                else:
+                    entry = self.cacheValue(key, _sentinel)
+            except sqlite3.Error:
                 raise KeyError(key)
-        except sqlite3.Error:
+        kind, val = entry
+        if kind == 'pickle':
+            return self.loads(val)
+        if val is _sentinel:
             raise KeyError(key)
-        return obj
+        return val
     #@+node:vitalije.20170716201700.7: *4* __iter__
     def __iter__(self):
         trace = False and g.unitTesting
@@ -861,13 +1176,74 @@ class SqlitePickleShare(object):
     def __setitem__(self, key, value):
         """ db['key'] = 5 """
         #trace = False and not g.unitTesting
+        self.cache.pop(key, None)
         try:
-            data = self.dumper(value)
+            data = self.dumps(value)
+            self.begin()
             self.conn.execute('''replace into cachevalues(key, data)
-                values(?,?);''', (key, data))
+                values(?,?);''', (key, sqlite3.Binary(zlib.compress(data))))
+            self.endWrite()
+            self.cacheValue(key, value, data)
         except sqlite3.OperationalError as e:
             g.es_exception(e)
 
+    #@+node:ekr.20170821102934.1: *3* begin, endWrite, commit & close
+    def begin(self):
+        '''Start a transaction if none is open and batching is enabled.'''
+        if self.batch and self.pending is None:
+            self.conn.execute('begin;')
+            self.pending = 0
+
+    def endWrite(self):
+        '''Count a write, committing if too many writes are pending.'''
+        if self.pending is not None:
+            self.pending += 1
+            if self.pending >= self.maxPending:
+                self.commit()
+
+    def commit(self):
+        '''Commit all pending writes in a single transaction.'''
+        if self.pending is not None:
+            self.pending = None
+            self.conn.execute('commit;')
+
+    def close(self):
+        '''Commit all pending writes and close the connection.'''
+        self.commit()
+        self.conn.close()
+        self.cache.clear()
+    #@+node:ekr.20170821102934.2: *3* cacheValue & isImmutable
+    def cacheValue(self, key, obj, data=None):
+        '''
+        Add key's value to self.cache and return the new entry.
+        Return the entry without caching it if self.useCache is False.
+
+        data is the pickle of obj. Mutable values are cached as pickles: each
+        read must return a copy that callers may change.
+        '''
+        if obj is _sentinel or self.isImmutable(obj):
+            entry = 'object', obj
+        else:
+            entry = 'pickle', data
+        if self.useCache:
+            cache = self.cache
+            cache.pop(key, None)
+            cache[key] = entry
+            if len(cache) > self.maxCacheSize:
+                # Discard the least recently used value.
+                cache.popitem(last=False)
+        return entry
+
+    immutableTypes = (type(None), bool, int, float, complex, str, bytes,
+        g.u('').__class__, frozenset)
+    if not isPython3:
+        immutableTypes += (long,) # NOQA
+
+    def isImmutable(self, obj):
+        '''Return True if obj can safely be shared between readers.'''
+        if isinstance(obj, tuple):
+            return all(self.isImmutable(z) for z in obj)
+        return isinstance(obj, self.immutableTypes)
     #@+node:vitalije.20170716201700.10: *3* _makedirs
     def _makedirs(self, fn, mode=0o777):
         trace = False and not g.unitTesting
@@ -925,7 +1301,10 @@ class SqlitePickleShare(object):
         if verbose:
             g.red('clearing cache at directory...\n')
             g.es_print(self.root)
+        self.cache.clear()
+        self.begin()
         self.conn.execute('delete from cachevalues;')
+        self.endWrite()
     #@+node:vitalije.20170716201700.16: *3* get
     def get(self, key, default=None):
         trace = False and not g.unitTesting
@@ -938,6 +1317,9 @@ class SqlitePickleShare(object):
             return default
     #@+node:vitalije.20170716201700.17: *3* has_key (PickleShareDB)
     def has_key(self, key):
+        entry = self.cache.get(key)
+        if entry is not None:
+            return entry[1] is not _sentinel
         sql = 'select 1 from cachevalues where key=?;'
         for row in self.conn.execute(sql, (key,)):
             return True
@@ -11,6 +11,9 @@ from leo.core.leoQt import Qsci, QtGui, QtWidgets # isQt5, QtCore
     # import builtins # Python 3
 # except ImportError:
     # import __builtin__ as builtins # Python 2.
+import collections
+import os
+import pickle
 import re
 import string
 # import time
@@ -144,6 +147,221 @@ class BaseColorizer(object):
     def setFontFromConfig(self):
         pass
     #@-others
+#@+node:ekr.20170822120517.1: ** class ColorStateCache
+class ColorStateCache(object):
+    '''
+    A cache of the colorizer state of recently colored vnodes, used by
+    JEditColorizer.recolor.
+
+    State numbers are meaningful only within the state tables that created
+    them, so each entry contains the state tables of one vnode. An entry is
+    valid only for the language in effect when it was created.
+
+    Entries also map (state, line) pairs to the results of coloring the
+    line: the state of the next line and the formats applied to the line.
+    Revisiting an unchanged node reapplies all formats without calling
+    jedit.mainLoop. After an edit, only changed lines and lines whose
+    incoming state changed are colored again.
+
+    Lines totaling at most maxSize characters are cached. The least recently
+    used vnodes are discarded first.
+    '''
+    #@+others
+    #@+node:ekr.20170822120517.2: *3* ccache.ctor & clear
+    def __init__(self, maxSize):
+        '''Ctor for the ColorStateCache class.'''
+        self.entries = collections.OrderedDict()
+            # Keys are vnodes, least recently used first. Values are g.Bunches.
+        self.maxSize = maxSize
+        self.size = 0
+            # The number of characters in all cached lines and formats.
+        # Statistics.
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        '''Delete all entries.'''
+        for entry in self.entries.values():
+            entry.lines.clear()
+        self.entries.clear()
+        self.size = 0
+    #@+node:ekr.20170822120517.3: *3* ccache.getEntry & newEntry
+    def getEntry(self, v, language):
+        '''Return the entry for v if it exists and is valid for language.'''
+        entry = self.entries.pop(v, None)
+        if entry is None:
+            return None
+        if entry.language != language:
+            self.size -= entry.size
+            return None
+        self.entries[v] = entry
+        return entry
+
+    def newEntry(self, v, language, **tables):
+        '''
+        Create an empty entry for v, replacing any previous entry.
+        tables contains the colorizer's state tables.
+        '''
+        old = self.entries.pop(v, None)
+        if old is not None:
+            self.size -= old.size
+        entry = g.Bunch(language=language, lines={}, size=0, v=v, **tables)
+        self.entries[v] = entry
+        return entry
+    #@+node:ekr.20170822120517.4: *3* ccache.putLine
+    def putLine(self, entry, key, data):
+        '''
+        Cache data, the results of coloring the line described by key,
+        a (state, line) pair.
+        '''
+        entry.lines[key] = data
+        n = len(key[1]) + len(data[1])
+        entry.size += n
+        self.size += n
+        if entry.size > 2 * len(entry.v.b) + 1024:
+            # Most lines are out of date: start again.
+            self.size -= entry.size
+            entry.lines.clear()
+            entry.size = 0
+        entries = self.entries
+        while self.size > self.maxSize and entries:
+            v, entry2 = entries.popitem(last=False)
+            self.size -= entry2.size
+            if entry2 is entry:
+                # The present node is larger than the cache.
+                entry.lines.clear()
+                entry.size = 0
+                entries[v] = entry
+    #@-others
+#@+node:ekr.20170822131904.1: ** class ModeRegistry
+class ModeRegistry(object):
+    '''
+    A process-wide registry of the jEdit language modes in leo/modes, shared
+    by all JEditColorizers.
+
+    - Each mode module is imported only once.
+    - Each ruleset is built only once for each value of the
+      color_trailing_whitespace setting. All colorizers share the result.
+    - Optionally, rulesets are saved in directory dirname as pickled data,
+      so they can be rebuilt later without importing any module. Saved data
+      is valid only if the mode modules from which it came are unchanged.
+    '''
+    version = 1
+
+    #@+others
+    #@+node:ekr.20170822131904.2: *3* modes.ctor & clear
+    def __init__(self, dirname=None):
+        '''
+        Ctor for the ModeRegistry class.
+        dirname: The directory containing saved rulesets.
+                 None: use ~/.leo/db/modes, but never when unit testing.
+        '''
+        self.dirname = dirname
+        self.modules = {}
+            # Keys are language names, values are modules or None.
+        self.rulesets = {}
+            # Keys are (rulesetName, color_trailing_whitespace), values are mode bunches.
+        # Statistics.
+        self.loads = 0
+        self.saves = 0
+
+    def clear(self):
+        '''Forget all modules and rulesets, but not the saved rulesets.'''
+        self.modules = {}
+        self.rulesets = {}
+    #@+node:ekr.20170822131904.3: *3* modes.getModule
+    def getModule(self, language):
+        '''
+        Return the module leo/modes/<language>.py, or None.
+
+        Modules having a pre_init_mode function change themselves for each
+        commander, so they are imported every time.
+        '''
+        if language in self.modules:
+            mode = self.modules[language]
+            if not hasattr(mode, 'pre_init_mode'):
+                return mode
+        # Bug fix: 2008/2/10: Don't try to import a non-existent language.
+        path = g.os_path_join(g.app.loadDir, '..', 'modes')
+        fn = g.os_path_join(path, '%s.py' % (language))
+        if g.os_path_exists(fn):
+            mode = g.importFromPath(moduleName=language, path=path)
+        else:
+            mode = None
+        self.modules[language] = mode
+        return mode
+    #@+node:ekr.20170822131904.4: *3* modes.getRuleset & putRuleset
+    def getRuleset(self, rulesetName, trailing_ws):
+        '''Return the shared mode bunch for the given ruleset, or None.'''
+        return self.rulesets.get((rulesetName, bool(trailing_ws)))
+
+    def putRuleset(self, rulesetName, trailing_ws, bunch):
+        '''Share bunch, the completely built mode bunch for the given ruleset.'''
+        self.rulesets[(rulesetName, bool(trailing_ws))] = bunch
+    #@+node:ekr.20170822131904.5: *3* modes.load & save
+    def load(self, rulesetName):
+        '''
+        Return the dict saved for the given ruleset, or None if there is no
+        valid saved data.
+        '''
+        fn = self.fileName(rulesetName)
+        if not fn or not g.os_path_isfile(fn):
+            return None
+        try:
+            with open(fn, 'rb') as f:
+                d = pickle.load(f)
+        except Exception:
+            return None
+        if not isinstance(d, dict) or d.get('version') != self.version:
+            return None
+        for path, mtime, size in d.get('sources', []):
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+            if st.st_mtime != mtime or st.st_size != size:
+                return None
+        self.loads += 1
+        return d
+
+    def save(self, rulesetName, d, sources):
+        '''
+        Save d, a dict describing the given ruleset. sources is a list of
+        the paths of all mode modules from which d came.
+        '''
+        fn = self.fileName(rulesetName)
+        if not fn:
+            return
+        try:
+            d = dict(d, version=self.version, sources=[
+                (path, os.stat(path).st_mtime, os.stat(path).st_size)
+                    for path in sources])
+            dirname = g.os_path_dirname(fn)
+            if not g.os_path_isdir(dirname):
+                os.makedirs(dirname)
+            tempFile = fn + '.tmp'
+            with open(tempFile, 'wb') as f:
+                pickle.dump(d, f, 2)
+            if g.os_path_isfile(fn):
+                os.remove(fn)
+            os.rename(tempFile, fn)
+            self.saves += 1
+        except Exception:
+            # Saving is only an optimization.
+            pass
+    #@+node:ekr.20170822131904.6: *3* modes.fileName
+    def fileName(self, rulesetName):
+        '''Return the name of the file containing the saved ruleset, or None.'''
+        dirname = self.dirname
+        if not dirname:
+            if g.unitTesting or not g.app.homeLeoDir:
+                return None
+            dirname = g.os_path_join(g.app.homeLeoDir, 'db', 'modes')
+        return g.os_path_join(dirname, '%s.pickle' % rulesetName)
+    #@-others
+
+modeRegistry = ModeRegistry()
+    # The singleton ModeRegistry instance.
 #@+node:ekr.20110605121601.18569: ** class JEditColorizer(BaseColorizer)
 # This is c.frame.body.colorizer
 class JEditColorizer(BaseColorizer):
@@ -182,6 +400,8 @@ class JEditColorizer(BaseColorizer):
         # State data used by recolor and helpers...
         # init() properly sets these for each language.
         self.actualColorDict = {} # Used only by setTag.
+        self.formatDict = {} # Used only by setTag.
+            # Keys are (tag, dots, colorName, underline), values are (font, format).
         self.hyperCount = 0
         # State dicts, etc.
         self.after_doc_language = None
@@ -192,6 +412,13 @@ class JEditColorizer(BaseColorizer):
         self.restartDict = {} # Keys are state numbers, values are restart functions.
         self.stateDict = {} # Keys are state numbers, values state names.
         self.stateNameDict = {} # Keys are state names, values are state numbers.
+        # The color cache...
+        self.cacheable = True
+            # False if the colors of the present line depend on more than its text and state.
+        self.colorCacheEntry = None
+            # The entry in self.colorCache for self.old_v.
+        self.recordedFormats = None
+            # A list of (i, length, format) tuples made by setTag, or None.
         # Attributes dict ivars: defaults are as shown...
         self.default = 'null'
         self.digit_re = ''
@@ -203,6 +430,10 @@ class JEditColorizer(BaseColorizer):
         self.showInvisibles = c.config.getBool("show_invisibles_by_default")
         self.underline_undefined = c.config.getBool("underline_undefined_section_names")
         self.use_hyperlinks = c.config.getBool("use_hyperlinks")
+        size = c.config.getInt('colorizer-cache-size')
+        if size is None:
+            size = 4000000
+        self.colorCache = ColorStateCache(size) if size > 0 else None
         # Debugging...
         self.allow_mark_prev = True
         self.n_setTag = 0
@@ -230,8 +461,12 @@ class JEditColorizer(BaseColorizer):
         self.modeBunch = None # A bunch fully describing a mode.
         self.modeStack = []
         self.rulesDict = {}
+        self.compiledRules = self.compileRules(self.rulesDict)
+            # The compiled form of self.rulesDict, used by mainLoop.
         # self.defineAndExtendForthWords()
         self.word_chars = {} # Inited by init_keywords().
+        self.wordRegexDict = {}
+            # Keys are id(word_chars), values are (word_chars, len(word_chars), regex).
         self.setFontFromConfig()
         self.tags = [
             # 8 Leo-specific tags.
@@ -442,6 +677,169 @@ class JEditColorizer(BaseColorizer):
                     theList.append(rule)
                 theDict[ch] = theList
         # g.trace(g.listToString(theDict.get('@')))
+    #@+node:ekr.20170822112233.1: *4* jedit.compileRules & helpers
+    def compileRules(self, rulesDict):
+        '''
+        Return a g.Bunch containing the compiled form of rulesDict:
+
+        table:  Keys are characters, values are tuples of rule functions.
+        skip:   A regex matching runs of characters that start no rule.
+
+        jedit.mainLoop skips such runs with a single regex match, rather than
+        looking up each character in rulesDict.
+        '''
+        if not isinstance(rulesDict, dict):
+            # A dict-like object, as in leo/modes/plain.py. Use it as it is.
+            table = g.Bunch(get=lambda ch, default=None: rulesDict.get(ch, []))
+            return g.Bunch(rulesDict=rulesDict, skip=None, table=table)
+        table = {}
+        for ch, rules in rulesDict.items():
+            compiled = tuple(z for z in (self.compileRule(rule) for rule in rules) if z)
+            if compiled:
+                table[ch] = compiled
+        chars = ''.join(re.escape(ch) for ch in sorted(table) if len(ch) == 1)
+        skip = re.compile('[^%s]+' % chars if chars else r'[\s\S]+')
+        return g.Bunch(rulesDict=rulesDict, skip=skip, table=table)
+
+    def getCompiledRules(self, bunch):
+        '''Return the compiled rules of the mode described by bunch.'''
+        compiled = bunch.get('compiledRules')
+        if not compiled or compiled.rulesDict is not bunch.rulesDict:
+            compiled = bunch.compiledRules = self.compileRules(bunch.rulesDict)
+        return compiled
+    #@+node:ekr.20170822112233.2: *5* jedit.compileRule
+    # Rules that never match. They return 0 so that Qt can show invisibles.
+    nullMatchers = ('match_blanks', 'match_mark_previous', 'match_tabs')
+
+    # Keys are Leo's rules, values are tuples of strings that must start any match.
+    leoRuleLeadins = {
+        'match_unl': tuple(a + b + c + '://' for a in 'uU' for b in 'nN' for c in 'lL'),
+        'match_url_f': ('file://', 'ftp://'),
+        'match_url_g': ('gopher://',),
+        'match_url_h': ('http://', 'https://'),
+        'match_url_m': ('mailto://',),
+        'match_url_n': ('news://', 'nntp://'),
+        'match_url_p': ('prospero://',),
+        'match_url_t': ('telnet://',),
+        'match_url_w': ('wais://',),
+    }
+
+    # Keys are pattern matchers, values are the keyword arg that must start any match.
+    leadinKeywords = {
+        'match_eol_span': 'seq',
+        'match_mark_following': 'pattern',
+        'match_seq': 'seq',
+        'match_span': 'begin',
+        'match_word_and_regexp': 'word',
+    }
+
+    def compileRule(self, rule):
+        '''
+        Return a rule function equivalent to rule, or None if rule never
+        matches. The new function fails at once unless the text starts with
+        the text that any match of rule must start with.
+        '''
+        if self.isLeoRule(rule):
+            name = rule.__name__
+            if name in self.nullMatchers:
+                return None
+            leadins = self.leoRuleLeadins.get(name)
+            if not leadins:
+                return rule
+
+            def leoRule(colorer, s, i):
+                if s.startswith(leadins, i):
+                    return rule(colorer, s, i)
+                return 0
+
+            return leoRule
+        aTuple = self.analyzeRule(rule)
+        if not aTuple:
+            return rule
+        matcher, keys = aTuple
+        if not matcher or matcher in self.nullMatchers:
+            return None
+        if not keys and matcher == 'match_keywords':
+            # Call the matcher directly.
+            f = getattr(self.__class__, matcher)
+            return getattr(f, '__func__', f)
+        leadin = keys.get(self.leadinKeywords.get(matcher))
+        if not leadin or not g.isString(leadin):
+            return rule
+
+        def modeRule(colorer, s, i):
+            if s.startswith(leadin, i):
+                return getattr(colorer, matcher)(s, i, **keys)
+            return 0
+
+        return modeRule
+    #@+node:ekr.20170822112233.3: *5* jedit.analyzeRule
+    def analyzeRule(self, rule):
+        '''
+        Return (matcher, keys) if rule does nothing but call the pattern
+        matcher with the given name, passing s, i and the constant keyword
+        args in the keys dict. This is so for almost all rules in leo/modes.
+        Return (None, {}) if rule always fails. Otherwise, return None.
+        '''
+        data = getattr(rule, 'ruleData', None)
+        if data:
+            # A rule created by jedit.makeRule.
+            return data
+        code = getattr(rule, '__code__', None)
+        if (not code or code.co_argcount != 3 or len(code.co_names) > 1 or
+            getattr(rule, '__closure__', None) or getattr(rule, '__defaults__', None)
+        ):
+            return None
+        if not code.co_names:
+            # The rule can use only its args, so it fails if it returns 0 here.
+            try:
+                if rule(None, 'x', 0) == 0:
+                    return None, {}
+            except Exception:
+                pass
+            return None
+        matcher = code.co_names[0]
+        if not matcher.startswith('match_'):
+            return None
+        calls = []
+
+        def recorder(s, i, **keys):
+            calls.append((s, i, keys))
+            return 0
+
+        try:
+            rule(g.Bunch(**{matcher: recorder}), 'x', 0)
+        except Exception:
+            return None
+        if len(calls) != 1 or calls[0][:2] != ('x', 0):
+            return None
+        return matcher, calls[0][2]
+    #@+node:ekr.20170822131904.7: *5* jedit.isLeoRule & makeRule
+    def isLeoRule(self, rule):
+        '''Return True if rule is one of the rules added by jedit.addLeoRules.'''
+        name = getattr(rule, '__name__', None)
+        f = getattr(self.__class__, name, None) if name else None
+        return getattr(f, '__func__', f) is rule
+
+    def makeRule(self, matcher, keys, source):
+        '''
+        Return a rule that calls the given matcher with the given keys, the
+        inverse of jedit.analyzeRule. source is the path to the mode module
+        that defined the original rule.
+        '''
+        if matcher:
+
+            def rule(colorer, s, i):
+                return getattr(colorer, matcher)(s, i, **keys)
+
+        else:
+
+            def rule(colorer, s, i):
+                return 0
+
+        rule.ruleData = matcher, keys
+        rule.ruleSource = source
+        return rule
     #@+node:ekr.20111024091133.16702: *4* jedit.configure_hard_tab_width
     def configure_hard_tab_width(self):
         '''Set the width of a hard tab.
@@ -617,6 +1015,11 @@ class JEditColorizer(BaseColorizer):
             return False
         language, rulesetName = self.nameToRulesetName(name)
         bunch = self.modes.get(rulesetName)
+        if not bunch:
+            bunch = modeRegistry.getRuleset(rulesetName,
+                self.c.config.getBool('color_trailing_whitespace'))
+            if bunch:
+                self.modes[rulesetName] = bunch
         if bunch:
             if bunch.language == 'unknown-language':
                 if trace: g.trace('found unknown language')
@@ -628,14 +1031,12 @@ class JEditColorizer(BaseColorizer):
                 return True
         else:
             if trace: g.trace(language, rulesetName)
-            # Bug fix: 2008/2/10: Don't try to import a non-existent language.
-            path = g.os_path_join(g.app.loadDir, '..', 'modes')
-            fn = g.os_path_join(path, '%s.py' % (language))
-            if g.os_path_exists(fn):
-                mode = g.importFromPath(moduleName=language, path=path)
-                if trace: g.trace(mode)
-            else:
-                mode = None
+            if self.c.config.getBool('cache-colorizer-modes', default=True):
+                d = modeRegistry.load(rulesetName)
+                if d:
+                    return self.init_mode_from_dict(name, d)
+            mode = modeRegistry.getModule(language)
+            if trace: g.trace(mode)
             return self.init_mode_from_module(name, mode)
     #@+node:btheado.20131124162237.16303: *5* jedit.init_mode_from_module
     def init_mode_from_module(self, name, mode):
@@ -670,12 +1071,15 @@ class JEditColorizer(BaseColorizer):
         self.language = language
         self.rulesetName = rulesetName
         self.properties = getattr(mode, 'properties', None) or {}
-        self.keywordsDict = mode.keywordsDictDict.get(rulesetName, {}) if hasattr(mode, 'keywordsDictDict') else {}
+        # Copy the module's dicts: other colorizers share the module.
+        self.keywordsDict = dict(mode.keywordsDictDict.get(rulesetName, {})) if hasattr(mode, 'keywordsDictDict') else {}
         self.setKeywords()
         self.attributesDict = mode.attributesDictDict.get(rulesetName) if hasattr(mode, 'attributesDictDict') else {}
         # if trace: g.trace(rulesetName,self.attributesDict)
         self.setModeAttributes()
         self.rulesDict = mode.rulesDictDict.get(rulesetName) if hasattr(mode, 'rulesDictDict') else {}
+        if isinstance(self.rulesDict, dict):
+            self.rulesDict = dict((ch, list(aList)) for ch, aList in self.rulesDict.items())
         # if trace: g.trace(self.rulesDict)
         self.addLeoRules(self.rulesDict)
         self.defaultColor = 'null'
@@ -693,6 +1097,7 @@ class JEditColorizer(BaseColorizer):
         )
         # Do this after 'officially' initing the mode, to limit recursion.
         self.addImportedRules(mode, self.rulesDict, rulesetName)
+        self.compiledRules = self.getCompiledRules(self.modeBunch)
         self.updateDelimsTables()
         initialDelegate = self.properties.get('initialModeDelegate')
         if initialDelegate:
@@ -704,7 +1109,84 @@ class JEditColorizer(BaseColorizer):
             self.language = language2 # 2017/01/31
         else:
             self.language = language # 2017/01/31
+        if not hasattr(mode, 'pre_init_mode'):
+            # Share the ruleset with all other colorizers.
+            bunch = self.modes.get(rulesetName)
+            modeRegistry.putRuleset(rulesetName,
+                self.c.config.getBool('color_trailing_whitespace'), bunch)
+            if not initialDelegate and self.c.config.getBool('cache-colorizer-modes', default=True):
+                self.saveMode(bunch, mode)
+        return True
+    #@+node:ekr.20170822131904.8: *5* jedit.init_mode_from_dict & saveMode
+    def init_mode_from_dict(self, name, d):
+        '''
+        Init the mode from d, a dict created by jedit.saveMode.
+        Name may be a language name or a delegate name.
+        '''
+        trace = False and not g.unitTesting
+        language, rulesetName = self.nameToRulesetName(name)
+        if trace: g.trace(language, rulesetName)
+        self.language = language
+        self.rulesetName = rulesetName
+        self.properties = d['properties']
+        self.keywordsDict = d['keywordsDict']
+        self.setKeywords()
+        self.attributesDict = d['attributesDict']
+        self.setModeAttributes()
+        self.rulesDict = dict(
+            (ch, [self.makeRule(*data) for data in aList])
+                for ch, aList in d['rulesDict'].items())
+        self.addLeoRules(self.rulesDict)
+        self.defaultColor = 'null'
+        self.mode = None
+        self.modes[rulesetName] = self.modeBunch = g.Bunch(
+            attributesDict=self.attributesDict,
+            defaultColor=self.defaultColor,
+            keywordsDict=self.keywordsDict,
+            language = self.language,
+            mode=self.mode,
+            properties=self.properties,
+            rulesDict=self.rulesDict,
+            rulesetName=self.rulesetName,
+            word_chars=self.word_chars,
+        )
+        self.compiledRules = self.getCompiledRules(self.modeBunch)
+        self.updateDelimsTables()
+        modeRegistry.putRuleset(rulesetName,
+            self.c.config.getBool('color_trailing_whitespace'), self.modeBunch)
         return True
+
+    def saveMode(self, bunch, mode):
+        '''
+        Save bunch, a completely built mode bunch, and mode, the module from
+        which it came, provided that all its rules can be saved as data.
+        '''
+        if not bunch or not isinstance(bunch.rulesDict, dict):
+            return
+        sources = set()
+        fn = getattr(mode, '__file__', None)
+        if fn:
+            sources.add(fn[: -1] if fn.endswith('.pyc') else fn)
+        rulesDict = {}
+        for ch, rules in bunch.rulesDict.items():
+            aList = []
+            for rule in rules:
+                if self.isLeoRule(rule):
+                    continue # jedit.addLeoRules adds them again.
+                data = self.analyzeRule(rule)
+                if not data:
+                    return
+                source = getattr(rule, 'ruleSource', None) or rule.__code__.co_filename
+                sources.add(source)
+                aList.append(data + (source,))
+            rulesDict[ch] = aList
+        d = {
+            'attributesDict': bunch.attributesDict,
+            'keywordsDict': bunch.keywordsDict,
+            'properties': bunch.properties,
+            'rulesDict': rulesDict,
+        }
+        modeRegistry.save(bunch.rulesetName, d, sorted(sources))
     #@+node:ekr.20110605121601.18582: *5* jedit.nameToRulesetName
     def nameToRulesetName(self, name):
         '''
@@ -788,6 +1270,7 @@ class JEditColorizer(BaseColorizer):
         self.mode = bunch.mode
         self.properties = bunch.properties
         self.rulesDict = bunch.rulesDict
+        self.compiledRules = self.getCompiledRules(bunch)
         self.rulesetName = bunch.rulesetName
         self.word_chars = bunch.word_chars # 2011/05/21
     #@+node:ekr.20110605121601.18586: *5* jedit.updateDelimsTables
@@ -974,6 +1457,7 @@ class JEditColorizer(BaseColorizer):
             k = g.skip_ws(s, j)
             self.colorRangeWithTag(s, i, k, 'leokeyword')
             c.frame.setWrap(c.p, force=True)
+            self.cacheable = False # Always set the wrap.
             return k - i
         else:
             return 0
@@ -1059,6 +1543,7 @@ class JEditColorizer(BaseColorizer):
         m = self.image_url.match(s,i)
         if m:
             self.image_src = src = m.group(1)
+            self.cacheable = False
             j = len(src)
             doc = self.highlighter.document()
             block_n = self.currentBlockNumber()
@@ -1134,6 +1619,7 @@ class JEditColorizer(BaseColorizer):
             return 0
         else:
             j = k + 2
+            self.cacheable = False # The colors depend on the outline.
             self.colorRangeWithTag(s, i, i + 2, 'namebrackets')
             # g.trace('ref %r %s' % (s[i: j], p.h))
             # g.trace(g.callers(6))
@@ -1202,6 +1688,8 @@ class JEditColorizer(BaseColorizer):
     url_regex_w = re.compile(r"""wais://[^\s'"]+[\w=/]""")
     kinds = '(file|ftp|gopher|http|https|mailto|news|nntp|prospero|telnet|wais)'
     url_regex = re.compile(r"""%s://[^\s'"]+[\w=/]""" % (kinds))
+    url_leadin_regex = re.compile('[fhuFHU]')
+        # The first characters of unl's and of urls matched by colorRangeWithTag.
 
     def match_any_url(self, s, i):
         return self.match_compiled_regexp(s, i, kind='url', regexp=self.url_regex)
@@ -1305,7 +1793,7 @@ class JEditColorizer(BaseColorizer):
         # j = len(s)
         # self.colorRangeWithTag(s,i,j,kind,delegate=delegate)
         # return j
-    #@+node:ekr.20110605121601.18614: *4* jedit.match_keywords
+    #@+node:ekr.20110605121601.18614: *4* jedit.match_keywords & helper
     # This is a time-critical method.
 
     def match_keywords(self, s, i):
@@ -1323,13 +1811,11 @@ class JEditColorizer(BaseColorizer):
             # if trace: g.trace('not at word start',s[i-1])
             return 0
         # Get the word as quickly as possible.
-        j = i; n = len(s)
         chars = self.word_chars
         # 2013/11/04: A kludge just for Haskell:
         if self.language in ('haskell','clojure'):
             chars["'"] = "'"
-        while j < n and s[j] in chars:
-            j += 1
+        j = self.getWordRegex(chars).match(s, i).end()
         word = s[i: j]
         if not word:
             g.trace('can not happen', repr(s[i: max(j, i + 1)]), repr(s[i: i + 10]), g.callers())
@@ -1346,6 +1832,17 @@ class JEditColorizer(BaseColorizer):
         else:
             if trace and traceFail: g.trace('fail', word, kind)
             return -len(word) # An important new optimization.
+    #@+node:ekr.20170822112233.4: *5* jedit.getWordRegex
+    def getWordRegex(self, chars):
+        '''Return a regex matching a (possibly empty) run of chars.'''
+        key = id(chars)
+        aTuple = self.wordRegexDict.get(key)
+        if aTuple and aTuple[0] is chars and aTuple[1] == len(chars):
+            return aTuple[2]
+        pattern = ''.join(re.escape(ch) for ch in sorted(chars))
+        regex = re.compile('[%s]*' % pattern if pattern else '')
+        self.wordRegexDict[key] = chars, len(chars), regex
+        return regex
     #@+node:ekr.20110605121601.18615: *4* jedit.match_line
     def match_line(self, s, i, kind=None, delegate='', exclude_match=False):
         '''Match the rest of the line.'''
@@ -1860,7 +2357,7 @@ class JEditColorizer(BaseColorizer):
             while 0 <= i < j and i < len(s):
                 progress = i
                 assert j >= 0, j
-                for f in self.rulesDict.get(s[i], []):
+                for f in self.compiledRules.table.get(s[i], ()):
                     n = f(self, s, i)
                     if n is None:
                         g.trace('Can not happen: delegate matcher returns None')
@@ -1886,26 +2383,35 @@ class JEditColorizer(BaseColorizer):
             # Allow UNL's and URL's *everywhere*.
             j = min(j, len(s))
             while i < j:
-                ch = s[i].lower()
-                if ch == 'u':
+                m = self.url_leadin_regex.search(s, i, j)
+                if not m:
+                    break
+                i = m.start()
+                if s[i] in 'uU':
                     n = self.match_unl(s, i)
                     # if n > 0: g.trace('found unl', s[i:i+n])
-                    i += max(1, n)
-                elif ch in 'fh': # file|ftp|http|https
+                else: # file|ftp|http|https
                     n = self.match_any_url(s, i)
                     # if n > 0: g.trace('found url', s[i:i+n])
-                    i += max(1, n)
-                else:
-                    i += 1
+                i += max(1, n)
     #@+node:ekr.20110605121601.18638: *3* jedit.mainLoop
     def mainLoop(self, n, s):
         '''Colorize a *single* line s, starting in state n.'''
         f = self.restartDict.get(n)
         i = f(s) if f else 0
+        if self.compiledRules.rulesDict is not self.rulesDict:
+            # Some other code has replaced self.rulesDict.
+            self.compiledRules = self.compileRules(self.rulesDict)
         # if trace: g.trace('===== %30s %r' % (self.showCurrentState(), s))
         while i < len(s):
             progress = i
-            functions = self.rulesDict.get(s[i], [])
+            rules = self.compiledRules
+                # Rules may change the mode.
+            functions = rules.table.get(s[i])
+            if functions is None:
+                # Skip all characters that start no rule.
+                i = rules.skip.match(s, i).end()
+                continue
             # g.printList(functions)
             for f in functions:
                 n = f(self, s, i)
@@ -1942,7 +2448,7 @@ class JEditColorizer(BaseColorizer):
         if p.v != self.old_v:
             self.updateSyntaxColorer(p) # Force a full recolor
             assert self.language
-            self.init_all_state(p.v)
+            self.switchColorState(p.v)
             self.init(p)
             if trace: g.trace('New node ==>', self.language, p.h)
         else:
@@ -1958,7 +2464,40 @@ class JEditColorizer(BaseColorizer):
             self.language, self.showState(n), block_n, g.truncate(s, 20)))
         # Always color the line, even if colorizing is disabled.
         if s:
+            self.colorLine(n, s)
+    #@+node:ekr.20170822120517.5: *4* jedit.colorLine
+    def colorLine(self, n, s):
+        '''
+        Color line s, whose initial state is n, reapplying the formats in the
+        color cache if possible.
+        '''
+        entry = self.colorCacheEntry
+        if entry is None:
             self.mainLoop(n, s)
+            return
+        cache = self.colorCache
+        data = entry.lines.get((n, s))
+        if data:
+            cache.hits += 1
+            state, formats, setsDocLanguage, docLanguage = data
+            for i, length, format in formats:
+                self.highlighter.setFormat(i, length, format)
+            if setsDocLanguage:
+                self.after_doc_language = docLanguage
+            self.setState(state)
+            return
+        cache.misses += 1
+        self.cacheable = True
+        docLanguage = self.after_doc_language
+        self.recordedFormats = formats = []
+        try:
+            self.mainLoop(n, s)
+        finally:
+            self.recordedFormats = None
+        if self.cacheable:
+            setsDocLanguage = self.after_doc_language != docLanguage
+            cache.putLine(entry, (n, s), (self.currentState(), tuple(formats),
+                setsDocLanguage, self.after_doc_language))
     #@+node:ekr.20170126100139.1: *4* jedit.initBlock0
     def initBlock0 (self):
         '''
@@ -2000,6 +2539,39 @@ class JEditColorizer(BaseColorizer):
             return name
         else:
             return 'no-language'
+    #@+node:ekr.20170822120517.6: *4* jedit.switchColorState & clearColorCache
+    def switchColorState(self, v):
+        '''
+        Switch to v's state tables, reusing the tables in the color cache if
+        they exist for v and the present language.
+        '''
+        cache, entry = self.colorCache, self.colorCacheEntry
+        if entry is not None:
+            entry.nextState = self.nextState
+        entry = cache.getEntry(v, self.language) if cache else None
+        if entry is None:
+            self.init_all_state(v)
+            if cache:
+                entry = cache.newEntry(v, self.language,
+                    n2languageDict=self.n2languageDict,
+                    nextState=self.nextState,
+                    restartDict=self.restartDict,
+                    stateDict=self.stateDict,
+                    stateNameDict=self.stateNameDict)
+        else:
+            self.old_v = v
+            self.n2languageDict = entry.n2languageDict
+            self.nextState = entry.nextState
+            self.restartDict = entry.restartDict
+            self.stateDict = entry.stateDict
+            self.stateNameDict = entry.stateNameDict
+        self.colorCacheEntry = entry
+
+    def clearColorCache(self):
+        '''Discard all cached colors.'''
+        if self.colorCache:
+            self.colorCache.clear()
+        self.colorCacheEntry = None
     #@+node:ekr.20170205055743.1: *3* jedit.set_wikiview_patterns
     def set_wikiview_patterns(self, leadins, patterns):
         '''
@@ -2007,6 +2579,9 @@ class JEditColorizer(BaseColorizer):
         The wikiview plugin calls this method.
         '''
         d = self.rulesDict
+        if isinstance(d, dict):
+            # Change a copy: all colorizers share the rulesets in modeRegistry.
+            d = dict((ch, list(aList)) for ch, aList in d.items())
         for leadins_list, pattern in zip(leadins, patterns):
             # g.trace('%3s %s' % (leadins_list, pattern))
             for ch in leadins_list:
@@ -2020,10 +2595,24 @@ class JEditColorizer(BaseColorizer):
                     aList.insert(0, wiki_rule)
                     d [ch] = aList
         self.rulesDict = d
+        # Replace the present mode by a mode using d.
+        old_bunch = self.modeBunch
+        if old_bunch:
+            bunch = g.Bunch(**old_bunch.__dict__)
+            bunch.compiledRules = None
+            bunch.rulesDict = d
+            for key, value in list(self.modes.items()):
+                if value is old_bunch:
+                    self.modes[key] = bunch
+            self.modeBunch = bunch
+            self.compiledRules = self.getCompiledRules(bunch)
+        else:
+            self.compiledRules = self.compileRules(d)
+        self.clearColorCache()
         # g.trace('===== f') ; g.printList(d.get('f'))
         # g.trace('===== h') ; g.printList(d.get('h'))
         # g.trace('===== `') ; g.printList(d.get('`'))
-    #@+node:ekr.20110605121601.18641: *3* jedit.setTag
+    #@+node:ekr.20110605121601.18641: *3* jedit.setTag & setFormat
     def setTag(self, tag, s, i, j):
         '''Set the tag in the highlighter.'''
         trace = False and not g.unitTesting
@@ -2057,8 +2646,14 @@ class JEditColorizer(BaseColorizer):
             else:
                 return g.trace('unknown color name', colorName, g.callers())
         underline = wrapper.configUnderlineDict.get(tag)
-        format = QtGui.QTextCharFormat()
         font = self.fonts.get(tag)
+        # Reuse formats: the color cache retains them.
+        key = (tag, dots, colorName, underline)
+        data = self.formatDict.get(key)
+        if data and data[0] is font:
+            self.setFormat(i, j, data[1])
+            return
+        format = QtGui.QTextCharFormat()
         if font:
             format.setFont(font)
         if trace:
@@ -2081,8 +2676,15 @@ class JEditColorizer(BaseColorizer):
         else:
             format.setForeground(color)
             format.setUnderlineStyle(format.NoUnderline)
+        self.formatDict[key] = font, format
+        self.setFormat(i, j, format)
+
+    def setFormat(self, i, j, format):
+        '''Set the format of s[i:j], remembering it for the color cache.'''
         self.tagCount += 1
         self.highlighter.setFormat(i, j - i, format)
+        if self.recordedFormats is not None:
+            self.recordedFormats.append((i, j - i, format))
     #@-others
 #@+node:ekr.20110605121601.18565: ** class LeoHighlighter
 # This is c.frame.body.colorizer.highlighter
@@ -142,6 +142,13 @@ class Commands(object):
             # List of nodes with conflicting read-time data.
         self.nodeConflictFileName = None
             # The fileName for c.nodeConflictList.
+        self.parentTextGeneration = 0
+            # Incremented whenever the headline or body of a node with
+            # children changes. See v.textChanged.
+        self.dataChangedSets = []
+            # Sets of vnodes. v.dataChanged adds v to all these sets.
+        self.textChangedSets = []
+            # Sets of vnodes. v.textChanged adds v to all these sets.
         self.user_dict = {}
             # Non-persistent dictionary for free use by scripts and plugins.
     #@+node:ekr.20120217070122.10467: *5* c.initEventIvars
@@ -259,6 +266,7 @@ class Commands(object):
         assert self.frame.c == c
         import leo.core.leoHistory as leoHistory
         self.nodeHistory = leoHistory.NodeHistory(c)
+        self.visibilityIndex = leoNodes.VisibilityIndex(c)
         self.initConfigSettings()
         c.setWindowPosition() # Do this after initing settings.
         # Break circular import dependencies by doing imports here.
@@ -3705,6 +3713,8 @@ class Commands(object):
         # g.trace(g.listToString(newChildren))
         bunch = u.beforeSort(p, undoType, oldChildren, newChildren, sortChildren)
         parent_v.children = newChildren
+        parent_v.dataChanged()
+        c.frame.tree.generation += 1
         if parent:
             dirtyVnodeList = parent.setAllAncestorAtFileNodesDirty()
         else:
@@ -4578,11 +4588,15 @@ class Commands(object):
         parent_v.children = parent_v.children[: n + 1]
         # Add the moved nodes to p's children
         p.v.children.extend(followingSibs)
+        c.frame.tree.generation += 1
         # Adjust the parent links in the moved nodes.
         # There is no need to adjust descendant links.
         for child in followingSibs:
             child.parents.remove(parent_v)
             child.parents.append(p.v)
+            child.dataChanged()
+        parent_v.dataChanged()
+        p.v.dataChanged()
         p.expand()
         # Even if p is an @ignore node there is no need to mark the demoted children dirty.
         dirtyVnodeList = p.setAllAncestorAtFileNodesDirty()
@@ -4799,11 +4813,15 @@ class Commands(object):
         parent_v.children.extend(z[n:])
         # Remove v's children.
         p.v.children = []
+        c.frame.tree.generation += 1
         # Adjust the parent links in the moved children.
         # There is no need to adjust descendant links.
         for child in children:
             child.parents.remove(p.v)
             child.parents.append(parent_v)
+            child.dataChanged()
+        parent_v.dataChanged()
+        p.v.dataChanged()
         c.setChanged(True)
         if undoFlag:
             if not inAtIgnoreRange and isAtIgnoreNode:
@@ -5356,22 +5374,63 @@ class Commands(object):
     #@+node:ekr.20080827175609.39: *4* c.scanAllDirectives
     #@@nobeautify
 
+    maxDirectivesMemo = 4
+
     def scanAllDirectives(self,p=None):
         '''
         Scan p and ancestors for directives.
 
         Returns a dict containing the results, including defaults.
+
+        The result is memoized in p.v._directivesMemo. Each memo entry is
+        valid until p's text, the text of any node with children, the
+        outline's structure, the directives or the defaults change, so a
+        hit checks only p itself. The entry for a node whose ancestors all
+        have a single parent has the key None. Other entries are keyed by
+        their chain of ancestors, so clones with different ancestors have
+        separate entries. The dict holds at most c.maxDirectivesMemo entries.
         '''
         trace = False and not g.unitTesting
         c = self
         p = p or c.p
         # Set defaults
         language = c.target_language and c.target_language.lower()
+        wrap = c.config.getBool("body_pane_wraps")
+        key = (
+            p.v.textCount, c.parentTextGeneration, c.frame.tree.generation,
+            g.get_directives_pattern(),
+            language, c.page_width, c.tab_width, wrap,
+            c.openDirectory, g.app.config and g.app.config.relative_path_base_directory,
+        )
+        memo = p.v._directivesMemo
+        entry = memo.get(None)
+        if entry and entry[0] == key:
+            d = entry[1]
+        else:
+            chain = tuple([v for v, childIndex in p.stack])
+            entry = memo.get(chain)
+            if entry and entry[0] == key:
+                d = entry[1]
+            else:
+                d = c.computeAllDirectives(p, language, wrap)
+                if len(memo) >= c.maxDirectivesMemo:
+                    # Discard entries for old versions of the outline.
+                    memo.clear()
+                unique = all(len(v.parents) == 1 for v in chain + (p.v,))
+                memo[None if unique else chain] = (key, d)
+        if trace: g.trace(d.get('language'),g.callers())
+        # Return a new dict: callers may change it.
+        d = dict(d)
+        d['pluginsList'] = [] # No longer used.
+        return d
+
+    def computeAllDirectives(self, p, language, wrap):
+        '''Compute the result of c.scanAllDirectives.'''
+        c = self
         lang_dict = {
             'language':language,
             'delims':g.set_delims_from_language(language),
         }
-        wrap = c.config.getBool("body_pane_wraps")
         table = (
             ('encoding',    None,           g.scanAtEncodingDirectives),
             ('lang-dict',   lang_dict,      g.scanAtCommentAndAtLanguageDirectives),
@@ -5400,7 +5459,6 @@ class Commands(object):
             "pluginsList":  [], # No longer used.
             "wrap":         d.get('wrap'),
         }
-        if trace: g.trace(lang_dict.get('language'),g.callers())
         # g.trace(d.get('tabwidth'))
         return d
     #@+node:ekr.20080828103146.15: *4* c.scanAtPathDirectives
@@ -5793,6 +5851,9 @@ class Commands(object):
         '''Force a full recolor.'''
         c = self
         wrapper = c.frame.body.wrapper
+        colorizer = c.frame.body.colorizer
+        if hasattr(colorizer, 'clearColorCache'):
+            colorizer.clearColorCache()
         # Setting all text appears to be the only way.
         i, j = wrapper.getSelectionRange()
         ins = wrapper.getInsertPoint()
@@ -6288,10 +6349,11 @@ class Commands(object):
         c = self
         pat = re.compile(regex, flags)
         res = leoNodes.PosList()
-        for p in c.all_positions():
-            m = re.match(pat, p.h)
+        w = c.walk_nodes()
+        for v, level, childIndex in w:
+            m = re.match(pat, v.h)
             if m:
-                pc = p.copy()
+                pc = w.position()
                 pc.mo = m
                 res.append(pc)
         return res
@@ -6304,8 +6366,9 @@ class Commands(object):
         c = self
         pat = re.compile(regex, flags)
         res = leoNodes.PosList()
-        for p in c.all_positions():
-            m = re.finditer(pat, p.b)
+        w = c.walk_nodes()
+        for v, level, childIndex in w:
+            m = re.finditer(pat, v.b)
             t1, t2 = itertools.tee(m, 2)
             try:
                 if g.isPython3:
@@ -6314,7 +6377,7 @@ class Commands(object):
                     t1.next()
             except StopIteration:
                 continue
-            pc = p.copy()
+            pc = w.position()
             pc.matchiter = t2
             res.append(pc)
         return res
@@ -6425,14 +6488,14 @@ class Commands(object):
     def all_nodes(self):
         '''A generator returning all vnodes in the outline, in outline order.'''
         c = self
-        for p in c.all_positions():
-            yield p.v
+        for v, level, childIndex in c.walk_nodes():
+            yield v
 
     def all_unique_nodes(self):
         '''A generator returning each vnode of the outline.'''
         c = self
-        for p in c.all_unique_positions():
-            yield p.v
+        for v, level, childIndex in c.walk_nodes(unique=True):
+            yield v
 
     # Compatibility with old code...
     all_tnodes_iter = all_nodes
@@ -6463,11 +6526,13 @@ class Commands(object):
         '''
         c = self
         if predicate is None:
-
-            # pylint: disable=function-redefined
-            def predicate(p):
-                return p.isAnyAtFileNode()
-
+            # Test vnodes: there is no need to create positions.
+            w = c.walk_nodes()
+            for v, level, childIndex in w:
+                if v.isAnyAtFileNode():
+                    yield w.position()
+                    w.skipTree()
+            return
         p = c.rootPosition()
         while p:
             if predicate(p):
@@ -6487,13 +6552,16 @@ class Commands(object):
         the predicate. Once a root is found, the generator skips its subtree.
         '''
         c = self
-        if predicate is None:
-
-            # pylint: disable=function-redefined
-            def predicate(p):
-                return p.isAnyAtFileNode()
-
         seen = set()
+        if predicate is None:
+            # Test vnodes: there is no need to create positions.
+            w = c.walk_nodes()
+            for v, level, childIndex in w:
+                if v not in seen and v.isAnyAtFileNode():
+                    seen.add(v)
+                    yield w.position()
+                    w.skipTree()
+            return
         p = c.rootPosition()
         while p:
             if p.v not in seen and predicate(p):
@@ -6522,6 +6590,14 @@ class Commands(object):
     # Compatibility with old code...
     all_positions_with_unique_tnodes_iter = all_unique_positions
     all_positions_with_unique_vnodes_iter = all_unique_positions
+    #@+node:ekr.20170819074406.5: *4* c.walk_nodes
+    def walk_nodes(self, root=None, unique=False):
+        '''
+        Return a leoNodes.NodeWalker, yielding (v, level, childIndex) for all
+        nodes of the outline, or for root and its subtree. This is much
+        faster than the position-based generators.
+        '''
+        return leoNodes.NodeWalker(self, root=root, unique=unique)
     #@+node:ekr.20150316175921.5: *4* c.safe_all_positions
     def safe_all_positions(self):
         '''
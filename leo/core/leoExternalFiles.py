@@ -3,12 +3,100 @@
 #@+node:ekr.20160306114544.1: * @file leoExternalFiles.py
 #@@first
 import leo.core.leoGlobals as g
+import ctypes
+import ctypes.util
+import errno
 import getpass
 import os
+import stat
+import struct
 import subprocess
+import sys
 import tempfile
 import time
 #@+others
+#@+node:ekr.20170822152245.1: ** class AtFileIndex
+class AtFileIndex(object):
+    '''
+    An index of the @<file> nodes of one commander and their external files.
+
+    Each entry is a g.Bunch holding an @<file> node's position, the full and
+    real paths of its external file, the modification time and size of the
+    file when it was last checked, and the (v, v.textCount) pairs of the
+    node and its ancestors: the inputs of g.fullPath.
+
+    v.textCount changes whenever v's headline or body changes, so comparing
+    counts tells whether an entry's paths must be recomputed, without
+    keeping references to bodies or loading them. The index is rebuilt
+    when c.frame.tree.generation changes, that is, when the outline's
+    structure changes, when the outline's file name changes, or when the
+    position of any entry no longer exists.
+    '''
+    #@+others
+    #@+node:ekr.20170822152245.2: *3* index.ctor
+    def __init__(self, c):
+        '''Ctor for AtFileIndex class.'''
+        self.c = c
+        self.entries = []
+            # One g.Bunch per @<file> node, in outline order.
+        self.key = None
+            # The state of c when self.entries was built.
+    #@+node:ekr.20170822152245.3: *3* index.get_entries & get_entries_for_paths
+    def get_entries(self):
+        '''Return the list of all entries, updated as needed.'''
+        c = self.c
+        key = (c.frame.tree.generation, c.openDirectory, c.fileName())
+        if key != self.key or not all(c.positionExists(z.p) for z in self.entries):
+            self.key = key
+            self.rebuild()
+        else:
+            for entry in self.entries:
+                if not self.is_valid(entry):
+                    self.update(entry)
+        return self.entries
+
+    def get_entries_for_paths(self, paths):
+        '''Return the list of entries whose real paths are in the given set.'''
+        return [z for z in self.get_entries() if z.realpath in paths]
+    #@+node:ekr.20170822152245.4: *3* index.is_valid
+    def is_valid(self, entry):
+        '''Return True if entry's paths are up to date.'''
+        for v, n in entry.inputs:
+            if v.textCount != n:
+                return False
+        return True
+    #@+node:ekr.20170822152245.5: *3* index.rebuild
+    def rebuild(self):
+        '''Recompute all entries, keeping the file times of unchanged entries.'''
+        old_d = dict((z.p.v, z) for z in self.entries)
+        self.entries = []
+        p = self.c.rootPosition()
+        seen = set()
+        while p:
+            if p.v in seen:
+                p.moveToNodeAfterTree()
+            elif p.isAnyAtFileNode():
+                seen.add(p.v)
+                entry = g.Bunch(p=p.copy(), path=None, realpath=None, stat=None)
+                self.update(entry)
+                old = old_d.get(p.v)
+                if old and old.path == entry.path:
+                    entry.stat = old.stat
+                self.entries.append(entry)
+                p.moveToNodeAfterTree()
+            else:
+                p.moveToThreadNext()
+    #@+node:ekr.20170822152245.6: *3* index.update
+    def update(self, entry):
+        '''Recompute the paths of the entry.'''
+        p = entry.p
+        entry.inputs = [(z.v, z.v.textCount) for z in p.self_and_parents()]
+        path = g.fullPath(self.c, p)
+        if path != entry.path:
+            entry.path = path
+            entry.realpath = g.os_path_realpath(path) if path else ''
+            entry.stat = None
+    #@-others
 #@+node:ekr.20160306110233.1: ** class ExternalFile
 class ExternalFile(object):
     '''A class holding all data about an external file.'''
@@ -35,6 +123,124 @@ class ExternalFile(object):
         '''Return True if the external file still exists.'''
         return g.os_path_exists(self.path)
     #@-others
+#@+node:ekr.20170822140311.1: ** class InotifyWatcher
+class InotifyWatcher(object):
+    '''
+    A class reporting changes to files using Linux's inotify API, via ctypes.
+
+    Watches are added to the directories containing the files, not to the
+    files themselves, so files that editors replace by renaming them remain
+    watched.
+    '''
+    # Constants from <sys/inotify.h>.
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    event_header = struct.Struct('iIII')
+        # wd, mask, cookie, len: the fixed part of struct inotify_event.
+
+    #@+others
+    #@+node:ekr.20170822140311.2: *3* watcher.ctor & close
+    def __init__(self):
+        '''
+        Ctor for InotifyWatcher class.
+        Raise OSError if inotify is not available.
+        '''
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify requires Linux')
+        self.fd = None
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+            use_errno=True)
+        fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.fd = fd
+        self.dirs = {}
+            # Keys are watch descriptors, values are directories.
+        self.paths = set()
+            # The real paths of all watched files.
+        self.wds = {}
+            # Keys are directories, values are watch descriptors.
+
+    def close(self):
+        '''Stop watching all files.'''
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.dirs, self.paths, self.wds = {}, set(), {}
+    #@+node:ekr.20170822140311.3: *3* watcher.watch
+    def watch(self, path):
+        '''
+        Watch the file at the given path.
+        Return False if the file's directory can not be watched.
+        '''
+        path = g.os_path_realpath(path)
+        if path in self.paths:
+            return True
+        directory = g.os_path_dirname(path)
+        if directory not in self.wds:
+            encoded = g.toEncodedString(directory, sys.getfilesystemencoding() or 'utf-8')
+            wd = self.libc.inotify_add_watch(self.fd, encoded, self.mask)
+            if wd < 0:
+                return False
+            self.wds[directory] = wd
+            self.dirs[wd] = directory
+        self.paths.add(path)
+        return True
+    #@+node:ekr.20170822140311.4: *3* watcher.read_events
+    def read_events(self):
+        '''
+        Read all pending events without blocking.
+
+        Return the set of real paths of watched files that have changed since
+        the last call, or None if inotify lost events.
+        '''
+        chunks = []
+        while True:
+            try:
+                chunk = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not chunk:
+                break
+            chunks.append(chunk)
+        buf = b''.join(chunks)
+        changed, lost = set(), False
+        header = self.event_header
+        i = 0
+        while i + header.size <= len(buf):
+            wd, mask, cookie, n = header.unpack_from(buf, i)
+            i += header.size
+            name = buf[i: i + n].rstrip(b'\0')
+            i += n
+            if mask & self.IN_Q_OVERFLOW:
+                lost = True
+            elif mask & self.IN_IGNORED:
+                # The directory has been deleted or unmounted.
+                directory = self.dirs.pop(wd, None)
+                if directory:
+                    del self.wds[directory]
+                    self.paths = set(z for z in self.paths
+                        if g.os_path_dirname(z) != directory)
+                    lost = True
+            elif name:
+                directory = self.dirs.get(wd)
+                if directory:
+                    name = g.toUnicode(name, sys.getfilesystemencoding() or 'utf-8')
+                    path = os.path.join(directory, name)
+                    if path in self.paths:
+                        changed.add(path)
+        return None if lost else changed
+    #@-others
 #@+node:ekr.20150405073203.1: ** class ExternalFilesController
 class ExternalFilesController(object):
     '''
@@ -45,6 +251,13 @@ class ExternalFilesController(object):
 
     This class raises a dialog when a file changes outside of Leo.
 
+    When possible, an InotifyWatcher reports changes to the external files
+    that Leo has read or written, and on_idle checks only the @<file> nodes
+    for those files. Otherwise, on_idle polls all @<file> nodes.
+
+    An AtFileIndex for each commander caches the paths of the external
+    files, so checking a file usually costs a single stat.
+
     **Convention**:
 
     - d is always a dict created by the @open-with logic.
@@ -65,6 +278,11 @@ class ExternalFilesController(object):
         self.has_changed_d = {}
             # Keys are commanders. Values are bools.
             # Used only to limit traces.
+        self.index_d = {}
+            # Keys are commanders, values are AtFileIndex instances.
+        self.realpath_d = {}
+            # Keys are paths, values are real paths.
+            # Cleared whenever on_idle starts checking all commanders.
         self.unchecked_commanders = []
             # Copy of g.app.commanders()
         self.unchecked_files = []
@@ -73,6 +291,14 @@ class ExternalFilesController(object):
             # Keys are full paths, values are modification times.
             # DO NOT alter directly, use set_time(path) and
             # get_time(path), see set_time() for notes.
+        self.changed_paths = set()
+            # Real paths reported by the watcher, not yet checked.
+        self.next_full_check = 0
+            # The time at which on_idle next checks all commanders.
+        self.watcher = None
+            # An InotifyWatcher, or None: poll all @<file> nodes.
+        self.watcher_inited = False
+            # True if get_watcher has tried to create self.watcher.
         self.yesno_all_time = 0  # previous yes/no to all answer, time of answer
         self.yesno_all_answer = None  # answer, 'yes-all', or 'no-all'
         g.app.idleTimeManager.add_callback(self.on_idle)
@@ -107,6 +333,7 @@ class ExternalFilesController(object):
         for ef in files:
             self.destroy_external_file(ef)
         self.files = [z for z in self.files if z.path not in paths]
+        self.index_d.pop(frame.c, None)
     #@+node:ekr.20031218072017.2614: *5* efc.destroy_external_file
     def destroy_external_file(self, ef):
         '''Destroy the file corresponding to the given ExternalFile instance.'''
@@ -137,11 +364,19 @@ class ExternalFilesController(object):
         return path
     #@+node:ekr.20150330033306.1: *4* efc.on_idle & helpers
     on_idle_count = 0
+    full_check_interval = 60
+        # Seconds between checks of all commanders when using a watcher.
 
     def on_idle(self):
         '''
         Check for changed open-with files and all external files in commanders
         for which @bool check_for_changed_external_file is True.
+
+        When using a watcher, check the files the watcher reports as changed,
+        and check all commanders only every full_check_interval seconds.
+
+        Return False if there was nothing to do. While a watcher is active,
+        never return False: backing off would delay reported changes.
         '''
         trace = False and not g.unitTesting and ((self.on_idle_count % 5) == 0)
         trace_idle = True
@@ -149,27 +384,37 @@ class ExternalFilesController(object):
             return
         t1 = time.time()
         self.on_idle_count += 1
+        busy = True
         if 1:
             # Fix #262: Improve performance of check_for_changed_external_files.
+            if self.watcher:
+                busy = self.idle_check_changed_paths()
             if self.unchecked_files:
                 # Check all external files.
                 for ef in self.unchecked_files:
                     if trace: g.trace('check', ef.shortFileName())
                     self.idle_check_open_with_file(ef)
                 self.unchecked_files = []
+                busy = True
             elif self.unchecked_commanders:
                 # Check the next commander for which
                 # @bool check_for_changed_external_file is True.
                 c = self.unchecked_commanders.pop()
                 if trace: g.trace('check', c.shortFileName())
                 self.idle_check_commander(c)
+                busy = True
             else:
                 # Add all commanders for which
                 # @bool check_for_changed_external_file is True.
-                self.unchecked_commanders = [
-                    z for z in g.app.commanders() if self.is_enabled(z)
-                ]
+                # The watcher reports most changes, so full checks are rare.
+                if not self.get_watcher() or t1 >= self.next_full_check:
+                    self.next_full_check = t1 + self.full_check_interval
+                    self.realpath_d = {}
+                    self.unchecked_commanders = [
+                        z for z in g.app.commanders() if self.is_enabled(z)
+                    ]
                 self.unchecked_files = [z for z in self.files if z.exists()]
+                busy = busy or bool(self.unchecked_commanders or self.unchecked_files)
         else:
             # First, check all existing open-with files.
             for ef in self.files: # A list of ExternalFile instances.
@@ -186,6 +431,37 @@ class ExternalFilesController(object):
             n2 = len([z for z in g.app.commanders() if self.is_enabled(z)])
             g.trace('(EFC) count: %3s files: %s commanders: %s time: %4.2f sec.' % (
                 self.on_idle_count, n1, n2, t2 - t1))
+        return busy or bool(self.watcher)
+    #@+node:ekr.20170822140311.5: *5* efc.idle_check_changed_paths
+    def idle_check_changed_paths(self):
+        '''
+        Check the @<file> nodes whose external files the watcher has reported
+        as changed.
+
+        Events are coalesced: nothing is checked until an idle-time tick
+        brings no new events, so a burst of writes leads to one check.
+
+        Return True if there were events.
+        '''
+        trace = False and not g.unitTesting
+        paths = self.watcher.read_events()
+        if paths is None:
+            # The watcher lost events: check all commanders soon.
+            if trace: g.trace('events lost')
+            self.next_full_check = 0
+            return True
+        if paths:
+            self.changed_paths |= paths
+            return True
+        if not self.changed_paths:
+            return False
+        paths, self.changed_paths = self.changed_paths, set()
+        if trace: g.trace(sorted(paths))
+        for c in g.app.commanders():
+            if self.is_enabled(c):
+                for entry in self.get_index(c).get_entries_for_paths(paths):
+                    self.idle_check_entry(c, entry)
+        return True
     #@+node:ekr.20150404045115.1: *5* efc.idle_check_commander
     def idle_check_commander(self, c):
         '''
@@ -194,21 +470,32 @@ class ExternalFilesController(object):
         '''
         trace = False and not g.unitTesting
         if trace: g.trace('checking', c.shortFileName())
-        p = c.rootPosition()
-        seen = set()
-        while p:
-            if p.v in seen:
-                p.moveToNodeAfterTree()
-            elif p.isAnyAtFileNode():
-                seen.add(p.v)
-                self.idle_check_at_file_node(c, p)
-                p.moveToNodeAfterTree()
-            else:
-                p.moveToThreadNext()
+        for entry in self.get_index(c).get_entries():
+            self.idle_check_entry(c, entry)
+    #@+node:ekr.20170822152245.7: *5* efc.idle_check_entry
+    def idle_check_entry(self, c, entry):
+        '''
+        Check the @<file> node of an AtFileIndex entry for external changes.
+
+        This costs one stat if the file's modification time and size have not
+        changed since the last check.
+        '''
+        try:
+            st = os.stat(entry.path)
+        except OSError:
+            return
+        if stat.S_ISDIR(st.st_mode):
+            return
+        if self.watcher and entry.realpath not in self.watcher.paths:
+            self.watch(entry.path)
+        key = (st.st_mtime, st.st_size)
+        if key != entry.stat:
+            entry.stat = key
+            self.idle_check_at_file_node(c, entry.p, path=entry.path)
     #@+node:ekr.20150403044823.1: *5* efc.idle_check_at_file_node
-    def idle_check_at_file_node(self, c, p):
+    def idle_check_at_file_node(self, c, p, path=None):
         '''Check the @<file> node at p for external changes.'''
-        path = g.fullPath(c, p)
+        path = path or g.fullPath(c, p)
         if self.has_changed(c, path):
             if self.ask(c, path, p=p):
                 c.redraw(p=p)
@@ -316,6 +603,9 @@ class ExternalFilesController(object):
         for ef in self.files[:]:
             self.destroy_external_file(ef)
         self.files = []
+        if self.watcher:
+            self.watcher.close()
+            self.watcher = None
     #@+node:ekr.20150405110219.1: *3* efc.utilities
     # pylint: disable=no-value-for-parameter
     #@+node:ekr.20150405200212.1: *4* efc.ask
@@ -452,7 +742,29 @@ class ExternalFilesController(object):
 
         see set_time() for notes
         '''
-        return self._time_d.get(g.os_path_realpath(path))
+        return self._time_d.get(self.realpath(path))
+    #@+node:ekr.20170822152245.8: *4* efc.get_index
+    def get_index(self, c):
+        '''Return the AtFileIndex for c, creating it if necessary.'''
+        index = self.index_d.get(c)
+        if not index:
+            index = self.index_d[c] = AtFileIndex(c)
+        return index
+    #@+node:ekr.20170822140311.7: *4* efc.get_watcher
+    def get_watcher(self):
+        '''
+        Return the InotifyWatcher, creating it on first use if
+        @bool watch-external-files is True. Return None if inotify is not
+        available: on_idle then polls all @<file> nodes.
+        '''
+        if not self.watcher_inited and g.app.config:
+            self.watcher_inited = True
+            if g.app.config.getBool('watch-external-files', default=True):
+                try:
+                    self.watcher = InotifyWatcher()
+                except Exception:
+                    self.watcher = None
+        return self.watcher
     #@+node:ekr.20150403045207.1: *4* efc.has_changed
     def has_changed(self, c, path):
         '''Return True if p's external file has changed outside of Leo.'''
@@ -597,6 +909,13 @@ class ExternalFilesController(object):
             g.es('exception executing open-with command:', command)
             g.es_exception()
             return 'oops: %s' % command
+    #@+node:ekr.20170822152245.9: *4* efc.realpath
+    def realpath(self, path):
+        '''Return g.os_path_realpath(path), using self.realpath_d.'''
+        result = self.realpath_d.get(path)
+        if result is None:
+            result = self.realpath_d[path] = g.os_path_realpath(path)
+        return result
     #@+node:tbrown.20150904102518.1: *4* efc.set_time
     def set_time(self, path, new_time=None):
         '''
@@ -612,7 +931,8 @@ class ExternalFilesController(object):
         trace = False and not g.unitTesting
         t = new_time or self.get_mtime(path)
         if trace: g.trace(t, path)
-        self._time_d[g.os_path_realpath(path)] = t
+        self._time_d[self.realpath(path)] = t
+        self.watch(path)
     #@+node:ekr.20031218072017.2832: *4* efc.temp_file_path & helpers
     def temp_file_path(self, c, p, ext):
         '''Return the path to the temp file for p and ext.'''
@@ -669,6 +989,20 @@ class ExternalFilesController(object):
         name = g.sanitize_filename(p.h) + '_' + str(id(p.v)) + ext
         path = os.path.join(td, name)
         return path
+    #@+node:ekr.20170822140311.8: *4* efc.watch
+    def watch(self, path):
+        '''
+        Tell the watcher to report changes to path.
+        Fall back to polling if that is not possible.
+        '''
+        watcher = self.get_watcher()
+        if watcher and self.realpath(path) in watcher.paths:
+            return
+        if watcher and not watcher.watch(path):
+            # Most likely, the inotify watch limit has been reached.
+            g.es_print('can not watch %s: polling external files' % path)
+            watcher.close()
+            self.watcher = None
     #@-others
 #@-others
 #@@language python
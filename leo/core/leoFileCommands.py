@@ -4,8 +4,10 @@
 #@+<< imports >>
 #@+node:ekr.20050405141130: ** << imports >> (leoFileCommands)
 import leo.core.leoGlobals as g
+import leo.core.leoExternalFiles as leoExternalFiles
 import leo.core.leoNodes as leoNodes
 import binascii
+import collections
 import difflib
 import time
 if g.isPython3:
@@ -43,6 +45,160 @@ class BadLeoFile(Exception):
 
 class InvalidPaste(Exception):
     pass
+#@+node:ekr.20170818091524.1: ** class DbBodyLoader
+class DbBodyLoader(object):
+    '''
+    Read the body text and uA's of DbVNodes from a .db file on demand.
+
+    At most maxResident unchanged bodies remain in memory. Changed bodies
+    are never discarded until they have been saved.
+    '''
+    #@+others
+    #@+node:ekr.20170818091524.2: *3* loader.ctor
+    def __init__(self, fileName, maxResident):
+        '''Ctor for DbBodyLoader class.'''
+        self.fileName = fileName
+        self.conn = sqlite3.connect(fileName)
+            # Our own connection: fc.save closes c.sqlite_connection.
+        self.maxResident = max(1, maxResident)
+        self.resident = collections.OrderedDict()
+            # Keys are DbVNodes whose unchanged bodies are in memory,
+            # least recently used first. Values are ignored.
+        self.n_loaded = 0
+    #@+node:ekr.20170818091524.3: *3* loader.loadBody & loadUa
+    def loadBody(self, v):
+        '''Return v's body text from the db, discarding least-recently used bodies.'''
+        self.n_loaded += 1
+        row = self.conn.execute(
+            'select body from vnodes where gnx = ?', (v.gnx,)).fetchone()
+        if row is None or row[0] is None:
+            g.trace('no body in %s for %s' % (self.fileName, v.gnx))
+            s = g.u('')
+        else:
+            s = g.toUnicode(row[0])
+        d = self.resident
+        d[v] = None
+        while len(d) > self.maxResident:
+            v2, junk = d.popitem(last=False)
+            v2.unloadBody()
+        return s
+
+    def loadUa(self, v):
+        '''Return v's uA's from the db, or None.'''
+        row = self.conn.execute(
+            'select ua from vnodes where gnx = ?', (v.gnx,)).fetchone()
+        if not row or not row[0]:
+            return None
+        try:
+            return pickle.loads(g.toEncodedString(row[0]))
+        except Exception:
+            return None
+    #@+node:ekr.20170818091524.4: *3* loader.pin & touch & unpin
+    def pin(self, v):
+        '''v's body has changed: never discard it.'''
+        self.resident.pop(v, None)
+
+    def touch(self, v):
+        '''Make v the most recently used node.'''
+        d = self.resident
+        d[v] = d.pop(v, None)
+
+    def unpin(self, v):
+        '''v's body has been saved: allow it to be discarded.'''
+        self.resident[v] = None
+    #@+node:ekr.20170818091524.5: *3* loader.close
+    def close(self):
+        '''Close the loader's connection.'''
+        self.resident.clear()
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+    #@-others
+#@+node:ekr.20170818091524.6: ** class DbVNode (VNode)
+class DbVNode(leoNodes.VNode):
+    '''
+    A VNode whose body text and uA's are read from a .db file only when
+    first needed. fc.retrieveVnodesFromDb creates DbVNodes when
+    @bool sqlite-lazy-load is True.
+    '''
+    unloaded = object()
+        # A marker: the node's uA's have not been read.
+    #@+others
+    #@+node:ekr.20170818091524.7: *3* dbv.ctor
+    def __init__(self, context, gnx, loader):
+        '''Ctor for DbVNode class.'''
+        self._loader = loader
+        self._bodyChanged = True
+        self._ua = None
+        leoNodes.VNode.__init__(self, context=context, gnx=gnx)
+        # The body and uA's remain in the db until needed.
+        self._body = None
+        self._bodyChanged = False
+        self._ua = self.unloaded
+    #@+node:ekr.20170818091524.8: *3* dbv._bodyString property
+    def __get_bodyString(self):
+        v = self
+        if v._body is None:
+            v._body = v._loader.loadBody(v)
+        elif not v._bodyChanged:
+            v._loader.touch(v)
+        return v._body
+
+    def __set_bodyString(self, s):
+        v = self
+        v._body = s
+        if not v._bodyChanged:
+            v._bodyChanged = True
+            v._loader.pin(v)
+
+    _bodyString = property(
+        __get_bodyString, __set_bodyString,
+        doc="DbVNode _bodyString property")
+    #@+node:ekr.20170818091524.9: *3* dbv.unknownAttributes property
+    def __get_ua(self):
+        v = self
+        if v._ua is v.unloaded:
+            v._ua = v._loader.loadUa(v)
+        if v._ua is None:
+            # Make hasattr(v, 'unknownAttributes') False, as for VNodes.
+            raise AttributeError('unknownAttributes')
+        return v._ua
+
+    def __set_ua(self, val):
+        self._ua = val
+
+    def __del_ua(self):
+        self._ua = None
+
+    unknownAttributes = property(
+        __get_ua, __set_ua, __del_ua,
+        doc="DbVNode unknownAttributes property")
+    #@+node:ekr.20170818091524.10: *3* dbv.dbBody & dbUa
+    def dbBody(self):
+        '''Return None if the body is unchanged since it was read or saved.'''
+        return self._body if self._bodyChanged else None
+
+    def dbUa(self):
+        '''Return True if the uA's have never been read from the db.'''
+        return self._ua is self.unloaded
+    #@+node:ekr.20170818091524.11: *3* dbv.load & unloadBody & bodySaved
+    def load(self):
+        '''Read everything from the db, and keep it in memory.'''
+        v = self
+        v._bodyString = v._bodyString
+        getattr(v, 'unknownAttributes', None)
+
+    def unloadBody(self):
+        '''Called by the loader to discard an unchanged body.'''
+        if not self._bodyChanged:
+            self._body = None
+
+    def bodySaved(self):
+        '''The body is now in the db.'''
+        if self._bodyChanged:
+            self._bodyChanged = False
+            self._loader.unpin(self)
+    #@-others
 #@+node:ekr.20060919110638.19: ** class SaxContentHandler (XMLGenerator)
 if sys.platform != 'cli':
 
@@ -516,6 +672,20 @@ class FileCommands(object):
             # 2011/12/10: This dict is never re-inited.
         self.vnodesDict = {}
             # keys are gnx strings; values are ignored
+        # For incremental writes to .db files...
+        self.dbFileName = None
+            # The .db file to which dbRows applies.
+        self.dbRows = None
+            # keys are gnx strings; values are the rows last read from
+            # or written to the vnodes table of dbFileName.
+        self.dbChanged = set()
+            # The vnodes whose rows may differ from dbRows.
+            # A member of c.dataChangedSets while dbRows is not None.
+        self.dbLoader = None
+            # A DbBodyLoader when @bool sqlite-lazy-load is True.
+        self.atFileIndex = None
+            # An AtFileIndex, used by fc.exportHashesToSqlite
+            # when there is no external files controller.
     #@+node:ekr.20031218072017.3020: *3* fc.Reading
     #@+node:ekr.20060919104836: *4*  fc.Reading Top-level
     #@+node:ekr.20070919133659.1: *5* fc.checkLeoFile
@@ -585,8 +755,10 @@ class FileCommands(object):
             self.usingClipboard = False
         # Restore the hidden root's children
         c.hiddenRootNode.children = children
+        c.frame.tree.generation += 1
         # Unlink v from the hidden root.
         v.parents.remove(c.hiddenRootNode)
+        v.dataChanged()
         p = leoNodes.Position(v)
         # Important: we must not adjust links when linking v
         # into the outline.  The read code has already done that.
@@ -1022,8 +1194,10 @@ class FileCommands(object):
                 self.createSaxChildren(sax_child, v)
             children.append(v)
         parent_v.children = children
+        parent_v.dataChanged()
         for child in children:
             child.parents.append(parent_v)
+            child.dataChanged()
             if trace: g.trace(
                 '*** added parent', parent_v, 'to', child,
                 'len(child.parents)', len(child.parents))
@@ -1358,17 +1532,34 @@ class FileCommands(object):
            method follows behavior of readSaxFile.'''
 
         fc = self; c = fc.c
-        sql = '''select gnx, head, 
-             body,
-             children,
-             parents,
-             iconVal,
-             statusBits,
-             ua from vnodes'''
+        lazy = c.config.getBool('sqlite-lazy-load', default=False)
+        if lazy:
+            # Read body text and uA's only when needed. See class DbVNode.
+            if fc.dbLoader:
+                fc.dbLoader.close()
+            fc.dbLoader = loader = DbBodyLoader(c.mFileName,
+                c.config.getInt('sqlite-max-resident-bodies') or 10000)
+            sql = '''select gnx, head,
+                 null,
+                 children,
+                 parents,
+                 iconVal,
+                 statusBits,
+                 null from vnodes'''
+        else:
+            sql = '''select gnx, head,
+                 body,
+                 children,
+                 parents,
+                 iconVal,
+                 statusBits,
+                 ua from vnodes'''
         vnodes = []
+        rows = {}
         try:
 
             for row in conn.execute(sql):
+                rows[row[0]] = row
                 (gnx,
                     h,
                     b,
@@ -1377,18 +1568,21 @@ class FileCommands(object):
                     iconVal,
                     statusBits,
                     ua) = row
-                try:
-                    ua = pickle.loads(g.toEncodedString(ua))
-                except ValueError:
-                    ua = None
-                v = leoNodes.VNode(context=c, gnx=gnx)
+                if lazy:
+                    v = DbVNode(context=c, gnx=gnx, loader=loader)
+                else:
+                    try:
+                        ua = pickle.loads(g.toEncodedString(ua))
+                    except ValueError:
+                        ua = None
+                    v = leoNodes.VNode(context=c, gnx=gnx)
+                    v._bodyString = b
+                    v.u = ua
                 v._headString = h
-                v._bodyString = b
                 v.children = children.split()
                 v.parents = parents.split()
                 v.iconVal = iconVal
                 v.statusBits = statusBits
-                v.u = ua
                 vnodes.append(v)
 
         except sqlite3.Error as er:
@@ -1402,6 +1596,7 @@ class FileCommands(object):
         if not rootChildren:
             g.trace('there should be at least one top level node!')
             return None
+        rootChildren = fc.sortRootChildrenFromDb(conn, rootChildren)
 
         findNode = lambda x: fc.gnxDict.get(x, c.hiddenRootNode)
 
@@ -1410,18 +1605,44 @@ class FileCommands(object):
             v.children = [findNode(x) for x in v.children]
             v.parents = [findNode(x) for x in v.parents]
         c.hiddenRootNode.children = rootChildren
+        c.frame.tree.generation += 1
         (w, h, x, y, r1, r2, encp) = fc.getWindowGeometryFromDb(conn)
         c.frame.setTopGeometry(w, h, x, y, adjustSize=True)
         c.frame.resizePanesToRatio(r1, r2)
         p = fc.decodePosition(encp)
         c.setCurrentPosition(p)
+        # Remember what is in the db, so that fc.exportToSqlite can
+        # write only the rows that change.
+        fc.setDbRows(c.mFileName, rows)
         return rootChildren[0]
+    #@+node:ekr.20170817063412.1: *6* fc.sortRootChildrenFromDb
+    def sortRootChildrenFromDb(self, conn, rootChildren):
+        '''
+        Return rootChildren in outline order.
+
+        Incremental writes replace rows in place, so the order of rows in the
+        vnodes table need not be the outline order of top-level nodes.
+        '''
+        try:
+            row = conn.execute(
+                'select value from extra_infos where name = ?',
+                ('root_children',)).fetchone()
+        except sqlite3.OperationalError:
+            row = None
+        if not row:
+            return rootChildren # An old db: rows are in outline order.
+        d = dict((v.gnx, v) for v in rootChildren)
+        result = [d.pop(gnx) for gnx in row[0].split() if gnx in d]
+        # Defensive: keep any top-level node missing from root_children.
+        result.extend([v for v in rootChildren if v.gnx in d])
+        return result
     #@+node:vitalije.20170815162307.1: *6* fc.initNewDb
     def initNewDb(self, conn):
         ''' Initializes tables and returns None'''
         fc = self; c = self.c
         v = leoNodes.VNode(context=c)
         c.hiddenRootNode.children = [v]
+        c.frame.tree.generation += 1
         (w, h, x, y, r1, r2, encp) = fc.getWindowGeometryFromDb(conn)
         c.frame.setTopGeometry(w, h, x, y, adjustSize=True)
         c.frame.resizePanesToRatio(r1, r2)
@@ -1509,6 +1730,8 @@ class FileCommands(object):
                     c.sqlite_connection.close()
                     c.sqlite_connection = None
                 ok = self.write_Leo_file(fileName, False) # outlineOnlyFlag
+                c.cacher.commit(close=False)
+                    # Commit the cached globals in one transaction.
             if ok:
                 if not silent:
                     self.putSavedMessage(fileName)
@@ -1538,6 +1761,7 @@ class FileCommands(object):
                     self.putSavedMessage(fileName)
             finally:
                 c.ignoreChangedPaths = True
+                c.cacher.commit(close=False)
             c.redraw_after_icons_changed()
         g.doHook("save2", c=c, p=p, v=p, fileName=fileName)
     #@+node:ekr.20031218072017.3044: *5* fc.saveTo
@@ -1557,6 +1781,7 @@ class FileCommands(object):
                 self.write_Leo_file(fileName, outlineOnlyFlag=False)
             finally:
                 c.ignoreChangedPaths = False
+                c.cacher.commit(close=False)
             self.putSavedMessage(fileName)
             c.redraw_after_icons_changed()
         g.doHook("save2", c=c, p=p, v=p, fileName=fileName)
@@ -1773,16 +1998,16 @@ class FileCommands(object):
         '''Put all referenced tnodes.'''
         c = self.c
         if self.usingClipboard: # write the current tree.
-            theIter = c.p.self_and_subtree()
+            theIter = c.walk_nodes(root=c.p)
         else: # write everything
-            theIter = c.all_unique_positions()
+            theIter = c.walk_nodes(unique=True)
         # Populate tnodes
         tnodes = {}
-        for p in theIter:
+        for v, level, childIndex in theIter:
             # Make *sure* the file index has the proper form.
             # pylint: disable=unbalanced-tuple-unpacking
-            index = p.v.fileIndex
-            tnodes[index] = p.v
+            index = v.fileIndex
+            tnodes[index] = v
         # Put all tnodes in index order.
         for index in sorted(tnodes):
             # g.trace(index)
@@ -1946,6 +2171,9 @@ class FileCommands(object):
         if g.SQLITE and fileName and fileName.endswith('.db'):
             return fc.exportToSqlite(fileName)
 
+        if fc.dbLoader and not toString:
+            fc.detachDbLoader()
+
         try:
             fc.putCount = 0
             fc.toString = toString
@@ -2113,42 +2341,176 @@ class FileCommands(object):
         theFile.close()
     #@+node:vitalije.20170630172118.1: *5* fc.exportToSqlite
     def exportToSqlite(self, fileName):
-        '''Dump all vnodes to sqlite database. Returns True on success.'''
-        # fc = self
+        '''
+        Dump all vnodes to sqlite database. Returns True on success.
+
+        When @bool sqlite-incremental-save is True and fc.dbRows describes
+        the db, compute and write only the rows of the vnodes in fc.dbChanged,
+        and delete the rows of deleted vnodes. The cost of such saves is
+        proportional to the number of changed vnodes, not to the size of
+        the outline.
+
+        All changes happen in a single transaction, so sqlite's rollback
+        journal guarantees that an interrupted save leaves the db unchanged.
+        '''
+        trace = False and not g.unitTesting
         c = self.c; fc = self
         if c.sqlite_connection is None:
-            c.sqlite_connection = sqlite3.connect(fileName, 
+            c.sqlite_connection = sqlite3.connect(fileName,
                                         isolation_level='DEFERRED')
         conn = c.sqlite_connection
+        empty_u = pickle.dumps({}, protocol=1)
         def dump_u(v):
+            if not getattr(v, 'unknownAttributes', None):
+                return empty_u
             try:
                 s = pickle.dumps(v.u, protocol=1)
             except pickle.PicklingError:
                 s = ''
                 g.trace('unpickleable value', repr(v.u))
             return s
+        incremental = (
+            fc.dbRows is not None and
+            fc.dbFileName == fileName and
+            c.config.getBool('sqlite-incremental-save', default=True))
+        loader = fc.dbLoader
+        if loader and loader.fileName != fileName:
+            fc.detachDbLoader()
+            loader = None
+        lazy = loader and incremental
+        def db_body(v):
+            # None: don't read the (unchanged) body from the db.
+            if lazy and isinstance(v, DbVNode):
+                return v.dbBody()
+            return v.b
+        def db_u(v):
+            # None: don't read the (unchanged) uA's from the db.
+            if lazy and isinstance(v, DbVNode) and v.dbUa():
+                return None
+            return dump_u(v)
+        # Other status bits are not saved, so changing them does not
+        # call v.dataChanged.
+        savedBits = leoNodes.VNode.clonedBit | leoNodes.VNode.expandedBit | leoNodes.VNode.markedBit
         dbrow = lambda v:(
                 v.gnx,
                 v.h,
-                v.b,
+                db_body(v),
                 ' '.join(x.gnx for x in v.children),
                 ' '.join(x.gnx for x in v.parents),
                 v.iconVal,
-                v.statusBits,
-                dump_u(v)
+                v.statusBits & savedBits,
+                db_u(v)
             )
+        if incremental:
+            vnodes, deleted = fc.computeDbChanges()
+        else:
+            vnodes, deleted = list(c.all_unique_nodes()), []
+        rows = dict((v.gnx, dbrow(v)) for v in vnodes)
         ok = False
+        # Manage the transaction explicitly. Otherwise the sqlite3 module
+        # may commit before the "drop table" in fc.prepareDbTables.
+        conn.isolation_level = None
         try:
-            fc.prepareDbTables(conn)
+            conn.execute('begin immediate')
+            if incremental:
+                n = fc.exportChangedVnodesToSqlite(conn, rows, deleted)
+            else:
+                fc.prepareDbTables(conn)
+                fc.exportVnodesToSqlite(conn, rows.values())
+                n = len(rows)
             fc.exportDbVersion(conn)
-            fc.exportVnodesToSqlite(conn, (dbrow(v) for v in c.all_unique_nodes()))
+            fc.exportRootChildrenToSqlite(conn)
             fc.exportGeomToSqlite(conn)
             fc.exportHashesToSqlite(conn)
-            conn.commit()
+            conn.execute('commit')
             ok = True
-        except sqlite3.Error as e:
-            g.internalError(e)
+            if trace: g.trace('incremental: %s wrote %s of %s changed rows' % (
+                incremental, n, len(rows) + len(deleted)))
+        except Exception as e:
+            try:
+                conn.execute('rollback')
+            except sqlite3.Error:
+                pass # No transaction is active.
+            if isinstance(e, sqlite3.Error):
+                g.internalError(e)
+            else:
+                g.es_exception()
+        finally:
+            conn.isolation_level = 'DEFERRED'
+        if ok:
+            if loader:
+                # All bodies are now in the db.
+                for v in vnodes:
+                    if isinstance(v, DbVNode):
+                        v.bodySaved()
+                        row = rows[v.gnx]
+                        if row[2] is not None:
+                            rows[v.gnx] = row[:2] + (None,) + row[3:]
+            if incremental:
+                fc.dbRows.update(rows)
+                for gnx in deleted:
+                    del fc.dbRows[gnx]
+                fc.dbChanged.clear()
+            else:
+                fc.setDbRows(fileName, rows)
+        else:
+            fc.setDbRows(None, None)
         return ok
+    #@+node:ekr.20170823150000.5: *6* fc.computeDbChanges & setDbRows
+    def computeDbChanges(self):
+        '''
+        Return (vnodes, deleted): the vnodes in the outline whose rows may
+        differ from fc.dbRows, and the gnxs of the rows of vnodes that are
+        no longer in the outline.
+
+        Only the vnodes in fc.dbChanged and the vnodes that their old rows
+        list as children are examined.
+        '''
+        fc = self; c = fc.c
+        old_rows = fc.dbRows
+        d = {c.hiddenRootNode: True}
+            # Keys are vnodes, values are True if the vnode is in the outline.
+
+        def inOutline(v):
+            val = d.get(v)
+            if val is None:
+                d[v] = False # Defensive: break cycles.
+                val = d[v] = any(v in parent.children and inOutline(parent)
+                    for parent in v.parents)
+            return val
+
+        vnodes, deleted, seen = [], [], set()
+        todo = [(v.gnx, v) for v in fc.dbChanged]
+        while todo:
+            gnx, v = todo.pop()
+            if gnx in seen:
+                continue
+            seen.add(gnx)
+            old = old_rows.get(gnx)
+            if v and v is not c.hiddenRootNode and inOutline(v):
+                vnodes.append(v)
+                # Children removed from v may have left the outline.
+                gnxs = set(old[3].split()) - set(z.gnx for z in v.children) if old else []
+            elif old:
+                deleted.append(gnx)
+                gnxs = old[3].split()
+            else:
+                gnxs = []
+            todo.extend((z, fc.gnxDict.get(z)) for z in gnxs)
+        return vnodes, deleted
+
+    def setDbRows(self, fileName, rows):
+        '''
+        Remember that rows are the rows of the vnodes table of fileName,
+        and track the vnodes whose rows change from now on.
+        rows is None: forget the db and stop tracking.
+        '''
+        fc = self; c = fc.c
+        c.dataChangedSets[:] = [z for z in c.dataChangedSets if z is not fc.dbChanged]
+        fc.dbFileName, fc.dbRows = fileName, rows
+        fc.dbChanged = set()
+        if rows is not None:
+            c.dataChangedSets.append(fc.dbChanged)
     #@+node:vitalije.20170705075107.1: *6* fc.decodePosition
     def decodePosition(self, s):
         '''Creates position from its string representation encoded by fc.encodePosition.'''
@@ -2190,6 +2552,57 @@ class FileCommands(object):
             (gnx, head, body, children, parents,
                 iconVal, statusBits, ua)
             values(?,?,?,?,?,?,?,?);''', rows)
+    #@+node:ekr.20170817063412.2: *6* fc.exportChangedVnodesToSqlite
+    def exportChangedVnodesToSqlite(self, conn, rows, deleted):
+        '''
+        Write only the rows that differ from fc.dbRows and delete the rows
+        whose gnxs are in deleted. Return the number of affected rows.
+
+        A None body or ua field means that the field in the db is unchanged.
+        '''
+        fc = self
+        old_rows = fc.dbRows
+        changed = [row for gnx, row in rows.items() if old_rows.get(gnx) != row]
+        deleted = [(gnx,) for gnx in deleted]
+        for gnx, in deleted:
+            # Undo may resurrect the deleted node.
+            v = fc.gnxDict.get(gnx)
+            if isinstance(v, DbVNode):
+                v.load()
+        conn.executemany('''replace into vnodes
+            (gnx, head, body, children, parents,
+                iconVal, statusBits, ua)
+            values(?,?,?,?,?,?,?,?);''',
+            [row for row in changed if row[2] is not None and row[7] is not None])
+        columns = ('head', 'body', 'children', 'parents', 'iconVal', 'statusBits', 'ua')
+        for row in changed:
+            if row[2] is None or row[7] is None:
+                aList = [(name, val) for name, val in zip(columns, row[1:]) if val is not None]
+                conn.execute('update vnodes set %s where gnx = ?' % (
+                    ', '.join(['%s = ?' % name for name, val in aList])),
+                    [val for name, val in aList] + [row[0]])
+        conn.executemany('delete from vnodes where gnx = ?', deleted)
+        return len(changed) + len(deleted)
+    #@+node:ekr.20170817063412.3: *6* fc.exportRootChildrenToSqlite
+    def exportRootChildrenToSqlite(self, conn):
+        '''Write the order of top-level nodes. See fc.sortRootChildrenFromDb.'''
+        gnxs = ' '.join(v.gnx for v in self.c.hiddenRootNode.children)
+        conn.execute(
+            "replace into extra_infos(name, value) values('root_children', ?)",
+            (gnxs,))
+    #@+node:ekr.20170818091524.12: *6* fc.detachDbLoader
+    def detachDbLoader(self):
+        '''
+        Read all remaining body text and uA's from fc.dbLoader's db,
+        then close the loader. Called when writing the outline elsewhere.
+        '''
+        fc = self
+        if fc.dbLoader:
+            for v in list(fc.gnxDict.values()):
+                if isinstance(v, DbVNode):
+                    v.load()
+            fc.dbLoader.close()
+            fc.dbLoader = None
     #@+node:vitalije.20170701162052.1: *6* fc.exportGeomToSqlite
     def exportGeomToSqlite(self, conn):
         c = self.c
@@ -2218,17 +2631,22 @@ class FileCommands(object):
             s = s.replace(b'\r\n', b'\n')
             return hashlib.md5(s).hexdigest()
         files = set()
-
-        p = c.rootPosition()
-        while p:
-            if p.isAtIgnoreNode():
-                p.moveToNodeAfterTree()
-            elif p.isAtAutoNode() or p.isAtFileNode():
+        # Use an index of @<file> nodes: walking the outline would
+        # check (and load) the body of every node for @ignore.
+        efc = g.app.externalFilesController
+        if efc:
+            index = efc.get_index(c)
+        else:
+            if not self.atFileIndex:
+                self.atFileIndex = leoExternalFiles.AtFileIndex(c)
+            index = self.atFileIndex
+        for entry in index.get_entries():
+            p = entry.p
+            if ((p.isAtAutoNode() or p.isAtFileNode()) and
+                not any(z.isAtIgnoreNode() for z in p.self_and_parents())
+            ):
                 fn = c.getNodeFileName(p)
                 files.add((fn, 'md5_'+p.gnx))
-                p.moveToNodeAfterTree()
-            else:
-                p.moveToThreadNext()
         # pylint: disable=deprecated-lambda
         conn.executemany(
             'replace into extra_infos(name, value) values(?,?)',
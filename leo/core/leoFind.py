@@ -2,6 +2,7 @@
 #@+node:ekr.20060123151617: * @file leoFind.py
 '''Leo's gui-independent find classes.'''
 import leo.core.leoGlobals as g
+import copy
 import keyword
 import re
 import time
@@ -136,6 +137,8 @@ class LeoFind(object):
 
         # Options ivars: set once:
         self.ignore_dups = c.config.getBool('find-ignore-duplicates', default=False)
+        self.use_search_index = c.config.getBool('find-use-search-index', default=False)
+        self.find_all_in_background = c.config.getBool('find-all-in-background', default=True)
 
         # Options ivars: set by FindTabManager.init.
         self.batch = None
@@ -178,11 +181,24 @@ class LeoFind(object):
         self.buttonFlag = False
         self.changeAllFlag = False
         self.findAllFlag = False
+        self.findAllJob = None
+            # The find-all command running in the background, a g.Bunch.
+        self.findAllSlice = 0.05
+            # The length of each slice of a background find-all, in seconds.
         self.in_headline = False
             # True: searching headline text.
         self.p = None
             # The position being searched.
             # Never saved between searches!
+        self.searchCandidates = None
+            # Batch commands only: the set of vnodes that might match, or None.
+        self.searchContainers = None
+            # Batch commands only: the set of ancestors of searchCandidates.
+        self.searchIgnoreCandidates = None
+            # Batch commands only: the set of vnodes that might be @ignore
+            # or @nosearch nodes, or None.
+        self.searchIndex = None
+            # A SearchIndex, created when first needed.
         self.previous_find_pattern = ''
             # The previous find pattern, used to disable auto-setting ignore-case.
         self.was_in_headline = None
@@ -1357,6 +1373,120 @@ class LeoFind(object):
                 'Change Headline' if self.in_headline else 'Change Body',
                 undoData,
             )
+    #@+node:ekr.20170822093015.1: *4* find.batchChangeAll & helpers
+    def batchChangeAll(self):
+        '''
+        Replace all matches in the search range, changing each vnode at most
+        once and creating one undo bead per changed node.
+
+        Return the number of replaced matches.
+        '''
+        c, u = self.c, self.c.undoer
+        candidates = self.searchCandidates
+        count, seen = 0, set()
+        for p in self.batchChangePositions():
+            v = p.v
+            if v in seen:
+                continue # Change clones only once.
+            seen.add(v)
+            if candidates is not None and v not in candidates:
+                continue
+            h, n1 = self.batchReplace(p.h) if self.search_headline else (p.h, 0)
+            b, n2 = self.batchReplace(p.b) if self.search_body else (p.b, 0)
+            count += n1 + n2
+            if h == p.h and b == p.b:
+                continue
+            undoData = u.beforeChangeNodeContents(p)
+            if h != p.h:
+                p.initHeadString(h)
+            if b != p.b:
+                # Fix #456: replace-all is very slow.
+                # p.b calls c.setBodyString, which is *very* slow.
+                p.v.setBodyString(b)
+            if self.mark_changes:
+                p.setMarked() # Just calls v.setMarked.
+            p.v.setDirty()
+            if not c.isChanged():
+                c.setChanged(True)
+            u.afterChangeNodeContents(
+                p,
+                'Change Body' if b != undoData.oldBody else 'Change Headline',
+                undoData,
+            )
+        return count
+    #@+node:ekr.20170822093015.2: *5* find.batchChangePositions
+    def batchChangePositions(self):
+        '''Return an iterator over all positions in the search range.'''
+        c = self.c
+        if self.node_only:
+            return [self.p or c.p]
+        if self.suboutline_only:
+            return (self.p or c.p).self_and_subtree()
+        if c.hoistStack:
+            return c.hoistStack[-1].p.self_and_subtree()
+        return c.all_positions()
+    #@+node:ekr.20170822093015.3: *5* find.batchReplace
+    def batchReplace(self, s):
+        '''
+        Return (s2, n): s with all n matches of the find pattern replaced by
+        self.change_text. Find all matches in a single pass over s.
+        '''
+        if not s:
+            return s, 0
+        if self.pattern_match:
+            return self.batchReplaceRegex(s)
+        s2 = s
+        pattern = self.replaceBackSlashes(self.find_text)
+        if not pattern:
+            return s, 0
+        if self.ignore_case:
+            s2 = s.lower()
+            if len(s2) == len(s):
+                pattern = pattern.lower()
+            else:
+                # Lowering changed the length of s. Lower each character
+                # separately so indices into s2 are valid indices into s.
+                s2 = ''.join([ch.lower()[0] for ch in s])
+                pattern = ''.join([ch.lower()[0] for ch in pattern])
+        change, n = self.change_text, len(pattern)
+        result, i, count = [], 0, 0
+        k = s2.find(pattern)
+        while k != -1:
+            if self.whole_word and not self.matchWord(s2, k, pattern):
+                k = s2.find(pattern, k + n)
+                continue
+            result.append(s[i: k])
+            result.append(change)
+            count += 1
+            i = k + n
+            k = s2.find(pattern, i)
+        if not count:
+            return s, 0
+        result.append(s[i:])
+        return ''.join(result), count
+
+    def batchReplaceRegex(self, s):
+        '''
+        Return (s2, n): s with all n matches of self.re_obj replaced by
+        self.change_text, with \\1...\\9 replaced by the matched groups.
+        Like regexHelper, ignore empty matches.
+        '''
+        result, i, count = [], 0, 0
+        for mo in self.re_obj.finditer(s):
+            if mo.start() == mo.end():
+                continue
+            change = self.change_text
+            groups = mo.groups('')
+            if groups:
+                change = self.makeRegexSubs(change, groups)
+            result.append(s[i: mo.start()])
+            result.append(change)
+            count += 1
+            i = mo.end()
+        if not count:
+            return s, 0
+        result.append(s[i:])
+        return ''.join(result), count
     #@+node:ekr.20031218072017.3068: *4* find.change
     @cmd('replace')
     def change(self, event=None):
@@ -1382,14 +1512,23 @@ class LeoFind(object):
         # Fix bug 338172: ReplaceAll will not replace newlines
         # indicated as \n in target string.
         self.change_text = self.replaceBackSlashes(self.change_text)
-        while 1:
-            pos1, pos2 = self.findNextMatch()
-            if pos1 is None:
-                if trace: g.trace('findNextMatch failed')
-                break
-            if trace: g.trace(pos1, pos2, self.p and self.p.h)
-            count += 1
-            self.batchChange(pos1, pos2)
+        self.initSearchCandidates()
+        try:
+            if self.reverse:
+                # Replace matches one at a time, from the end.
+                while 1:
+                    pos1, pos2 = self.findNextMatch()
+                    if pos1 is None:
+                        if trace: g.trace('findNextMatch failed')
+                        break
+                    if trace: g.trace(pos1, pos2, self.p and self.p.h)
+                    count += 1
+                    self.batchChange(pos1, pos2)
+            elif not self.pattern_match or self.precompilePattern():
+                # Replace all matches in each node at once.
+                count = self.batchChangeAll()
+        finally:
+            self.clearSearchCandidates()
         p = c.p
         u.afterChangeGroup(p, undoType, reportFlag=True)
         t2 = time.clock()
@@ -1518,6 +1657,10 @@ class LeoFind(object):
         return found
     #@+node:ekr.20031218072017.3073: *4* find.findAll & helpers
     def findAll(self, clone_find_all=False, clone_find_all_flattened=False):
+        '''
+        Handle the find-all, clone-find-all and clone-find-all-flattened
+        commands. Cancel any find-all command still running in the background.
+        '''
         trace = False and not g.unitTesting
         c, flatten = self.c, clone_find_all_flattened
         clone_find = clone_find_all or flatten
@@ -1527,6 +1670,7 @@ class LeoFind(object):
             undoType = 'Clone Find All'
         else:
             undoType = 'Find All'
+        self.cancelFindAll()
         if not self.checkArgs():
             return
         self.initInHeadline()
@@ -1546,45 +1690,224 @@ class LeoFind(object):
             # Always search the entire outline.
             p = c.rootPosition()
             after = None
+        try:
+            self.initSearchCandidates()
+            if not clone_find:
+                self.p = p
+            job = self.createFindAllJob(after, data, flatten, p, undoType, clone_find)
+        finally:
+            self.clearSearchCandidates()
+        self.startFindAllJob(job)
+    #@+node:ekr.20170822104521.1: *5* find.createFindAllJob
+    def createFindAllJob(self, after, data, flatten, p, undoType, clone_find):
+        '''
+        Return a g.Bunch describing a find-all or clone-find-all command
+        that will search from p to after.
+
+        job.finder is a shallow copy of self with its own search widget, so
+        the job is not affected by later changes to the find settings or by
+        other find commands.
+        '''
+        c = self.c
+        finder = copy.copy(self)
+        w = self.s_ctrl
+        finder.s_ctrl = w2 = SearchWidget()
+        w2.s, w2.i, w2.sel = w.s, w.i, w.sel
+        return g.Bunch(
+            after=after,
+            background=False,
+                # True: the job is running in idle-time slices.
+            cancelled=False,
+            clone_find=clone_find,
+            clones=[],
+                # Clone-find-all: the positions of all matching nodes.
+            count=0,
+            data=data,
+            done=False,
+            finder=finder,
+            find_text=self.find_text,
+            flatten=flatten,
+            found=None,
+                # The "Found" node, created when the first match is flushed.
+            nFlushed=0,
+                # Clone-find-all: the number of clones linked to the found node.
+            p=p.copy(),
+                # Clone-find-all: the position being searched.
+            result=[],
+                # Find-all: lines not yet added to the found node.
+            skip=set(),
+                # Clone-find-all: vnodes that need not be searched.
+            startPosition=c.p.copy(),
+            timer=None,
+            undoType=undoType,
+        )
+    #@+node:ekr.20170822104521.2: *5* find.startFindAllJob & runFindAllJob
+    def startFindAllJob(self, job):
+        '''
+        Start the find-all job created by self.createFindAllJob.
+
+        The first slice runs at once. If the job is not done after that and
+        the find-all-in-background setting is True, the rest of the job runs
+        in idle-time slices, adding matches to the found node as they are
+        found. Otherwise, the job runs to completion immediately.
+        '''
+        self.findAllJob = job
+        if self.runFindAllJob(job, self.findAllSlice):
+            self.finishFindAllJob(job)
+            return
+        if self.find_all_in_background and not g.unitTesting:
+
+            def findAllHandler(timer, job=job):
+                if job is not self.findAllJob:
+                    timer.stop()
+                elif self.runFindAllJob(job, self.findAllSlice):
+                    self.finishFindAllJob(job)
+
+            timer = g.IdleTime(findAllHandler, delay=0, tag='find-all')
+            if timer:
+                job.background = True
+                job.timer = timer
+                timer.start()
+                return
+        while not self.runFindAllJob(job):
+            pass
+        self.finishFindAllJob(job)
+
+    def runFindAllJob(self, job, budget=None):
+        '''
+        Search for at most budget seconds (None: no limit), then add all new
+        matches to the found node and call the find-all-progress hook.
+        Return True if the job is finished.
+        '''
+        c = self.c
+        if not c.exists:
+            job.cancelled = True
+            return True
+        if not self.validFindAllJob(job):
+            g.es('outline changed: find-all stopped')
+            job.cancelled = True
+            return True
+        step = self.doCloneFindAllStep if job.clone_find else self.doFindAllStep
+        t1 = time.time()
         # Fix #292: Never collapse nodes during find-all commands.
         old_sparse_find = c.sparse_find
         try:
             c.sparse_find = False
-            if clone_find:
-                count = self.doCloneFindAll(after, data, flatten, p, undoType)
+            while step(job):
+                if budget is not None and time.time() - t1 > budget:
+                    break
             else:
-                self.p = p
-                count = self.doFindAll(after, data, p, undoType)
-            # c.contractAllHeadlines()
+                job.done = True
+        except Exception:
+            g.es_exception()
+            job.cancelled = True
+            return True
         finally:
             c.sparse_find = old_sparse_find
-        if count:
-            c.redraw()
-        g.es("found", count, "matches for", self.find_text)
-    #@+node:ekr.20160422072841.1: *5* find.doCloneFindAll & helpers
-    def doCloneFindAll(self, after, data, flatten, p, undoType):
-        '''Handle the clone-find-all command, from p to after.'''
+        self.flushFindAllResults(job)
+        if g.doHook('find-all-progress', c=c, count=job.count,
+            done=job.done, find_text=job.find_text
+        ) and not job.done:
+            # A hook handler asked to stop the search.
+            job.cancelled = True
+        return job.done or job.cancelled
+
+    def validFindAllJob(self, job):
+        '''Return True if the positions used by job still exist.'''
+        c = self.c
+        p = job.p if job.clone_find else job.finder.p
+        if p and not c.positionExists(p):
+            return False
+        return not job.found or c.positionExists(job.found)
+    #@+node:ekr.20170822104521.3: *5* find.flushFindAllResults
+    def flushFindAllResults(self, job):
+        '''Add all new matches to the found node, creating it if necessary.'''
         c, u = self.c, self.c.undoer
-        count, found = 0, None
-        # 535: positions are not hashable, but vnodes are.
-        clones, skip = [], set()
-        while p and p != after:
-            progress = p.copy()
-            if p.v in skip:
-                p.moveToThreadNext()
+        finder = job.finder
+        if job.clone_find:
+            clones = job.clones[job.nFlushed:]
+            if not clones:
+                return
+            job.nFlushed = len(job.clones)
+            if job.found:
+                for p in clones:
+                    p2 = p.copy()
+                    p2._linkAsNthChild(job.found, job.found.numberOfChildren(), adjust=False)
+                finder.setCloneFindAllBody(job.found, len(job.clones), job.flatten)
             else:
-                count = self.doCloneFindAllHelper(clones, count, flatten, p, skip)
-            assert p != progress
-        if clones:
-            undoData = u.beforeInsertNode(c.p)
-            found = self.createCloneFindAllNodes(clones, flatten)
-            u.afterInsertNode(found, undoType, undoData, dirtyVnodeList=[])
-            assert c.positionExists(found, trace=True), found
-            c.setChanged(True)
-            c.selectPosition(found)
+                undoData = u.beforeInsertNode(c.p)
+                job.found = finder.createCloneFindAllNodes(clones, job.flatten)
+                u.afterInsertNode(job.found, job.undoType, undoData, dirtyVnodeList=[])
+                assert c.positionExists(job.found, trace=True), job.found
         else:
-            self.restore(data)
-        return count
+            result, job.result = job.result, []
+            if not result:
+                return
+            if job.found:
+                job.found.b = job.found.b + ''.join(result)
+            else:
+                undoData = u.beforeInsertNode(c.p)
+                job.found = finder.createFindAllNode(result)
+                u.afterInsertNode(job.found, job.undoType, undoData, dirtyVnodeList=[])
+        c.setChanged(True)
+        if job.background:
+            c.redraw()
+    #@+node:ekr.20170822104521.4: *5* find.finishFindAllJob & cancelFindAll
+    def finishFindAllJob(self, job):
+        '''Report the results of a finished or cancelled find-all job.'''
+        c = self.c
+        if job.timer:
+            job.timer.stop()
+            job.timer = None
+        if job is self.findAllJob:
+            self.findAllJob = None
+        if not c.exists:
+            return
+        # Don't change the selection if the user has moved since the search started.
+        moved = job.background and c.p != job.startPosition
+        found = job.found
+        if found and c.positionExists(found):
+            if not moved:
+                c.selectPosition(found)
+            c.redraw()
+        elif not moved:
+            self.restore(job.data)
+        if job.cancelled:
+            g.es("found", job.count, "matches for", job.find_text, "(cancelled)")
+        else:
+            g.es("found", job.count, "matches for", job.find_text)
+
+    @cmd('find-all-cancel')
+    def cancelFindAll(self, event=None):
+        '''
+        Stop the find-all or clone-find-all command running in the background,
+        keeping the matches found so far.
+        '''
+        job = self.findAllJob
+        if job:
+            job.cancelled = True
+            self.finishFindAllJob(job)
+    #@+node:ekr.20160422072841.1: *5* find.doCloneFindAllStep & helpers
+    def doCloneFindAllStep(self, job):
+        '''
+        Handle one node for the clone-find-all commands.
+        Return False when the search is done.
+        '''
+        finder, p = job.finder, job.p
+        if not p or p == job.after:
+            return False
+        if job.found and p.v == job.found.v:
+            # Don't search the found node.
+            return False
+        progress = p.copy()
+        # 535: positions are not hashable, but vnodes are.
+        if p.v in job.skip:
+            p.moveToThreadNext()
+        else:
+            job.count = finder.doCloneFindAllHelper(
+                job.clones, job.count, job.flatten, p, job.skip)
+        assert p != progress
+        return True
     #@+node:ekr.20141023110422.1: *6* find.createCloneFindAllNodes
     def createCloneFindAllNodes(self, clones, flattened):
         '''
@@ -1598,10 +1921,7 @@ class LeoFind(object):
         assert found
         assert c.positionExists(found), found
         found.h = 'Found:%s' % self.find_text
-        status = self.getFindResultStatus(find_all=True)
-        status = status.strip().lstrip('(').rstrip(')').strip()
-        flat = 'flattened, ' if flattened else ''
-        found.b = '# %s%s\n\n# found %s nodes' % (flat, status, len(clones))
+        self.setCloneFindAllBody(found, len(clones), flattened)
         # Clone nodes as children of the found node.
         for p in clones:
             # Create the clone directly as a child of found.
@@ -1609,13 +1929,30 @@ class LeoFind(object):
             n = found.numberOfChildren()
             p2._linkAsNthChild(found, n, adjust=False)
         return found
+    #@+node:ekr.20170822104521.5: *6* find.setCloneFindAllBody
+    def setCloneFindAllBody(self, found, n, flattened):
+        '''Set the body of the "Found" node for n cloned nodes.'''
+        status = self.getFindResultStatus(find_all=True)
+        status = status.strip().lstrip('(').rstrip(')').strip()
+        flat = 'flattened, ' if flattened else ''
+        found.b = '# %s%s\n\n# found %s nodes' % (flat, status, n)
     #@+node:ekr.20160422071747.1: *6* find.doCloneFindAllHelper
     def doCloneFindAllHelper(self, clones, count, flatten, p, skip):
         '''Handle the cff or cfa at node p.'''
         trace = False and not g.unitTesting
         verbose = False
         if trace and verbose: g.trace(p.h)
-        if p.is_at_ignore() or re.search(r'(^@|\n@)nosearch\b', p.b):
+        candidates = self.searchCandidates
+        if (candidates is not None and p.v not in candidates and
+            p.v not in self.searchContainers
+        ):
+            # Nothing in p's tree can match.
+            p.moveToNodeAfterTree()
+            return count
+        ignore = self.searchIgnoreCandidates
+        if (ignore is None or p.v in ignore) and (
+            p.is_at_ignore() or re.search(r'(^@|\n@)nosearch\b', p.b)
+        ):
             if trace: g.trace('===== skipping tree', p.h)
             p.moveToNodeAfterTree()
             return count
@@ -1636,39 +1973,38 @@ class LeoFind(object):
         else:
             p.moveToThreadNext()
         return count
-    #@+node:ekr.20160422073500.1: *5* find.doFindAll & helpers
-    def doFindAll(self, after, data, p, undoType):
-        '''Handle the find-all command from p to after.'''
-        c, u, w = self.c, self.c.undoer, self.s_ctrl
-        both = self.search_body and self.search_headline
-        count, found, result = 0, None, []
-        while 1:
-            pos, newpos = self.findNextMatch()
-            if not self.p: self.p = c.p
-            if pos is None: break
-            count += 1
-            s = w.getAllText()
-            i, j = g.getLine(s, pos)
-            line = s[i: j]
-            if both:
-                result.append('%s%s\n%s%s\n' % (
-                    '-' * 20, self.p.h,
-                    "head: " if self.in_headline else "body: ",
-                    line.rstrip()+'\n'))
-            elif self.p.isVisited():
-                result.append(line.rstrip()+'\n')
-            else:
-                result.append('%s%s\n%s' % ('-' * 20, self.p.h, line.rstrip()+'\n'))
-                self.p.setVisited()
-        if result:
-            undoData = u.beforeInsertNode(c.p)
-            found = self.createFindAllNode(result)
-            u.afterInsertNode(found, undoType, undoData, dirtyVnodeList=[])
-            c.selectPosition(found)
-            c.setChanged(True)
+    #@+node:ekr.20160422073500.1: *5* find.doFindAllStep & helpers
+    def doFindAllStep(self, job):
+        '''
+        Find the next match for the find-all command.
+        Return False when the search is done.
+        '''
+        finder = job.finder
+        c, w = self.c, finder.s_ctrl
+        both = finder.search_body and finder.search_headline
+        pos, newpos = finder.findNextMatch()
+        if not finder.p: finder.p = c.p
+        if pos is None:
+            return False
+        p = finder.p
+        if job.found and p.v == job.found.v:
+            # Don't search the found node.
+            return False
+        job.count += 1
+        s = w.getAllText()
+        i, j = g.getLine(s, pos)
+        line = s[i: j]
+        if both:
+            job.result.append('%s%s\n%s%s\n' % (
+                '-' * 20, p.h,
+                "head: " if finder.in_headline else "body: ",
+                line.rstrip()+'\n'))
+        elif p.isVisited():
+            job.result.append(line.rstrip()+'\n')
         else:
-            self.restore(data)
-        return count
+            job.result.append('%s%s\n%s' % ('-' * 20, p.h, line.rstrip()+'\n'))
+            p.setVisited()
+        return True
     #@+node:ekr.20150717105329.1: *6* find.createFindAllNode
     def createFindAllNode(self, result):
         '''Create a "Found All" node as the last node of the outline.'''
@@ -1684,6 +2020,8 @@ class LeoFind(object):
     def findNextBatchMatch(self, p):
         '''Find the next batch match at p.'''
         trace = False and not g.unitTesting
+        if self.searchCandidates is not None and p.v not in self.searchCandidates:
+            return False
         table = []
         if self.search_headline:
             table.append(p.h)
@@ -1695,6 +2033,64 @@ class LeoFind(object):
             pos, newpos = self.searchHelper(s, 0, len(s), self.find_text)
             if pos != -1: return True
         return False
+    #@+node:ekr.20170822081247.5: *4* find.init/clearSearchCandidates
+    def initSearchCandidates(self):
+        '''
+        Set self.searchCandidates and self.searchIgnoreCandidates for a
+        batch command if the find-use-search-index setting is True.
+        '''
+        c = self.c
+        self.clearSearchCandidates()
+        if not self.use_search_index or not self.find_text:
+            return
+        if not self.searchIndex:
+            self.searchIndex = SearchIndex(c)
+        index = self.searchIndex
+        if self.pattern_match:
+            pattern = self.find_text
+        else:
+            pattern = self.replaceBackSlashes(self.find_text)
+        candidates = index.candidates(pattern, regex=self.pattern_match)
+        if candidates is None:
+            return
+        containers, todo = set(), list(candidates)
+        while todo:
+            v = todo.pop()
+            for parent in v.parents:
+                if parent not in containers:
+                    containers.add(parent)
+                    todo.append(parent)
+        self.searchCandidates = candidates
+        self.searchContainers = containers
+        ignore = index.candidates('@ignore')
+        nosearch = index.candidates('@nosearch')
+        if ignore is not None and nosearch is not None:
+            self.searchIgnoreCandidates = ignore | nosearch
+
+    def clearSearchCandidates(self):
+        self.searchCandidates = None
+        self.searchContainers = None
+        self.searchIgnoreCandidates = None
+    #@+node:ekr.20170822081247.6: *4* find.nextSearchCandidate
+    def nextSearchCandidate(self, p):
+        '''
+        Return the first position at or after p (before p when searching
+        backward) that might match, or None. Skip entire subtrees that
+        contain no candidates when searching forward.
+        '''
+        candidates, containers = self.searchCandidates, self.searchContainers
+        while p and p.v not in candidates:
+            if self.reverse:
+                p = self.nextNodeAfterFail(p)
+                continue
+            p = p.copy()
+            if p.v in containers:
+                p.moveToThreadNext()
+            else:
+                p.moveToNodeAfterTree()
+            if p and self.outsideSearchRange(p):
+                p = None
+        return p
     #@+node:ekr.20031218072017.3074: *4* find.findNext & helper
     def findNext(self, initFlag=True):
         '''Find the next instance of the pattern.'''
@@ -1769,7 +2165,16 @@ class LeoFind(object):
         if self.pattern_match:
             ok = self.precompilePattern()
             if not ok: return None, None
+        candidates = self.searchCandidates
         while p:
+            if candidates is not None and p.v not in candidates:
+                # Skip all nodes that can not match.
+                attempts += 1
+                p = self.p = self.nextSearchCandidate(p)
+                if p:
+                    self.in_headline = self.firstSearchPane()
+                    self.initNextText()
+                continue
             pos, newpos = self.search()
             if self.errors:
                 g.trace('find errors')
@@ -2568,6 +2973,186 @@ class LeoFind(object):
         self.change_text = s
         if trace: g.trace('change', repr(s))
     #@-others
+#@+node:ekr.20170822081247.1: ** class SearchIndex
+class SearchIndex(object):
+    '''
+    An in-memory index of the words in all headlines and body texts.
+
+    Batch find commands use si.candidates to skip nodes that can not
+    contain a match. The exact matcher still checks all candidates, so
+    the index only has to return a superset of the matching vnodes.
+
+    Words are runs of word characters in case-folded text. The first query
+    indexes all nodes. v.textChanged adds new and changed vnodes to
+    si.changed, and later queries reindex only those vnodes.
+
+    The index never reads bodies that are still in a .db file (see
+    leoFileCommands.DbVNode): such nodes are candidates for every search
+    until their text changes. Deleted nodes remain in the index. This is
+    harmless: find commands visit only positions in the outline.
+    '''
+    word_pat = re.compile(r'\w+', re.UNICODE)
+    fold_table = {
+        0x0130: 0x69, # Capital I with dot above -> i.
+        0x0131: 0x69, # Small dotless i -> i.
+        0x017F: 0x73, # Long s -> s.
+        0x03C2: 0x03C3, # Final sigma -> sigma.
+    }
+    combining_dot = b'\\u0307'.decode('unicode_escape')
+    #@+others
+    #@+node:ekr.20170822081247.2: *3* si.ctor
+    def __init__(self, c):
+        '''Ctor for the SearchIndex class.'''
+        self.c = c
+        self.built = False
+            # True: all nodes have been indexed.
+        self.changed = set()
+            # Vnodes whose text has changed since the last update.
+        self.entries = {}
+            # Keys are vnodes, values are sets of words.
+        self.postings = {}
+            # Keys are words, values are sets of vnodes.
+        self.unloaded = set()
+            # Unindexed DbVNodes whose bodies have not been read.
+        c.textChangedSets.append(self.changed)
+    #@+node:ekr.20170822081247.3: *3* si.candidates & helpers
+    def candidates(self, pattern, regex=False):
+        '''
+        Return the set of vnodes whose headline or body text might contain
+        pattern, or None if the index can not narrow the search much.
+
+        pattern must be the actual text to find, with backslashes replaced.
+        regex: pattern is a regular expression.
+        '''
+        if regex:
+            pattern = self.regexLiteral(pattern)
+        s = self.fold(pattern)
+        if not s or self.combining_dot in s:
+            # Folding a combining dot above is not reliable.
+            return None
+        runs = [(m.group(0), m.start() == 0, m.end() == len(s))
+            for m in self.word_pat.finditer(s)]
+        if not runs:
+            return None
+        self.update()
+        postings = self.postings
+        limit = max(100, (len(self.entries) + len(self.unloaded)) // 2)
+            # Checking most nodes is faster than computing a large set.
+        if len(self.unloaded) > limit:
+            return None
+        # Runs bounded by non-word characters must be complete words.
+        words = [word for word, left, right in runs if not left and not right]
+        if words:
+            sets = sorted([postings.get(word, set()) for word in words], key=len)
+            result = sets[0].intersection(*sets[1:])
+            result |= self.unloaded
+            return None if len(result) > limit else result
+        # Otherwise, scan all words for the longest run.
+        word, left, right = max(runs, key=lambda run: len(run[0]))
+        result = set(self.unloaded)
+        for word2, vnodes in postings.items():
+            if left and right:
+                ok = word in word2
+            elif left:
+                ok = word2.endswith(word)
+            else:
+                ok = word2.startswith(word)
+            if ok:
+                result.update(vnodes)
+                if len(result) > limit:
+                    return None
+        return result
+
+    def fold(self, s):
+        '''Return s in the case-folded form used for words.'''
+        s = g.toUnicode(s)
+        # Lowering may create final sigmas.
+        return s.translate(self.fold_table).lower().translate(self.fold_table)
+
+    def regexLiteral(self, pattern):
+        '''
+        Return the literal text with which every match of the regular
+        expression must begin, or the empty string.
+        '''
+        if '|' in pattern:
+            return ''
+        result, i, n = [], 0, len(pattern)
+        while i < n:
+            ch = pattern[i]
+            if ch == '\\':
+                ch2 = pattern[i + 1: i + 2]
+                if ch2 in ('b', 'B', 'A'):
+                    i += 2 # Skip zero-width assertions.
+                    continue
+                if not ch2 or ch2.isalnum():
+                    break
+                step = 2
+                ch = ch2
+            elif ch == '^' and not result:
+                i += 1
+                continue
+            elif ch in '.^$*+?{}[]()':
+                break
+            else:
+                step = 1
+            next = pattern[i + step: i + step + 1]
+            if next and next in '*?{':
+                break # ch is optional.
+            result.append(ch)
+            if next == '+':
+                break
+            i += step
+        return ''.join(result)
+    #@+node:ekr.20170822081247.4: *3* si.update & helpers
+    def update(self):
+        '''Index all nodes the first time, then reindex changed vnodes.'''
+        changed = self.changed
+        if not self.built:
+            self.built = True
+            changed.update(v for v, level, childIndex in self.c.walk_nodes(unique=True))
+        while changed:
+            v = changed.pop()
+            if self.isUnloaded(v):
+                self.remove(v)
+                self.unloaded.add(v)
+            else:
+                self.unloaded.discard(v)
+                self.add(v)
+
+    def isUnloaded(self, v):
+        '''Return True if v is a DbVNode whose body is still in the db.'''
+        return getattr(v, '_body', '') is None
+
+    def add(self, v):
+        '''Add or reindex v.'''
+        h, b = v._headString, v._bodyString
+        words = set(self.word_pat.findall(self.fold(h + '\n' + b)))
+        old = self.entries.get(v, set())
+        postings = self.postings
+        for word in old - words:
+            self.discard(word, v)
+        for word in words - old:
+            vnodes = postings.get(word)
+            if vnodes is None:
+                postings[word] = set([v])
+            else:
+                vnodes.add(v)
+        self.entries[v] = words
+
+    def remove(self, v):
+        '''Remove v from the index.'''
+        words = self.entries.pop(v, None)
+        if words:
+            for word in words:
+                self.discard(word, v)
+
+    def discard(self, word, v):
+        vnodes = self.postings.get(word)
+        if vnodes is not None:
+            vnodes.discard(v)
+            if not vnodes:
+                del self.postings[word]
+    #@-others
 #@-others
 #@@language python
 #@@tabwidth -4
@@ -333,6 +333,142 @@ class GeneralSetting(object):
 
 def isGeneralSetting(obj):
     return isinstance(obj, GeneralSetting)
+#@+node:ekr.20170822065412.1: *3* class g.GitInfoCache
+class GitInfoCache(object):
+    '''
+    A cache of the branch and commit of git repositories, used by g.gitInfo.
+
+    Repositories are found by searching upward from a directory for .git.
+    The results of the search are cached for each directory. An entry for
+    a repository is revalidated by stat'ing .git/HEAD, the branch's ref file
+    and .git/packed-refs, at most once every self.ttl seconds.
+    '''
+
+    def __init__(self, ttl=1.0):
+        self.dirs = {}
+            # Keys are directories, values are .git directories or None.
+        self.repos = {}
+            # Keys are .git directories, values are g.Bunches.
+        self.ttl = ttl
+
+    def clear(self):
+        '''Clear all cached data.'''
+        self.dirs = {}
+        self.repos = {}
+
+    def findGitDir(self, directory, search=True):
+        '''
+        Return the .git directory of the repository containing directory,
+        or None. Search only directory itself if search is False.
+        '''
+        directory = os.path.normcase(os.path.abspath(directory))
+        key = directory, search
+        if key in self.dirs:
+            return self.dirs.get(key)
+        gitDir, path = None, directory
+        while True:
+            dotGit = os.path.join(path, '.git')
+            if os.path.isdir(dotGit):
+                gitDir = dotGit
+            elif os.path.isfile(dotGit):
+                # A worktree or submodule: .git contains "gitdir: <path>".
+                try:
+                    with open(dotGit) as f:
+                        s = f.read().strip()
+                    if s.startswith('gitdir:'):
+                        gitDir = os.path.normpath(
+                            os.path.join(path, s[len('gitdir:'):].strip()))
+                except IOError:
+                    pass
+            parent = os.path.dirname(path)
+            if gitDir or not search or parent == path:
+                break
+            path = parent
+        self.dirs[key] = gitDir
+        return gitDir
+
+    def getInfo(self, directory, search=True):
+        '''
+        Return (branch, commit) for the repository containing directory,
+        or ('', '').
+        '''
+        gitDir = self.findGitDir(directory, search)
+        if not gitDir:
+            return '', ''
+        d = self.repos.get(gitDir)
+        now = time.time()
+        if d and now - d.checked < self.ttl:
+            return d.info
+        if d and self.stamps(d.paths) == d.stamps:
+            d.checked = now
+            return d.info
+        info, paths = self.readInfo(gitDir)
+        self.repos[gitDir] = g.Bunch(
+            checked=now, info=info, paths=paths, stamps=self.stamps(paths))
+        return info
+
+    def stamps(self, paths):
+        '''Return a list of the modification times of all paths.'''
+        result = []
+        for path in paths:
+            try:
+                result.append(os.stat(path).st_mtime)
+            except OSError:
+                result.append(None)
+        return result
+
+    def readInfo(self, gitDir):
+        '''
+        Return ((branch, commit), paths), where paths is the list of files
+        that determine the branch and commit.
+        '''
+        trace = False and not g.unitTesting
+        branch, commit = '', '' # Set defaults.
+        head = os.path.join(gitDir, 'HEAD')
+        paths = [head]
+        try:
+            with open(head) as f:
+                s = f.read()
+        except IOError:
+            g.trace('can not open:', head)
+            return (branch, commit), paths
+        if not s.startswith('ref'):
+            if trace: g.trace('no ref', branch, commit)
+            return (branch, commit), paths
+        # On a proper branch
+        pointer = s.split()[1]
+        dirs = pointer.split('/')
+        branch = dirs[-1]
+        # Worktrees keep refs in the common directory.
+        commonDir = gitDir
+        try:
+            with open(os.path.join(gitDir, 'commondir')) as f:
+                commonDir = os.path.normpath(os.path.join(gitDir, f.read().strip()))
+        except IOError:
+            pass
+        refPath = os.path.join(commonDir, pointer)
+        packedPath = os.path.join(commonDir, 'packed-refs')
+        paths.extend([refPath, packedPath])
+        # Try to get a better commit number.
+        try:
+            with open(refPath) as f:
+                s = f.read()
+            commit = s.strip()[0: 12]
+            # shorten the hash to a unique shortname
+        except IOError:
+            try:
+                with open(packedPath) as f:
+                    for line in f:
+                        if line.strip().endswith(' '+pointer):
+                            commit = line.split()[0][0: 12]
+                            break
+            except IOError:
+                pass
+        if trace: g.trace('returns:', branch, commit)
+        return (branch, commit), paths
+
+gitInfoCache = GitInfoCache()
+    # The singleton GitInfoCache instance.
 #@+node:ekr.20120201164453.10090: *3* class g.KeyStroke & isStroke/OrNone
 class KeyStroke(object):
     '''A class that announces that its contents has been canonicalized by k.strokeFromSetting.
@@ -2447,19 +2583,61 @@ def get_directives_dict(p, root=None):
 
     Returns a dict containing the stripped remainder of the line
     following the first occurrence of each recognized directive
+
+    The result of the scan is cached in p.v, so calling this function
+    again costs little until p's headline or body text changes.
     """
     trace = False and not g.unitTesting
-    verbose = False
-    if trace and verbose: g.trace('*' * 20, p.h)
     if root: root_node = root[0]
+    d, hasNowebRoot = g.get_directives_entry(p)[2:4]
+    d = dict(d)
+    if '@path_in_body' in d:
+        # Warn about @path in the body text of @<file> nodes.
+        g.app.atPathInBodyWarning = d.get('@path_in_body')
+    if root and hasNowebRoot:
+        if root_node:
+            d["root"] = 0 # value not immportant
+        else:
+            g.es('%s= may only occur in a topmost node (i.e., without a parent)' % (
+                g.angleBrackets('*')))
+    if trace: g.trace('%4d %s' % (len(p.h) + len(p.b), p.h))
+    return d
+#@+node:ekr.20170822175312.1: *4* g.get_directives_entry & scan_directives_dict
+def get_directives_entry(p):
+    """
+    Return the directives cache entry of p.v, rescanning p if necessary.
+
+    The entry is a tuple (textCount, pattern, d, hasNowebRoot). It is valid
+    if p.v.textCount is unchanged, that is, if p's headline and body have
+    not changed since the entry was made, and if globalDirectiveList has
+    not changed. Checking an entry does not load a lazily-loaded body.
+
+    d is the dict described in g.get_directives_dict: callers must not
+    change it.
+    """
+    v = p.v
+    pat = g.get_directives_pattern()
+    entry = getattr(v, '_directivesEntry', None)
+    if entry and entry[0] == v.textCount and entry[1] is pat:
+        return entry
+    h, b = v._headString, v._bodyString
+    d = g.scan_directives_dict(p, h, b, pat)
+    hasNowebRoot = bool(g_noweb_root.search(b))
+    entry = (v.textCount, pat, d, hasNowebRoot)
+    v._directivesEntry = entry
+    return entry
+
+def scan_directives_dict(p, h, b, pat):
+    """
+    Return the dict described in g.get_directives_dict for headline h and
+    body b of p, using pat, the compiled directives pattern.
+    """
+    trace = False and not g.unitTesting
     c = p and p.v and p.v.context
     d = {}
-    # Do this every time so plugins can add directives.
-    pat = g.compute_directives_re()
-    directives_pat = re.compile(pat, re.MULTILINE)
     # The headline has higher precedence because it is more visible.
-    for kind, s in (('head', p.h), ('body', p.b)):
-        anIter = directives_pat.finditer(s)
+    for kind, s in (('head', h), ('body', b)):
+        anIter = pat.finditer(s)
         for m in anIter:
             word = m.group(1).strip()
             i = m.start(1)
@@ -2481,32 +2659,36 @@ def get_directives_dict(p, root=None):
                 word == 'path' and
                 p.isAnyAtFileNode()
             ):
-                g.app.atPathInBodyWarning = p.h
-                d['@path_in_body'] = p.h
-                if trace: g.trace('@path in body', p.h)
-    if root:
-        anIter = g_noweb_root.finditer(p.b)
-        for m in anIter:
-            if root_node:
-                d["root"] = 0 # value not immportant
-            else:
-                g.es('%s= may only occur in a topmost node (i.e., without a parent)' % (
-                    g.angleBrackets('*')))
-            break
-    if trace and verbose:
-        g.trace('%4d' % (len(p.h) + len(p.b)))
+                d['@path_in_body'] = h
+                if trace: g.trace('@path in body', h)
     return d
 #@+node:ekr.20090214075058.10: *4* g.compute_directives_re
 def compute_directives_re():
     '''
     Return an re pattern which word matches all Leo directives.
-    Only g.get_directives_dict uses this pattern.
+    Only g.get_directives_pattern uses this pattern.
     '''
     global globalDirectiveList
     # EKR: 2016/03/30: Use a pattern that guarantees word matches.
     aList = [r'\b%s\b' % (z) for z in globalDirectiveList
                 if z != 'others']
     return "^@(%s)" % "|".join(aList)
+#@+node:ekr.20170822175312.2: *4* g.get_directives_pattern
+g_directives_key = None
+    # The contents of globalDirectiveList when g_directives_pat was compiled.
+g_directives_pat = None
+
+def get_directives_pattern():
+    '''
+    Return the compiled pattern for g.compute_directives_re, recompiling
+    it only if plugins have changed globalDirectiveList.
+    '''
+    global g_directives_key, g_directives_pat
+    key = tuple(globalDirectiveList)
+    if key != g_directives_key:
+        g_directives_key = key
+        g_directives_pat = re.compile(g.compute_directives_re(), re.MULTILINE)
+    return g_directives_pat
 #@+node:ekr.20080827175609.1: *3* g.get_directives_dict_list (must be fast)
 def get_directives_dict_list(p):
     """Scans p and all its ancestors for directives.
@@ -3015,13 +3197,15 @@ def fullPath(c, p, simulate=False):
     path nor the fileName will be created if it does not exist.
     '''
     trace = False and not g.unitTesting
+    # The directives of p and all its ancestors.
+    # aList[i:] contains the directives of the i'th ancestor and its ancestors.
+    aList = g.get_directives_dict_list(p)
     # 2016/03/30: search p and p's parents.
-    for p in p.self_and_parents():
-        aList = g.get_directives_dict_list(p)
-        path = c.scanAtPathDirectives(aList)
+    for i, p in enumerate(p.self_and_parents()):
         fn = p.h if simulate else p.anyAtFileNodeName()
             # Use p.h for unit tests.
         if fn:
+            path = c.scanAtPathDirectives(aList[i:])
             # Fix #102: call commander method, not the global function.
             if trace and c and c.p == p: g.trace('found', p.h)
             return c.os_path_finalize_join(path, fn)
@@ -4238,18 +4422,18 @@ def execGitCommand(command, directory):
 #@+node:ekr.20170414034616.2: *3* g.gitBranchName
 def gitBranchName(path=None):
     '''
-    Return the git branch name associated with path/.git, or the empty
-    string if path/.git does not exist. If path is None, use the leo-editor
-    directory.
+    Return the git branch name of the repository containing path, or the
+    empty string if there is no such repository. If path is None, use the
+    leo-editor directory.
     '''
     branch, commit = g.gitInfo(path)
     return branch
 #@+node:ekr.20170414034616.4: *3* g.gitCommitNumber
 def gitCommitNumber(path=None):
     '''
-    Return the git commit number associated with path/.git, or the empty
-    string if path/.git does not exist. If path is None, use the leo-editor
-    directory.
+    Return the git commit number of the repository containing path, or the
+    empty string if there is no such repository. If path is None, use the
+    leo-editor directory.
     '''
     branch, commit = g.gitInfo(path)
     return commit
@@ -4270,50 +4454,21 @@ def gitHeadPath(path=None):
 #@+node:ekr.20170414034616.3: *3* g.gitInfo
 def gitInfo(path=None):
     '''
-    Path is a .git/HEAD directory, or None.
+    Path is a directory, or None.
+
+    Return the branch and commit number of the git repository containing
+    path or ('', ''). If path is None, use the leo-editor directory.
 
-    Return the branch and commit number or ('', '').
+    g.gitInfoCache caches the results for each repository.
     '''
-    trace = False and not g.unitTesting
-    branch, commit = '', '' # Set defaults.
-    # Does path/../ref exist?
-    path = g.gitHeadPath(path)
-    if not path or not g.os_path_exists(path):
-        if trace: g.trace('no path')
-        return branch, commit
-    try:
-        with open(path) as f:
-            s = f.read()
-            if not s.startswith('ref'):
-                if trace: g.trace('no ref', branch, commit)
-                return branch, commit
-        # On a proper branch
-        pointer = s.split()[1]
-        dirs = pointer.split('/')
-        branch = dirs[-1]
-    except IOError:
-        g.trace('can not open:', path)
-        return branch, commit
-    # Try to get a better commit number.
-    git_dir = g.os_path_finalize_join(path, '..')
-    try:
-        path = g.os_path_finalize_join(git_dir, pointer)
-        with open(path) as f:
-            s = f.read()
-        commit = s.strip()[0: 12]
-        # shorten the hash to a unique shortname
-    except IOError:
-        try:
-            path = g.os_path_finalize_join(git_dir, 'packed-refs')
-            with open(path) as f:
-                for line in f:
-                    if line.strip().endswith(' '+pointer):
-                        commit = line.split()[0][0: 12]
-                        break
-        except IOError:
-            pass
-    if trace: g.trace('returns:', branch, commit)
-    return branch, commit
+    if path:
+        return g.gitInfoCache.getInfo(path)
+    # Look only in the leo-editor directory.
+    head = g.gitHeadPath()
+    if not head:
+        return '', ''
+    return g.gitInfoCache.getInfo(g.os_path_dirname(g.os_path_dirname(head)),
+        search=False)
 #@+node:ekr.20170414041333.1: *3* g.jsonCommitInfo
 def jsonCommitInfo():
     '''
@@ -189,6 +189,217 @@ class NodeIndices(object):
             except Exception:
                 g.trace('can not happen', repr(n))
     #@-others
+#@+node:ekr.20170819074406.1: ** class NodeWalker
+class NodeWalker(object):
+    '''
+    Traverse all or part of an outline in outline order without creating
+    positions. Iterating yields (v, level, childIndex) tuples.
+
+    The walker reuses a single stack of (v, childIndex) tuples, having the
+    form of p.stack, so after each step:
+
+    - w.position() returns a new position for the node just yielded.
+    - w.skipTree() skips the subtree of the node just yielded.
+
+    Like positions, walkers become invalid if the outline changes.
+    '''
+    #@+others
+    #@+node:ekr.20170819074406.2: *3* walker.ctor
+    def __init__(self, c, root=None, unique=False):
+        '''
+        Ctor for the NodeWalker class.
+
+        root:   None: traverse the entire outline.
+                Otherwise, traverse root and its subtree.
+        unique: True: visit each VNode only once, skipping
+                the subtrees of all other clones.
+        '''
+        self.c = c
+        self.root = root and root.copy()
+        self.unique = unique
+        self.seen = set()
+        self.stack = []
+        self.v = None
+        self.childIndex = 0
+        self.skip = False
+    #@+node:ekr.20170819074406.3: *3* walker.__iter__
+    def __iter__(self):
+        '''Yield (v, level, childIndex) for all nodes.'''
+        w = self
+        seen, unique = w.seen, w.unique
+        top = w.c.hiddenRootNode.children
+        if w.root:
+            # Visit the root, then its subtree.
+            v, i = w.root.v, w.root._childIndex
+            stack = w.stack = w.root.stack[:]
+            w.v, w.childIndex, w.skip = v, i, False
+            yield v, len(stack), i
+            if unique: seen.add(v)
+            if w.skip or not v.children:
+                return
+            stack.append((v, i))
+            limit = len(stack)
+            children = v.children
+        else:
+            stack = w.stack = []
+            limit = 0
+            children = top
+        i = 0
+        while True:
+            if i < len(children):
+                v = children[i]
+                if unique and v in seen:
+                    i += 1
+                    continue
+                w.v, w.childIndex, w.skip = v, i, False
+                yield v, len(stack), i
+                if unique: seen.add(v)
+                if v.children and not w.skip:
+                    stack.append((v, i))
+                    children = v.children
+                    i = 0
+                else:
+                    i += 1
+            elif len(stack) > limit:
+                v, i = stack.pop()
+                children = stack[-1][0].children if stack else top
+                i += 1
+            else:
+                break
+    #@+node:ekr.20170819074406.4: *3* walker.position & skipTree
+    def position(self):
+        '''Return a new position for the node most recently yielded.'''
+        return Position(self.v, self.childIndex, self.stack)
+
+    def skipTree(self):
+        '''Don't visit the subtree of the node most recently yielded.'''
+        self.skip = True
+    #@-others
+#@+node:ekr.20170820081733.1: ** class VisibilityIndex
+class VisibilityIndex(object):
+    '''
+    A cache of the visibility of positions, used by p.isVisible and hence
+    by p.moveToVisBack and p.moveToVisNext.
+
+    Keys are (v, childIndex) pairs. Values are True if the node exists and
+    is visible. Only nodes that appear at exactly one position are cached:
+    neither they nor their ancestors are clones, so the pair identifies the
+    position, and its visibility does not depend on the selected position.
+    A cached value is used only if p's parent still has p.v as its
+    childIndex'th child. Computing the visibility of a position reuses the
+    cached value for its deepest cached ancestor, so walking the visible
+    outline takes time proportional to the number of positions visited.
+
+    The cache clears itself when c.frame.tree.generation changes (VNode
+    link and expansion methods increment it) or when the hoist stack
+    changes. Scripts that change v.children or v.statusBits directly should
+    call c.visibilityIndex.invalidate().
+    '''
+    #@+others
+    #@+node:ekr.20170820081733.2: *3* vis.ctor & invalidate
+    def __init__(self, c, maxSize=50000):
+        '''Ctor for the VisibilityIndex class.'''
+        self.c = c
+        self.cache = {}
+        self.key = None
+            # The state of c when the cache was last valid.
+        self.maxSize = maxSize
+        # Statistics.
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        '''Clear the cache.'''
+        self.cache.clear()
+        self.key = None
+    #@+node:ekr.20170820081733.3: *3* vis.validate
+    def validate(self):
+        '''Clear the cache if the outline or the hoist stack has changed.'''
+        c = self.c
+        top = c.hoistStack[-1] if c.hoistStack else None
+        old = self.key
+        if (old is None or old[0] != c.frame.tree.generation or
+            old[1] is not top or len(self.cache) > self.maxSize
+        ):
+            self.cache.clear()
+            self.key = (c.frame.tree.generation, top)
+    #@+node:ekr.20170820081733.4: *3* vis.isVisible & helpers
+    def isVisible(self, p):
+        '''Return True if p exists and is visible in c's outline.'''
+        if not p.v:
+            return False
+        self.validate()
+        cache = self.cache
+        val = cache.get((p.v, p._childIndex))
+        if val is not None and self.isLinked(p.stack, len(p.stack), p.v, p._childIndex):
+            self.hits += 1
+            return val
+        self.misses += 1
+        path = p.stack + [(p.v, p._childIndex)]
+        # Find the deepest cached ancestor.
+        n = len(path) - 2
+        while n >= 0:
+            v, childIndex = path[n]
+            val = cache.get((v, childIndex))
+            if val is not None and self.isLinked(path, n, v, childIndex):
+                break
+            n -= 1
+        # Compute the values below it, caching the values of unique nodes.
+        c = self.c
+        hoist = c.hoistStack and c.hoistStack[-1].p
+        unique = True
+            # True if no node in path[:i+1] is a clone.
+        for i in range(n + 1, len(path)):
+            v, childIndex = path[i]
+            unique = unique and len(v.parents) == 1
+            val = self.computeVisible(path, i, val, hoist)
+            if unique:
+                cache[v, childIndex] = val
+        return val
+
+    def computeVisible(self, path, i, parentVal, hoist):
+        '''
+        Return True if the position given by path[:i+1] is visible.
+        parentVal is the value for path[:i] when i > 0.
+        '''
+        c = self.c
+        v, childIndex = path[i]
+        if hoist and self.isHoist(path, i, hoist):
+            # Fix bug: https://github.com/leo-editor/leo-editor/issues/12
+            return True
+        if not self.isLinked(path, i, v, childIndex):
+            return False
+        if i == 0:
+            return not hoist
+        if hoist and self.isHoist(path, i - 1, hoist):
+            return True
+        if not parentVal:
+            return False
+        # Do not call p.isExpanded here. It creates a position.
+        parent_v, parentIndex = path[i - 1]
+        if parent_v.isCloned():
+            parent = Position(parent_v, parentIndex, path[: i - 1])
+            return c.shouldBeExpanded(parent)
+        else:
+            return parent_v.isExpanded()
+
+    def isHoist(self, path, i, hoist):
+        '''Return True if path[:i+1] is the path to the hoisted position.'''
+        v, childIndex = path[i]
+        if v is not hoist.v or childIndex != hoist._childIndex or len(hoist.stack) != i:
+            return False
+        return all(v1 is v2 and n1 == n2
+            for (v1, n1), (v2, n2) in zip(path, hoist.stack))
+
+    def isLinked(self, path, i, v, childIndex):
+        '''
+        Return True if v is the childIndex'th child of its parent in path,
+        the first i entries of which describe v's ancestors.
+        '''
+        parent_v = path[i - 1][0] if i > 0 else self.c.hiddenRootNode
+        children = parent_v.children
+        return childIndex < len(children) and children[childIndex] is v
+    #@-others
 #@+node:ekr.20031218072017.889: ** class Position
 #@+<< about the position class >>
 #@+node:ekr.20031218072017.890: *3* << about the position class >>
@@ -858,11 +1069,14 @@ class Position(object):
     def isRoot(self):
         p = self
         return not p.hasParent() and not p.hasBack()
-    #@+node:ekr.20080416161551.196: *4* p.isVisible (slow)
+    #@+node:ekr.20080416161551.196: *4* p.isVisible
     def isVisible(self, c):
         '''Return True if p is visible in c's outline.'''
         trace = False and not g.unitTesting
         p = self
+        index = getattr(c, 'visibilityIndex', None)
+        if index:
+            return index.isVisible(p)
 
         def visible(p, root=None):
             for parent in p.parents():
@@ -1052,7 +1266,10 @@ class Position(object):
         p._childIndex = 0
         parent_v = hiddenRootNode
         child = p.v
-        if not oldRoot: parent_v.children = []
+        if not oldRoot:
+            for v in parent_v.children:
+                v.dataChanged()
+            parent_v.children = []
         child._addLink(0, parent_v)
         return p
     #@+node:ekr.20080416161551.212: *4* p._parentVnode
@@ -1081,6 +1298,8 @@ class Position(object):
         if parent_v.children[p._childIndex] == v:
             parent_v.children[p._childIndex] = v2
             v2.parents.append(parent_v)
+            for v3 in (v, v2, parent_v):
+                v3.dataChanged()
             # p.v no longer truly exists.
             # p.v = p2.v
         else:
@@ -1350,6 +1569,8 @@ class Position(object):
                             v2 for v2 in parent.v.children if not v2 == child_v]
                         if parent.v in child_v.parents:
                             child_v.parents.remove(parent.v)
+                        parent.v.dataChanged()
+                        child_v.dataChanged()
                         # Try not to hang.
                         p.moveToParent()
                         break
@@ -1407,6 +1628,7 @@ class Position(object):
         p = self
         p2.v._headString = g.toUnicode(p.h, reportErrors=True) # 2017/01/24
         p2.v._bodyString = g.toUnicode(p.b, reportErrors=True) # 2017/01/24
+        p2.v.textChanged()
         # 2013/09/08: Fix bug 1019794: p.copyTreeFromSelfTo, should deepcopy p.v.u.
         p2.v.u = copy.deepcopy(p.v.u)
         # 2009/10/02: no need to copy arg to iter
@@ -1985,6 +2207,13 @@ class VNodeBase(object):
         # The primary data: headline and body text.
         self._headString = g.u('newHeadline')
         self._bodyString = g.u('')
+        self._directivesEntry = None
+            # A cache for g.get_directives_dict: see g.get_directives_entry.
+        self._directivesMemo = {}
+            # A cache for c.scanAllDirectives.
+        self.textCount = 0
+            # Incremented by v.textChanged: compare counts, not strings,
+            # to tell whether the headline or body has changed.
         # Structure data...
         self.children = []
             # Ordered list of all children of this node.
@@ -2019,6 +2248,7 @@ class VNodeBase(object):
         #       g.app.nodeIndices.new_vnode_helper(c,gnx,v)
         g.app.nodeIndices.new_vnode_helper(context, gnx, self)
         assert self.fileIndex, g.callers()
+        self.textChanged()
     #@+node:ekr.20031218072017.3345: *4* v.__repr__ & v.__str__
     def __repr__(self):
         return "<VNode %7x %s>" % (id(self), self.cleanHeadString())
@@ -2379,13 +2609,16 @@ class VNodeBase(object):
         # if self.h.startswith('@auto'):
         # g.trace('(v) %5s %30s' % (self.isDirty(),self.h),g.callers())
         self.statusBits |= self.dirtyBit
+        self.dataChanged()
     #@+node:ekr.20031218072017.3386: *4*  v.Status bits
     #@+node:ekr.20031218072017.3389: *5* v.clearClonedBit
     def clearClonedBit(self):
         self.statusBits &= ~self.clonedBit
+        self.dataChanged()
     #@+node:ekr.20031218072017.3391: *5* v.clearMarked
     def clearMarked(self):
         self.statusBits &= ~self.markedBit
+        self.dataChanged()
     #@+node:ekr.20080429053831.8: *5* v.clearWriteBit
     def clearWriteBit(self):
         self.statusBits &= ~self.writeBit
@@ -2400,14 +2633,20 @@ class VNodeBase(object):
     def contract(self):
         '''Contract the node.'''
         self.statusBits &= ~self.expandedBit
+        self.context.frame.tree.generation += 1
+        self.dataChanged()
 
     def expand(self):
         '''Expand the node.'''
         self.statusBits |= self.expandedBit
+        self.context.frame.tree.generation += 1
+        self.dataChanged()
 
     def initExpandedBit(self):
         '''Init self.statusBits.'''
         self.statusBits |= self.expandedBit
+        self.context.frame.tree.generation += 1
+        self.dataChanged()
 
     def isExpanded(self):
         '''Return True if the VNode expansion bit is set.'''
@@ -2415,21 +2654,26 @@ class VNodeBase(object):
     #@+node:ekr.20031218072017.3396: *5* v.initStatus
     def initStatus(self, status):
         self.statusBits = status
+        self.dataChanged()
     #@+node:ekr.20031218072017.3397: *5* v.setClonedBit & initClonedBit
     def setClonedBit(self):
         self.statusBits |= self.clonedBit
+        self.dataChanged()
 
     def initClonedBit(self, val):
         if val:
             self.statusBits |= self.clonedBit
         else:
             self.statusBits &= ~self.clonedBit
+        self.dataChanged()
     #@+node:ekr.20031218072017.3398: *5* v.setMarked & initMarkedBit
     def setMarked(self):
         self.statusBits |= self.markedBit
+        self.dataChanged()
 
     def initMarkedBit(self):
         self.statusBits |= self.markedBit
+        self.dataChanged()
     #@+node:ekr.20031218072017.3399: *5* v.setOrphan
     def setOrphan(self):
         '''Set the vnode's orphan bit.'''
@@ -2518,6 +2762,7 @@ class VNodeBase(object):
                     self.unicode_warning_given = True
                     g.internalError(s)
                     g.es_exception()
+        v.textChanged()
 
     def setHeadString(self, s):
         # Fix bug: https://bugs.launchpad.net/leo-editor/+bug/1245535
@@ -2534,6 +2779,7 @@ class VNodeBase(object):
                     self.unicode_warning_given = True
                     g.internalError(s)
                     g.es_exception()
+        v.textChanged()
 
     initBodyString = setBodyString
     initHeadString = setHeadString
@@ -2550,6 +2796,40 @@ class VNodeBase(object):
     #@+node:ville.20120502221057.7499: *4* v.childrenModified
     def childrenModified(self):
         g.childrenModifiedSet.add(self)
+    #@+node:ekr.20170823150000.2: *4* v.textChanged
+    def textChanged(self):
+        '''
+        Called when v is created and whenever v's headline or body changes.
+        Increment v.textCount and add v to all sets in c.textChangedSets.
+        If v has children, increment c.parentTextGeneration. Call
+        v.dataChanged.
+
+        Code that sets v._headString or v._bodyString directly must call
+        this method.
+        '''
+        c = self.context
+        self.textCount += 1
+        if self.children and hasattr(c, 'parentTextGeneration'):
+            c.parentTextGeneration += 1
+        aList = getattr(c, 'textChangedSets', None)
+        if aList:
+            for aSet in aList:
+                aSet.add(self)
+        self.dataChanged()
+    #@+node:ekr.20170823150000.4: *4* v.dataChanged
+    def dataChanged(self):
+        '''
+        Called whenever data that Leo saves for v may have changed: v's
+        headline, body, links, saved status bits, or (via v.setDirty) uA's.
+        Add v to all sets in c.dataChangedSets.
+
+        Code that changes v.children or v.parents directly must call this
+        method for all affected vnodes.
+        '''
+        aList = getattr(self.context, 'dataChangedSets', None)
+        if aList:
+            for aSet in aList:
+                aSet.add(self)
     #@+node:ekr.20130524063409.10700: *3* v.Inserting & cloning
     def cloneAsNthChild(self, parent_v, n):
         # Does not check for illegal clones!
@@ -2584,6 +2864,8 @@ class VNodeBase(object):
         # Update parent_v.children & v.parents.
         parent_v.children.insert(childIndex, v)
         v.parents.append(parent_v)
+        v.dataChanged()
+        parent_v.dataChanged()
         if trace:
             g.trace('*** added parent', parent_v, 'to', v,
                     'len(parents)', len(v.parents))
@@ -2602,6 +2884,7 @@ class VNodeBase(object):
         trace = False and not g.unitTesting
         v = self
         v.parents.append(parent)
+        v.dataChanged()
         if trace:
             g.trace('v', v.h, 'parent', parent.h, g.callers())
             # '*** added parent', parent, 'to', v, 'len(parents)', len(v.parents))
@@ -2618,6 +2901,8 @@ class VNodeBase(object):
         del parent_v.children[childIndex]
         if parent_v in v.parents:
             v.parents.remove(parent_v)
+        v.dataChanged()
+        parent_v.dataChanged()
         v._p_changed = 1
         parent_v._p_changed = 1
         # If v has no more parents, we adjust all
@@ -2632,6 +2917,7 @@ class VNodeBase(object):
         v = self
         if trace: g.trace('parent', parent, 'v', v)
         v.parents.remove(parent)
+        v.dataChanged()
         if not v.parents:
             for child in v.children:
                 child._cutParentLinks(parent=v)
@@ -253,6 +253,8 @@ class LeoPluginsController(object):
     def __init__(self):
         # g.trace('LeoPluginsController',g.callers())
         self.handlers = {}
+        self.idle_callbacks = {}
+            # Keys are ids of 'idle' handler bunches, values are callbacks.
         self.loadedModulesFilesDict = {}
             # Keys are regularized module names, values are the names of .leo files
             # containing @enabled-plugins nodes that caused the plugin to be loaded
@@ -290,6 +292,45 @@ class LeoPluginsController(object):
                     g.trace('(leoPlugins.py) calling g.doHook(c=%s)' % (
                         c.shortFileName()))
                 g.doHook("idle", c=c)
+    #@+node:ekr.20170823150000.3: *4* plugins.get_idle_callbacks
+    def get_idle_callbacks(self):
+        '''
+        Return a list of callbacks that run the idle-time hooks, so that the
+        IdleTimeManager can time and back off each 'idle' handler separately.
+
+        Return [plugins.on_idle] if some commander or script has replaced
+        the default hook function.
+        '''
+        if (
+            g.app.hookFunction not in (None, self.doPlugins) or
+            any(frame.c.hookFunction for frame in g.app.windowList)
+        ):
+            return [self.on_idle]
+        bunches = self.handlers.get('idle', []) + self.handlers.get('all', [])
+        d = {}
+        for bunch in bunches:
+            d[id(bunch)] = self.idle_callbacks.get(id(bunch)) or self.make_idle_callback(bunch)
+        self.idle_callbacks = d
+        return [d[id(bunch)] for bunch in bunches]
+
+    def make_idle_callback(self, bunch):
+        '''Return a callback that calls one 'idle' handler for all commanders.'''
+
+        def idle_callback(bunch=bunch):
+            if (
+                g.app.killed or g.app.hookError or
+                not g.app.idle_time_hooks_enabled or
+                not g.app.config.use_plugins
+            ):
+                return False
+            for frame in g.app.windowList:
+                # Do NOT compute c.currentPosition.
+                self.callTagHandler(bunch, 'idle', {'c': frame.c})
+            return None
+
+        idle_callback.__name__ = 'idle hook: %s.%s' % (
+            bunch.moduleName, getattr(bunch.fn, '__name__', repr(bunch.fn)))
+        return idle_callback
     #@+node:ekr.20100908125007.6017: *4* plugins.doHandlersForTag & helper
     def doHandlersForTag(self, tag, keywords):
         """
@@ -41,9 +41,14 @@
 # operation. More than one list may be generated: client code is responsible for
 # merging lists using the pattern dirtyVnodeList.extend(dirtyVnodeList2)
 # 
+# New in Leo 5.6: u.pushBead replaces copies of body text in beads by shared
+# strings or by diffs, and u.cutStack removes the oldest beads when the undo
+# stack uses more than @int max_undo_memory megabytes.
+# 
 # I first saw this model of unlimited undo in the documentation for Apple's Yellow Box classes.
 #@-<< How Leo implements unlimited undo >>
 import leo.core.leoGlobals as g
+import sys
 # pylint: disable=unpacking-non-sequence
 #@+others
 #@+node:ekr.20031218072017.3605: ** class Undoer
@@ -65,6 +70,14 @@ class Undoer(object):
             self.granularity = 'line'
         # g.trace('Undoer',self.granularity)
         self.max_undo_stack_size = c.config.getInt('max_undo_stack_size') or 0
+        n = c.config.getInt('max_undo_memory')
+        self.max_undo_memory = 1024 * 1024 * (100 if n is None else n)
+            # The maximum size of the undo stack, in bytes. 0: no limit.
+        self.beadSizes = {}
+            # Keys are id(bunch), values are (bunch, size).
+            # Contains all beads except the present bead.
+        self.memorySlack = 0
+            # The amount by which u.estimateMemory overcounts the beads in u.beadSizes.
         # Statistics comparing old and new ways (only if self.debug_Undoer is on).
         self.new_mem = 0
         self.old_mem = 0
@@ -140,22 +153,140 @@ class Undoer(object):
         u.p = None # The position/node being operated upon for undo and redo.
         for ivar in u.optionalIvars:
             setattr(u, ivar, None)
+    #@+node:ekr.20170822183015.1: *4* u.compactBead & helpers
+    def compactBead(self, bunch):
+        '''
+        Replace the full copies of body text in bunch by references to
+        shared strings or by diffs. u.expandBead reverses the process.
+        '''
+        u = self
+        kind = bunch.get('kind')
+        if kind == 'node':
+            old, new = bunch.get('oldBody'), bunch.get('newBody')
+            if not g.isString(old) or not g.isString(new):
+                pass
+            elif old == new:
+                bunch.oldBody = new
+            else:
+                diff = u.diffText(new, old)
+                if diff:
+                    bunch.oldBody = None
+                    bunch.oldBodyDiff = diff
+        elif kind == 'tree' and bunch.get('oldTree') and bunch.get('newTree'):
+            # u.undoTree and u.redoTree do not use the text of the body pane.
+            bunch.oldText = bunch.newText = None
+            d = dict((v, tInfo) for v, vInfo, tInfo in bunch.newTree)
+            for v, vInfo, tInfo in bunch.oldTree:
+                new = d.get(v)
+                if new:
+                    u.compactTnodeUndoInfo(tInfo, new)
+    #@+node:ekr.20170822183015.2: *5* u.compactTnodeUndoInfo
+    def compactTnodeUndoInfo(self, bunch, newBunch):
+        '''
+        Share the strings of bunch that are equal to the strings of newBunch.
+        Replace bunch.bodyString by a diff if that would save space.
+        '''
+        u = self
+        if bunch.headString == newBunch.headString:
+            bunch.headString = newBunch.headString
+        old, new = bunch.bodyString, newBunch.bodyString
+        if old == new:
+            bunch.bodyString = new
+        else:
+            diff = u.diffText(new, old)
+            if diff:
+                bunch.bodyString = None
+                bunch.bodyDiff = diff
+    #@+node:ekr.20170822183015.3: *5* u.diffText, commonPrefixAndSuffix & patchText
+    def diffText(self, s1, s2):
+        '''
+        Return a diff from s1 to s2, a tuple (i, j, middle) such that s2 is
+        s1[:i] + middle + s1[len(s1)-j:], or None if the diff would not save
+        at least half of the space used by s2.
+        '''
+        n2 = len(s2)
+        if n2 < 256:
+            return None
+        i, j = self.commonPrefixAndSuffix(s1, s2)
+        middle = s2[i: n2 - j]
+        if 2 * len(middle) > n2:
+            return None
+        return i, j, middle
+
+    def commonPrefixAndSuffix(self, s1, s2):
+        '''
+        Return (i, j), the lengths of the longest common prefix and the
+        longest common suffix of s1 and s2, such that i + j <= min(len(s1), len(s2)).
+        '''
+        n1, n2 = len(s1), len(s2)
+        # Binary searches compare slices, so they run mostly in C.
+        lo, hi = 0, min(n1, n2)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if s1[:mid] == s2[:mid]:
+                lo = mid
+            else:
+                hi = mid - 1
+        i = lo
+        lo, hi = 0, min(n1, n2) - i
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if s1[n1 - mid:] == s2[n2 - mid:]:
+                lo = mid
+            else:
+                hi = mid - 1
+        return i, lo
+
+    def patchText(self, s1, diff):
+        '''Return s2, given s1 and the diff returned by u.diffText(s1, s2).'''
+        i, j, middle = diff
+        return s1[:i] + middle + s1[len(s1) - j:]
     #@+node:ekr.20060127052111.1: *4* u.cutStack
     def cutStack(self):
+        '''
+        Cut the undo stack to at most u.max_undo_stack_size beads,
+        then to at most u.max_undo_memory bytes.
+        '''
         u = self; n = u.max_undo_stack_size
         if n > 0 and u.bead >= n and not g.app.unitTesting:
             # Do nothing if we are in the middle of creating a group.
-            i = len(u.beads) - 1
-            while i >= 0:
-                bunch = u.beads[i]
-                if hasattr(bunch, 'kind') and bunch.kind == 'beforeGroup':
-                    return
-                i -= 1
+            if u.groupIsOpen():
+                return
             # This work regardless of how many items appear after bead n.
             # g.trace('Cutting undo stack to %d entries' % (n))
             u.beads = u.beads[-n:]
             u.bead = n - 1
             # g.trace('bead:',u.bead,'len(u.beads)',len(u.beads),g.callers())
+        u.cutStackToMemoryLimit()
+    #@+node:ekr.20170822183015.4: *4* u.cutStackToMemoryLimit
+    def cutStackToMemoryLimit(self):
+        '''
+        When the undo stack uses more than u.max_undo_memory bytes, remove the
+        oldest beads until it uses at most 90% of that. Never remove the
+        present bead.
+        '''
+        trace = False and not g.unitTesting
+        u = self; limit = u.max_undo_memory
+        if limit <= 0 or u.bead < 1:
+            return
+        # Computing the exact sizes requires a scan of the outline.
+        if u.estimateMemory() <= limit or u.groupIsOpen():
+            return
+        sizes = u.getExclusiveSizes()
+        total = sum(sizes)
+        if total > limit:
+            # Leave room for new beads, so that we don't rescan on every change.
+            low = limit - limit // 10
+            n = 0
+            while total > low and n < u.bead:
+                total -= sizes[n]
+                n += 1
+            if trace: g.trace('removing %s beads, %s bytes remain' % (n, total))
+            del u.beads[: n]
+            u.bead -= n
+        # Remember how much u.estimateMemory overcounts the remaining beads.
+        u.memorySlack = 0
+        u.memorySlack = max(0, u.estimateMemory() - total)
     #@+node:ekr.20080623083646.10: *4* u.dumpBead
     def dumpBead(self, n):
         u = self
@@ -176,6 +307,133 @@ class Undoer(object):
             return self.dumpBead(n - 1)
         else:
             return '<no top bead>'
+    #@+node:ekr.20170822183015.5: *4* u.estimateMemory & helpers
+    def estimateMemory(self):
+        '''
+        Return an upper bound of the size of the undo stack, in bytes.
+
+        This counts strings shared between beads or with the outline more
+        than once, less the slack found by the last u.cutStackToMemoryLimit.
+        '''
+        u = self; d = {}; total = 0; slack = u.memorySlack
+        present = u.peekBead(u.bead)
+        for bunch in u.beads:
+            key = id(bunch)
+            # The present bead may still change.
+            data = u.beadSizes.get(key) if bunch is not present else None
+            if data and data[0] is bunch:
+                n = data[1]
+            else:
+                n = u.getBeadSize(bunch, set())
+            if bunch is not present:
+                d[key] = bunch, n
+            total += n
+        if any(key not in d for key in u.beadSizes):
+            # Some other code removed beads, so the slack is unknown.
+            slack = u.memorySlack = 0
+        u.beadSizes = d
+        return max(0, total - slack)
+    #@+node:ekr.20170822183015.6: *5* u.getExclusiveSizes
+    def getExclusiveSizes(self):
+        '''
+        Return a list giving, for each bead, the number of bytes used only by
+        that bead and older beads. Removing the n oldest beads frees the sum
+        of the first n entries.
+        '''
+        u = self; c = u.c
+        # Don't count strings that the outline uses.
+        seen = set()
+        for v in c.all_unique_nodes():
+            seen.add(id(v._headString))
+            seen.add(id(v._bodyString))
+        sizes = [u.getBeadSize(bunch, seen) for bunch in reversed(u.beads)]
+        sizes.reverse()
+        return sizes
+    #@+node:ekr.20170822183015.11: *5* u.getBeadSize & getTreeSize
+    def getBeadSize(self, bunch, seen):
+        '''
+        Return the number of bytes used by bunch, an undo bead, ignoring
+        objects whose id is in seen. Add the ids of all counted objects to seen.
+        '''
+        u = self
+        n = sys.getsizeof(bunch.__dict__)
+        for key, val in bunch.__dict__.items():
+            if key in ('oldTree', 'newTree') and isinstance(val, list):
+                n += u.getTreeSize(val, seen)
+            elif key == 'items' and isinstance(val, list):
+                n += sys.getsizeof(val)
+                n += sum(u.getBeadSize(z, seen) for z in val)
+            else:
+                n += u.getObjectSize(val, seen)
+        return n
+
+    tree_entry_size = 800
+        # The approximate size of the tuple, bunches and lists in each entry
+        # of the list returned by u.saveTree, excluding strings.
+
+    def getTreeSize(self, tree, seen):
+        '''A fast version of u.getObjectSize for lists returned by u.saveTree.'''
+        u = self
+        n = sys.getsizeof(tree) + len(tree) * u.tree_entry_size
+        for v, vInfo, tInfo in tree:
+            n += 8 * (len(vInfo.children) + len(vInfo.parents))
+            for s in (tInfo.headString, tInfo.bodyString):
+                key = id(s)
+                if s is not None and key not in seen:
+                    seen.add(key)
+                    n += sys.getsizeof(s)
+            diff = tInfo.get('bodyDiff')
+            if diff:
+                n += u.getObjectSize(diff, seen)
+        return n
+    #@+node:ekr.20170822183015.7: *5* u.getObjectSize
+    def getObjectSize(self, obj, seen):
+        '''
+        Return the number of bytes used by obj and by the strings, lists,
+        tuples, dicts and bunches it contains. Ignore all other objects,
+        including vnodes and positions, and objects whose id is in seen.
+        Add the ids of all counted objects to seen.
+        '''
+        n = 0; todo = [obj]
+        while todo:
+            obj = todo.pop()
+            key = id(obj)
+            if key in seen:
+                continue
+            if g.isString(obj) or isinstance(obj, bytes):
+                n += sys.getsizeof(obj)
+            elif isinstance(obj, (list, tuple)):
+                n += sys.getsizeof(obj)
+                todo.extend(obj)
+            elif isinstance(obj, dict):
+                n += sys.getsizeof(obj)
+                todo.extend(obj.values())
+            elif isinstance(obj, g.Bunch):
+                n += sys.getsizeof(obj.__dict__)
+                todo.extend(obj.__dict__.values())
+            else:
+                continue
+            seen.add(key)
+        return n
+    #@+node:ekr.20170822183015.8: *4* u.expandBead
+    def expandBead(self, bunch):
+        '''
+        Undo the effects of u.compactBead(bunch) on the Undoer ivars
+        set by u.setIvarsFromBunch(bunch). Don't change bunch.
+        '''
+        u = self
+        if bunch.get('oldBodyDiff') and bunch.get('oldBody') is None:
+            u.oldBody = u.patchText(bunch.newBody, bunch.oldBodyDiff)
+        if bunch.get('kind') == 'tree' and bunch.get('oldTree') and bunch.get('newTree'):
+            d = dict((v, tInfo) for v, vInfo, tInfo in bunch.newTree)
+            oldTree = []
+            for v, vInfo, tInfo in bunch.oldTree:
+                if tInfo.get('bodyDiff'):
+                    tInfo2 = g.Bunch(**tInfo.__dict__)
+                    tInfo2.bodyString = u.patchText(d[v].bodyString, tInfo.bodyDiff)
+                    tInfo = tInfo2
+                oldTree.append((v, vInfo, tInfo))
+            u.oldTree = oldTree
     #@+node:EKR.20040526150818: *4* u.getBead
     def getBead(self, n):
         '''Set Undoer ivars from the bunch at the top of the undo stack.'''
@@ -185,6 +443,102 @@ class Undoer(object):
         bunch = u.beads[n]
         self.setIvarsFromBunch(bunch)
         return bunch
+    #@+node:ekr.20170823091214.1: *4* u.getTypingLines
+    def getTypingLines(self, oldText, newText, i, removed, added):
+        '''
+        Return (leading, trailing, old_middle_lines, new_middle_lines),
+        exactly as if we had split oldText and newText into lines and compared
+        the lines from both ends.
+
+        oldText[i:i+removed] is the text that was replaced by newText[i:i+added].
+        Lines outside the changed text are equal, so this method compares only
+        the lines near the change.
+        '''
+        old_n, new_n = len(oldText), len(newText)
+        # Count newlines before, in and after the change.
+        before = oldText.count('\n', 0, i)
+        after = oldText.count('\n', i + removed)
+        old_len = before + oldText.count('\n', i, i + removed) + after + 1
+        new_len = before + newText.count('\n', i, i + added) + after + 1
+        min_len = min(old_len, new_len)
+        # All lines ending before the change are equal.
+        leading = before
+        old_i = new_i = oldText.rfind('\n', 0, i) + 1
+            # The start of line number leading in oldText and newText.
+        while leading < min_len:
+            old_j = oldText.find('\n', old_i)
+            new_j = newText.find('\n', new_i)
+            if old_j == -1: old_j = old_n
+            if new_j == -1: new_j = new_n
+            if oldText[old_i: old_j] != newText[new_i: new_j]:
+                break
+            leading += 1
+            old_i, new_i = old_j + 1, new_j + 1
+        if leading == new_len:
+            # This happens when we remove lines from the end.
+            # The new text is simply the leading lines from the old text.
+            trailing = 0
+            old_j, new_j = old_n, new_n
+        else:
+            # All lines starting after the change are equal.
+            limit = min_len - leading
+            trailing = after
+            if trailing <= limit:
+                old_j = oldText.find('\n', i + removed)
+                if old_j == -1: old_j = old_n
+                new_j = old_j + added - removed
+                    # The end of the last line before the trailing lines.
+            else:
+                # Rare: start from the end.
+                trailing = 0
+                old_j, new_j = old_n, new_n
+            while trailing < limit:
+                old_k = oldText.rfind('\n', 0, old_j) + 1
+                new_k = newText.rfind('\n', 0, new_j) + 1
+                if oldText[old_k: old_j] != newText[new_k: new_j]:
+                    break
+                trailing += 1
+                old_j, new_j = old_k - 1, new_k - 1
+        old_middle_lines = (oldText[old_i: old_j].split('\n')
+            if old_len - trailing > leading else [])
+        new_middle_lines = (newText[new_i: new_j].split('\n')
+            if new_len - trailing > leading else [])
+        return leading, trailing, old_middle_lines, new_middle_lines
+    #@+node:ekr.20170823091214.2: *4* u.getTypingSpan
+    def getTypingSpan(self, oldText, newText, oldSel, newSel):
+        '''
+        Return (i, removed, added) such that newText is oldText with
+        oldText[i:i+removed] replaced by newText[i:i+added].
+
+        Typing, deleting and pasting replace the old selection, so oldSel and
+        newSel usually give the changed text. Otherwise, for example after
+        bulk changes, compare oldText and newText from both ends.
+        '''
+        u = self
+        sels = list(oldSel or []) + list(newSel or [])
+        if len(sels) == 4 and all(g.isInt(z) for z in sels) and sels[2] == sels[3]:
+            # After the change, the insert point follows the new text.
+            ins = sels[2]
+            i = min(sels[0], sels[1], ins)
+            added = ins - i
+            removed = added - (len(newText) - len(oldText))
+            # Guard against invalid selection ranges.
+            if (
+                0 <= i and 0 <= removed and i + removed <= len(oldText) and
+                newText.startswith(oldText[: i]) and
+                newText.endswith(oldText[i + removed:])
+            ):
+                return i, removed, added
+        i, j = u.commonPrefixAndSuffix(oldText, newText)
+        return i, len(oldText) - i - j, len(newText) - i - j
+    #@+node:ekr.20170822183015.9: *4* u.groupIsOpen
+    def groupIsOpen(self):
+        '''Return True if we are in the middle of creating a group.'''
+        u = self
+        for bunch in u.beads:
+            if hasattr(bunch, 'kind') and bunch.kind == 'beforeGroup':
+                return True
+        return False
     #@+node:EKR.20040526150818.1: *4* u.peekBead
     def peekBead(self, n):
         # g.trace(repr(n),g.callers())
@@ -196,6 +550,7 @@ class Undoer(object):
     #@+node:ekr.20060127113243: *4* u.pushBead
     def pushBead(self, bunch):
         u = self
+        u.compactBead(bunch)
         # New in 4.4b2:  Add this to the group if it is being accumulated.
         bunch2 = u.bead >= 0 and u.bead < len(u.beads) and u.beads[u.bead]
         if bunch2 and hasattr(bunch2, 'kind') and bunch2.kind == 'beforeGroup':
@@ -259,6 +614,7 @@ class Undoer(object):
             setattr(u, key, val)
             if key not in u.optionalIvars:
                 u.optionalIvars.append(key)
+        u.expandBead(bunch)
     #@+node:ekr.20031218072017.3614: *4* u.setRedoType
     # These routines update both the ivar and the menu label.
 
@@ -335,6 +691,7 @@ class Undoer(object):
         for v, vInfo, tInfo in treeInfo:
             u.restoreVnodeUndoInfo(vInfo)
             u.restoreTnodeUndoInfo(tInfo)
+        u.c.frame.tree.generation += 1
     #@+node:ekr.20050415170737.2: *5* u.restoreVnodeUndoInfo
     def restoreVnodeUndoInfo(self, bunch):
         """Restore all ivars saved in the bunch."""
@@ -342,6 +699,7 @@ class Undoer(object):
         v.statusBits = bunch.statusBits
         v.children = bunch.children
         v.parents = bunch.parents
+        v.dataChanged()
         uA = bunch.get('unknownAttributes')
         if uA is not None:
             v.unknownAttributes = uA
@@ -352,6 +710,7 @@ class Undoer(object):
         v.h = bunch.headString
         v.b = bunch.bodyString
         v.statusBits = bunch.statusBits
+        v.dataChanged()
         uA = bunch.get('unknownAttributes')
         if uA is not None:
             v.unknownAttributes = uA
@@ -887,6 +1246,8 @@ class Undoer(object):
         u.setUndoType("Can't Undo")
         u.beads = [] # List of undo nodes.
         u.bead = -1 # Index of the present bead: -1:len(beads)
+        u.beadSizes = {}
+        u.memorySlack = 0
     #@+node:ekr.20031218072017.3611: *4* u.enableMenuItems
     def enableMenuItems(self):
         u = self; frame = u.c.frame
@@ -969,36 +1330,13 @@ class Undoer(object):
         #@+at Incremental undo typing is similar to incremental syntax coloring. We compute
         # the number of leading and trailing lines that match, and save both the old and
         # new middle lines. NB: the number of old and new middle lines may be different.
+        # 
+        # We find the changed characters first, usually from the selection ranges,
+        # then look only at the lines near the change.
         #@@c
-        old_lines = oldText.split('\n')
-        new_lines = newText.split('\n')
-        new_len = len(new_lines)
-        old_len = len(old_lines)
-        min_len = min(old_len, new_len)
-        i = 0
-        while i < min_len:
-            if old_lines[i] != new_lines[i]:
-                break
-            i += 1
-        leading = i
-        if leading == new_len:
-            # This happens when we remove lines from the end.
-            # The new text is simply the leading lines from the old text.
-            trailing = 0
-        else:
-            i = 0
-            while i < min_len - leading:
-                if old_lines[old_len - i - 1] != new_lines[new_len - i - 1]:
-                    break
-                i += 1
-            trailing = i
-        # NB: the number of old and new middle lines may be different.
-        if trailing == 0:
-            old_middle_lines = old_lines[leading:]
-            new_middle_lines = new_lines[leading:]
-        else:
-            old_middle_lines = old_lines[leading: -trailing]
-            new_middle_lines = new_lines[leading: -trailing]
+        i, removed, added = u.getTypingSpan(oldText, newText, oldSel, newSel)
+        leading, trailing, old_middle_lines, new_middle_lines = u.getTypingLines(
+            oldText, newText, i, removed, added)
         # Remember how many trailing newlines in the old and new text.
         i = len(oldText) - 1; old_newlines = 0
         while i >= 0 and oldText[i] == '\n':
@@ -1292,11 +1630,15 @@ class Undoer(object):
         # Move the demoted nodes from the old parent to the new parent.
         parent_v.children = parent_v.children[: n + 1]
         u.p.v.children.extend(u.followingSibs)
+        c.frame.tree.generation += 1
         # Adjust the parent links of the moved nodes.
         # There is no need to adjust descendant links.
         for v in u.followingSibs:
             v.parents.remove(parent_v)
             v.parents.append(u.p.v)
+            v.dataChanged()
+        parent_v.dataChanged()
+        u.p.v.dataChanged()
         c.setCurrentPosition(u.p)
     #@+node:ekr.20050318085432.6: *4* u.redoGroup
     def redoGroup(self):
@@ -1385,8 +1727,11 @@ class Undoer(object):
         del u.oldParent_v.children[u.oldN]
         parent_v = u.newParent_v
         parent_v.children.insert(u.newN, v)
+        c.frame.tree.generation += 1
         v.parents.append(u.newParent_v)
         v.parents.remove(u.oldParent_v)
+        for v2 in (v, u.oldParent_v, u.newParent_v):
+            v2.dataChanged()
         u.updateMarks('new')
         for v in u.dirtyVnodeList:
             v.setDirty()
@@ -1426,17 +1771,23 @@ class Undoer(object):
             # Add the children up to the promoted nodes.
         # Remove the old children.
         u.p.v.children = []
+        c.frame.tree.generation += 1
         # Adjust the parent links in the moved children.
         # There is no need to adjust descendant links.
         for child in u.children:
             child.parents.remove(u.p.v)
             child.parents.append(parent_v)
+            child.dataChanged()
+        parent_v.dataChanged()
+        u.p.v.dataChanged()
         c.setCurrentPosition(u.p)
     #@+node:ekr.20080425060424.4: *4* u.redoSort
     def redoSort(self):
         u = self; c = u.c
         parent_v = u.p._parentVnode()
         parent_v.children = u.newChildren
+        parent_v.dataChanged()
+        c.frame.tree.generation += 1
         p = c.setPositionAfterSort(u.sortChildren)
         c.setCurrentPosition(p)
     #@+node:ekr.20050318085432.8: *4* u.redoTree
@@ -1470,6 +1821,25 @@ class Undoer(object):
         if u.yview:
             c.bodyWantsFocus()
             w.setYScrollPosition(u.yview)
+    #@+node:ekr.20170822183015.10: *3* u.showUndoMemory
+    @cmd('show-undo-memory')
+    def showUndoMemory(self, event=None):
+        '''Print the memory used by the undo stack, by kind of bead.'''
+        u = self
+        sizes = u.getExclusiveSizes()
+        d = {}
+        for bunch, n in zip(u.beads, sizes):
+            kind = bunch.get('kind') or bunch.get('undoType') or '<unknown>'
+            count, total = d.get(kind, (0, 0))
+            d[kind] = count + 1, total + n
+        limit = u.max_undo_memory
+        g.es_print('undo beads: %s, present bead: %s' % (len(u.beads), u.bead))
+        g.es_print('undo memory: %s KB, limit: %s' % (
+            sum(sizes) // 1024, '%s KB' % (limit // 1024) if limit > 0 else 'none'))
+        g.es_print('%8s %10s  %s' % ('beads', 'KB', 'kind'))
+        for kind in sorted(d, key=lambda z: -d[z][1]):
+            count, total = d.get(kind)
+            g.es_print('%8s %10s  %s' % (count, total // 1024, kind))
     #@+node:ekr.20031218072017.2039: *3* u.undo
     @cmd('undo')
     def undo(self, event=None):
@@ -1588,11 +1958,15 @@ class Undoer(object):
         u.p.v.children = u.p.v.children[: -n]
         # Add the demoted nodes to the parent's children.
         parent_v.children.extend(u.followingSibs)
+        c.frame.tree.generation += 1
         # Adjust the parent links.
         # There is no need to adjust descendant links.
         for sib in u.followingSibs:
             sib.parents.remove(u.p.v)
             sib.parents.append(parent_v)
+            sib.dataChanged()
+        parent_v.dataChanged()
+        u.p.v.dataChanged()
         c.setCurrentPosition(u.p)
     #@+node:ekr.20050318085713: *4* u.undoGroup
     def undoGroup(self):
@@ -1683,9 +2057,12 @@ class Undoer(object):
         assert u.newParent_v.children[u.newN] == v
         del u.newParent_v.children[u.newN]
         u.oldParent_v.children.insert(u.oldN, v)
+        c.frame.tree.generation += 1
         # Recompute the parent links.
         v.parents.append(u.oldParent_v)
         v.parents.remove(u.newParent_v)
+        for v2 in (v, u.oldParent_v, u.newParent_v):
+            v2.dataChanged()
         u.updateMarks('old')
         for v in u.dirtyVnodeList:
             v.setDirty()
@@ -1727,11 +2104,15 @@ class Undoer(object):
             # Add the nodes after the promoted nodes.
         # Add the demoted nodes to v's children.
         u.p.v.children = u.children[:]
+        c.frame.tree.generation += 1
         # Adjust the parent links.
         # There is no need to adjust descendant links.
         for child in u.children:
             child.parents.remove(parent_v)
             child.parents.append(u.p.v)
+            child.dataChanged()
+        parent_v.dataChanged()
+        u.p.v.dataChanged()
         c.setCurrentPosition(u.p)
     #@+node:ekr.20031218072017.1493: *4* u.undoRedoText
     def undoRedoText(self, p,
@@ -1799,6 +2180,8 @@ class Undoer(object):
         u = self; c = u.c
         parent_v = u.p._parentVnode()
         parent_v.children = u.oldChildren
+        parent_v.dataChanged()
+        c.frame.tree.generation += 1
         p = c.setPositionAfterSort(u.sortChildren)
         c.setCurrentPosition(p)
     #@+node:ekr.20050318085713.2: *4* u.undoTree
@@ -3767,6 +3767,7 @@ class HeadWrapper(leoFrame.StringTextWrapper):
         self.ins = i
         self.sel = i, i
         self.p.v._headString = self.s
+        self.p.v.textChanged()
     #@-others
 #@+node:ekr.20170525062512.1: *3* class LogWrapper (leoFrame.StringTextWrapper)
 class LogWrapper(leoFrame.StringTextWrapper):
@@ -83,7 +83,10 @@ if g.isPython3:
 else:
     import StringIO
     StringIO = StringIO.StringIO
+import hashlib
+import os
 import re
+import sys
 # import time
 #@-<< linescanner imports >>
 #@+others
@@ -146,6 +149,13 @@ class Importer(object):
             'at_auto_warns_about_leading_whitespace')
         self.warn_about_underindented_lines = True
         # self.at_auto_separate_non_def_nodes = False
+        self.import_checks = c.config.getString('import_checks') or 'on-change'
+            # 'always', 'on-change' or 'never'. See i.check.
+        if self.import_checks not in ('always', 'on-change', 'never'):
+            g.es_print('ignoring @string import_checks = %s' % self.import_checks)
+            self.import_checks = 'on-change'
+        if g.unitTesting:
+            self.import_checks = 'always'
 
         # State vars.
         self.errors = 0
@@ -346,7 +356,40 @@ class Importer(object):
             if trace and trace_fail: g.trace(
                 'NO MATCH: i: %s ch: %r context: %r line: %r' % (
                     i, ch, context, s))
-        return new_context, i+1, 0, 0, 0, False
+        # Skipping characters that start no pattern changes only i.
+        return new_context, self.skip_uninteresting(s, i+1, d), 0, 0, 0, False
+    #@+node:ekr.20170823101500.1: *4* i.skip_uninteresting
+    skip_patterns = {}
+        # Keys are id(table), values are (table, compiled pattern).
+    use_skip_patterns = True
+        # False: i.scan_dict advances one character at a time.
+        # The importer benchmark and unit tests compare both ways.
+
+    def skip_uninteresting(self, s, i, d):
+        '''
+        Return the index of the first character of s at or after i that may
+        start a pattern in table d, or len(s).
+
+        For each table, a precompiled regex finds the next such character,
+        so runs of uninteresting characters are skipped by the re module.
+        Skipping is equivalent to scanning each character separately,
+        because i.scan_dict returns zero deltas and the old context for
+        characters that match no pattern.
+        '''
+        if not self.use_skip_patterns or i >= len(s) or s[i] in d:
+            return i
+        data = self.skip_patterns.get(id(d))
+        if data and data[0] is d:
+            pattern = data[1]
+        else:
+            # Only single-character keys can match: see i.scan_dict.
+            keys = sorted(z for z in d if len(z) == 1)
+            pattern = re.compile('[%s]' % ''.join(
+                [re.escape(z) for z in keys])) if keys else None
+            self.skip_patterns[id(d)] = d, pattern
+                # Keep a reference to d so its id can not be reused.
+        m = pattern and pattern.search(s, i)
+        return m.start() if m else len(s)
     #@+node:ekr.20161108170435.1: *4* i.scan_line
     def scan_line(self, s, prev_state):
         '''
@@ -373,11 +416,12 @@ class Importer(object):
             's':s,
         }
         new_state = self.state_class(d)
-        i = 0
+        i, context, table = 0, None, None
         while i < len(s):
             progress = i
-            context = new_state.context
-            table = self.get_table(context)
+            if context != new_state.context or table is None:
+                context = new_state.context
+                table = self.get_table(context)
             data = self.scan_dict(context, i, s, table)
             i = new_state.update(data)
             assert progress < i
@@ -881,10 +925,20 @@ class Importer(object):
             v._bodyString = g.toUnicode(''.join(lines), reportErrors=True)
                 # Bug fix: 2017/01/24: must convert to unicode!
                 # This was the source of the internal error in the p.b getter.
+            v.textChanged()
             delattr(v, '_import_lines')
     #@+node:ekr.20161108131153.3: *4* Stage 4: i.check & helpers
     def check(self, unused_s, parent):
-        '''True if perfect import checks pass.'''
+        '''
+        True if perfect import checks pass.
+
+        @string import_checks = always: check all imports.
+        @string import_checks = on-change: remember successful checks in
+        c.db, the file cache, and check only files that have changed, or
+        whose importer or relevant settings have changed, since the last
+        successful check. c.db holds one entry per file.
+        @string import_checks = never: do no checks.
+        '''
         trace = False # and g.unitTesting
         trace_all = False # Trace all lines, always.
         trace_lines = True # Trace all lines on failure.
@@ -894,10 +948,18 @@ class Importer(object):
                 g.trace('===== skipping all checks', parent.h)
             g.app.suppressImportChecks = False
             return True
+        if self.import_checks == 'never':
+            return True
         c = self.c
         # t1 = time.clock()
         sfn = g.shortFileName(self.root.h)
         s1 = g.toUnicode(self.file_s, self.encoding)
+        key = self.check_key() if self.import_checks == 'on-change' else None
+        check_hash = key and self.check_hash(s1)
+        if key and c.db.get(key) == check_hash:
+            if trace and trace_status:
+                g.trace('===== already checked', parent.h)
+            return True
         s2 = self.trial_write()
         lines1, lines2 = g.splitLines(s1), g.splitLines(s2)
         if self.strict:
@@ -919,6 +981,9 @@ class Importer(object):
             g.trace('===== entry')
             self.trace_lines(lines1, lines2, parent)
         ok = lines1 == lines2
+        if ok and key:
+            # Remember only checks that issue no warnings.
+            c.db[key] = check_hash
         if not ok and not self.strict:
             if trace and trace_status:
                 g.trace('===== %s NOT OK cleaning LWS' % self.name)
@@ -947,6 +1012,66 @@ class Importer(object):
         if trace and trace_status:
             g.trace('Ok:', ok, g.shortFileName(parent.h))
         return ok
+    #@+node:ekr.20170823113000.1: *5* i.check_key, check_hash & importer_version
+    check_settings = (
+        ('bool', 'at_auto_separate_non_def_nodes'),
+        ('data', 'import_html_tags'),
+        ('data', 'import_xml_tags'),
+        ('bool', 'js_importer_clean_lws'),
+        ('bool', 'put_python_decorators_in_imported_headlines'),
+    )
+        # The (kind, name) pairs of settings that may change the result of
+        # an import, and so the result of i.check.
+
+    def check_key(self):
+        '''
+        Return the key in c.db that records the last successful i.check of
+        the imported file. Each file has one key, so c.db does not grow as
+        the file changes.
+        '''
+        return 'import-check/' + (g.fullPath(self.c, self.root) or self.root.h)
+
+    def check_hash(self, s):
+        '''
+        Return the value recorded in c.db after a successful i.check of s,
+        the contents of an external file: a hash of s, the importer's version
+        and all settings that may change the result of the import.
+        '''
+        c = self.c
+        m = hashlib.md5()
+        for z in (self.importer_version(), self.name, self.strict, self.tab_width):
+            m.update(g.toEncodedString('%s\n' % z))
+        for kind, name in self.check_settings:
+            val = c.config.getData(name) if kind == 'data' else c.config.getBool(name)
+            m.update(g.toEncodedString('%s=%s\n' % (name, val)))
+        m.update(g.toEncodedString(s))
+        return m.hexdigest()
+
+    importer_versions = {}
+        # Keys are importer classes, values are strings.
+
+    def importer_version(self):
+        '''
+        Return a string that changes whenever the code of this importer
+        may have changed: the paths, sizes and modification times of the
+        modules that define the importer's class and its base classes.
+        '''
+        cls = self.__class__
+        version = self.importer_versions.get(cls)
+        if version is None:
+            aList = []
+            for cls2 in cls.__mro__:
+                fn = getattr(sys.modules.get(cls2.__module__), '__file__', None)
+                if fn:
+                    if fn.endswith(('.pyc', '.pyo')):
+                        fn = fn[:-1]
+                    try:
+                        st = os.stat(fn)
+                        aList.append('%s %s %s' % (fn, st.st_mtime, st.st_size))
+                    except OSError:
+                        aList.append(fn)
+            version = self.importer_versions[cls] = '\n'.join(aList)
+        return version
     #@+node:ekr.20161108131153.4: *5* i.clean_blank_lines
     def clean_blank_lines(self, lines):
         '''Remove all blanks and tabs in all blank lines.'''
@@ -151,7 +151,7 @@ class Php_Importer(Importer):
             if trace and trace_fail: g.trace(
                 'NO MATCH: i: %s ch: %r context: %r line: %r' % (
                     i, ch, context, s))
-        return new_context, i+1, 0, 0, 0, False
+        return new_context, self.skip_uninteresting(s, i+1, d), 0, 0, 0, False
     #@+node:ekr.20161130044051.1: *3* php_i.skip_heredoc_string (not used)
     # EKR: This is Dave Hein's heredoc code from the old PHP scanner.
     # I have included it for reference in case heredoc problems arise.
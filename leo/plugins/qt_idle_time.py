@@ -108,6 +108,10 @@ class IdleTime(object):
     #@+node:ekr.20140825042850.18408: *3* IdleTime.call_handler
     def call_handler(self):
         '''Carefully call the handler.'''
+        itm = g.app.idleTimeManager
+        if itm and itm.skip_timer(self):
+            # The handler is slow: skip this firing.
+            return
         try:
             self.count += 1
             self.time = time.time()
@@ -116,6 +120,8 @@ class IdleTime(object):
         except Exception:
             g.es_exception()
             self.stop()
+        if itm:
+            itm.record_timer(self, time.time() - self.time)
     #@+node:ekr.20140825080012.18529: *3* IdleTime.destroy_self
     def destroy_self(self):
         '''Remove the instance from g.app.idle_timers.'''
@@ -0,0 +1,117 @@
+#@+leo-ver=5-thin
+#@+node:ekr.20170823101500.2: * @file ../test/importer-benchmark.py
+'''
+Benchmark the line scanners of Leo's importers.
+
+The corpora are the strings in the @test nodes in the "Tests of @auto"
+node of unitTest.leo, plus Leo's own core .py files for the Python
+importer. For each importer, this script scans all lines with and without
+Importer.use_skip_patterns, checks that both ways produce the same scan
+states, and prints the times.
+
+Run this script from the leo-editor directory:
+
+    python leo/test/importer-benchmark.py
+'''
+import glob
+import os
+import re
+import sys
+import time
+
+# Switches...
+count = 5               # Number of times to scan each corpus.
+leo_core_files = True   # True: add leo/core/*.py to the Python corpus.
+
+# Keys are the headlines of the "x tests" nodes, values are file extensions.
+groups = {
+    'C tests': '.c',
+    'c# tests': '.cs',
+    'dart tests': '.dart',
+    'elisp tests': '.el',
+    'Java tests': '.java',
+    'Pascal tests': '.pas',
+    'Perl tests': '.pl',
+    'PHP tests': '.php',
+    'Python tests': '.py',
+    'TypeScript tests': '.ts',
+}
+
+# Import stuff...
+dir_ = os.path.abspath('.')
+if dir_ not in sys.path:
+    sys.path.append(dir_)
+import leo.core.leoBridge as leoBridge
+controller = leoBridge.controller(
+    gui='nullGui',
+    loadPlugins=False,
+    readSettings=False,
+    silent=True,
+    verbose=False)
+g = controller.globals()
+#@+others
+#@+node:ekr.20170823101500.3: ** get_corpora
+string_pattern = re.compile(
+    r"^\s*s\s*=\s*(?:g\.adjustTripleString\()?[rub]?('''|\"\"\")\\?\n(.*?)\1",
+    re.DOTALL | re.MULTILINE)
+
+def get_corpora(c):
+    '''Return a dict: keys are file extensions, values are lists of lines.'''
+    d = {}
+    root = g.findNodeAnywhere(c, 'Tests of @auto')
+    assert root, 'no "Tests of @auto" node'
+    for p in root.children():
+        ext = groups.get(p.h)
+        if ext:
+            for p2 in p.subtree():
+                for m in string_pattern.finditer(p2.b):
+                    d.setdefault(ext, []).extend(g.splitLines(m.group(2)))
+    if leo_core_files:
+        for fn in sorted(glob.glob(os.path.join(g.app.loadDir, '*.py'))):
+            s, e = g.readFileIntoString(fn)
+            if s:
+                d.setdefault('.py', []).extend(g.splitLines(s))
+    return d
+#@+node:ekr.20170823101500.4: ** scan_lines
+def scan_lines(importer, lines):
+    '''Scan all lines, returning a list of the scan states' ivars.'''
+    result = []
+    prev_state = importer.state_class()
+    for line in lines:
+        new_state = importer.scan_line(line, prev_state)
+        result.append(dict([(key, val) for key, val in vars(new_state).items()
+            if val is None or isinstance(val, (bool, int, str))]))
+        prev_state = new_state
+    return result
+#@+node:ekr.20170823101500.5: ** benchmark
+def benchmark(c, ext, lines):
+    '''Time scanning lines with the importer for ext, both ways.'''
+    aClass = g.app.classDispatchDict.get(ext)
+    if not aClass:
+        print('no importer for %s' % ext)
+        return
+    importer = aClass(c.importCommands)
+    importer.tab_width = -4
+        # Normally set by i.run.
+    times, states = [], []
+    for flag in (False, True):
+        importer.use_skip_patterns = flag
+        states.append(scan_lines(importer, lines))
+        t1 = time.time()
+        for n in range(count):
+            scan_lines(importer, lines)
+        t2 = time.time()
+        times.append(t2 - t1)
+    ok = 'ok' if states[0] == states[1] else 'MISMATCH'
+    print('%-6s %-16s %7s lines %7.3f sec %7.3f sec %5.1fx %s' % (
+        ext, aClass.__name__, len(lines), times[0], times[1],
+        times[0] / max(times[1], 1e-9), ok))
+#@-others
+c = controller.openLeoFile(os.path.join(g.app.loadDir, '..', 'test', 'unitTest.leo'))
+if not g.app.classDispatchDict:
+    g.app.loadManager.createAllImporetersData()
+corpora = get_corpora(c)
+print('%s passes. Times without and with Importer.use_skip_patterns:' % count)
+for ext in sorted(corpora):
+    benchmark(c, ext, corpora.get(ext))
+#@-leo